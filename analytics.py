@@ -1,7 +1,14 @@
 
-import pandas as pd
+import argparse
+import os
 import logging
-from sql_queries import create_connection, test_queries, validation_queries
+from backends import add_backend_argument, get_backend
+from instrument import add_metrics_arguments, write_metrics, label
+from result_cache import ResultCache
+from sampling import sample_rows
+from streaming import open_sink, stream_dataframes, write_stream
+from sql_queries import test_queries, validation_queries, rollup_queries, rollup_totals, \
+    songplay_rollup_totals
 
 def table_counts(cur, conn):
     """
@@ -16,90 +23,148 @@ def table_counts(cur, conn):
             print(row)
 
 
-def execute_test_queries(cur, conn):
-    for query in test_queries:
+def fresh_rollups(cur, conn):
+    """
+    Rollup tables that exist and count the same plays up to the same day
+    as songplay, so queries can be answered from them instead of the fact
+    table. A load that failed between the songplay insert and the rollup
+    refresh leaves them out.
+    """
+    rollups = {table for _, tables in rollup_queries.values() for table in tables}
+    fresh = set()
+    cur.execute(songplay_rollup_totals)
+    plays, last_day = cur.fetchone()
+    for table in sorted(rollups):
+        try:
+            cur.execute(rollup_totals.format(table))
+            rolled_up, rolled_up_day = cur.fetchone()
+            if int(rolled_up or 0) == int(plays or 0) and rolled_up_day == last_day:
+                fresh.add(table)
+            else:
+                logging.info('Rollup {} is stale: {} plays up to {}, songplay has {} up to {}'.format(
+                    table, rolled_up, rolled_up_day, plays, last_day))
+        except Exception as e:
+            conn.rollback()
+            logging.info('Rollup {} unavailable: {}'.format(table, e))
+    return fresh
+
+
+def answer_from_rollups(query, fresh):
+    """ The rollup-backed equivalent of a query if its rollups are fresh """
+    rollup_query, tables = rollup_queries.get(query, (query, ()))
+    return rollup_query if set(tables) <= fresh else query
+
+
+def execute_test_queries(cur, conn, output_dir=None, chunksize=10000, fmt='parquet',
+                         cache=None):
+    """
+    Run the test queries on server-side cursors. Results are streamed in
+    chunks, printed or written to output_dir, so client memory stays flat
+    however large a result is. Results found in the cache are served from
+    disk without touching the cluster, and queries that the songplay
+    rollups can answer read those instead of the fact table.
+
+    Args:
+        * cur: the cursor to the db connection
+        * conn: the db connection
+        * output_dir: write each result to <output_dir>/testN.<fmt> instead of printing it
+        * chunksize: rows fetched per round trip
+        * fmt: 'parquet' or 'csv'
+        * cache: ResultCache, or None to always query the cluster
+    """
+    fresh = fresh_rollups(cur, conn) if conn is not None else set()
+    for i, query in enumerate(test_queries, 1):
+        name = 'test{}'.format(i)
         try:
             logging.info('Query data in final tables. {}'.format(query))
             print(query)
-            cur.execute(query)
-            rows = cur.fetchall()
-            print(pd.DataFrame(rows))
-            # for row in rows:
-            #     print(row)
+            with label(name):
+                cached = cache.get(query) if cache is not None else None
+                if cached is not None:
+                    print('(cached result)')
+                    chunks = iter([cached])
+                else:
+                    chunks = stream_dataframes(conn, answer_from_rollups(query, fresh), chunksize)
+                    if cache is not None:
+                        chunks = cache.record(query, chunks)
+                if output_dir:
+                    path = os.path.join(output_dir, '{}.{}'.format(name, fmt))
+                    print('{} rows written to {}'.format(write_stream(chunks, open_sink(path)), path))
+                else:
+                    total = 0
+                    for frame in chunks:
+                        if total == 0:
+                            print(frame)
+                        total += len(frame)
+                    print('{} rows'.format(total))
+            if conn is not None:
+                conn.commit()
 
         except Exception as e:
+            if conn is not None:
+                conn.rollback()
             print(e)
 
 
 
 def sample_data_from_tables(cur):
     """ Print a sample of the data in each of the final tables.
+        The samples kept by the loads are read, so no table is scanned.
 
         Args:
         * cur: the cursor to the db connection
     """
-    tables = (
-                ("staging_events", 
-                    ("artist", "auth", "firstName", "gender" ,
-                     "itemInSession", "lastName", "length", "level", 
-                     "location", "method", "page", "registration",
-                     "sessionId" ,"song", "status" ,"ts", "userAgent", "userId")
-                ),
-                ("staging_songs", 
-                    ("num_songs", "artist_id", "artist_latitude", "artist_longitude", 
-                     "artist_location", "artist_name", "song_id", "title", "duration",
-                     "year")
-                ),
-                ("songplay",
-                    ("songplay_id", "start_time", "user_id", "level", "song_id",
-                    "artist_id", "session_id", "location", "user_agent")
-                ),
-                ("users", 
-                    ("user_id", "first_name", "last_name", "gender", "level")
-                ),
-                ("songs", 
-                    ("song_id", "title", "artist_id", "year", "duration")
-                ),
-                ("artists", 
-                    ("artist_id", "name", "location", "latitude", "longitude")
-                ),
-                ("time", 
-                    ("start_time", "hour", "day", "week", "month", "year", "weekday")
-                )
-            )
-        
-    for table, cols in tables:
-        query = """
-            SELECT * FROM {}
-            ORDER BY random()
-            LIMIT {};
-        """.format(table, 20)
-
-        logging.info('Sample of data in final tables. {}'.format(query))
+    tables = ("staging_events", "staging_songs", "songplay", "users", "songs", "artists", "time")
+
+    import pandas as pd
+    for table in tables:
         try:
-            cur.execute(query)
-            rows = cur.fetchall()
+            cols, rows = sample_rows(cur, table, 20)
             print(pd.DataFrame(rows, columns=cols))
 
         except Exception as e:
             print(e)
 
-def main():
+def main(args):
     """
     Runs analytical queries
     """
-    cur, conn = create_connection()
-    print('Connected to Redshift Cluster...')
-
-    # View a sample of data for sanitation
-    sample_data_from_tables(cur)
-    # Analytical queries
-    table_counts(cur, conn)
-    execute_test_queries(cur, conn)
-  
+    backend = get_backend(args.backend)
+    cache = None if args.no_cache else ResultCache.from_config(scope=backend.scope)
+    test_args = (args.output_dir, args.chunksize, args.format, cache)
+
+    if args.tests_only and cache is not None and \
+            all(cache.get(query) is not None for query in test_queries):
+        # every result is cached, no need to connect
+        execute_test_queries(None, None, *test_args)
+        write_metrics(args)
+        return
+
+    with backend.session() as (cur, conn):
+        print('Connected to {}...'.format(backend.name))
+
+        if not args.tests_only:
+            # View a sample of data for sanitation
+            sample_data_from_tables(cur)
+            table_counts(cur, conn)
+        # Analytical queries
+        execute_test_queries(cur, conn, *test_args)
+        write_metrics(args, cur)
+
     logging.info('Exiting...')
-    conn.close()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output-dir', dest='output_dir', default=None,
+                        help='write test query results to files instead of printing them')
+    parser.add_argument('--format', dest='format', default='parquet', choices=('parquet', 'csv'))
+    parser.add_argument('--chunksize', dest='chunksize', type=int, default=10000)
+    parser.add_argument('--tests-only', dest='tests_only', default=False, action='store_true',
+                        help='only run the test queries, skipping samples and counts')
+    parser.add_argument('--no-cache', dest='no_cache', default=False, action='store_true',
+                        help='always run the test queries on the cluster')
+    add_backend_argument(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    main(args)
\ No newline at end of file
@@ -0,0 +1,304 @@
+import argparse
+import hashlib
+import logging
+import os
+import re
+from contextlib import contextmanager
+
+from config import config
+from local_loader import LOG_JSONPATHS, LOG_ZIP, batched, copy_rows, read_jsonpaths
+from parquet_converter import TABLES, arrow_table, iter_input, list_inputs, typed_rows
+from schema import ddl_columns, duckdb_ddl, duckdb_sequence_drops, postgres_ddl
+from sql_queries import create_table_queries
+
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+BACKENDS = ('redshift', 'postgres', 'duckdb')
+# Rows per COPY or Arrow batch of the local loads, which bounds their memory
+BATCH_ROWS = 10000
+
+
+def local_sources(config=config):
+    """
+    Log and song data loaded by the local backends: [LOCAL] LOG_DATA, a zip
+    or directory of JSON files defaulting to data/log_data.zip, and the
+    optional [LOCAL] SONG_DATA directory
+
+    Returns:
+        (log data path, song data path or None)
+    """
+    return (config.get('LOCAL', 'LOG_DATA', fallback=None) or LOG_ZIP,
+            config.get('LOCAL', 'SONG_DATA', fallback=None) or None)
+
+
+def read_records(source):
+    """ Every JSON record of a zip, directory or S3 prefix, in key order """
+    for path, _ in list_inputs(source):
+        yield from iter_input(path)
+
+
+def staged_rows(config=config):
+    """
+    Typed rows of the local data for each staging table
+
+    Yields:
+        (staging table, iterator of rows in column order)
+    """
+    log_data, song_data = local_sources(config)
+    yield 'staging_events', typed_rows('staging_events', read_records(log_data),
+                                       read_jsonpaths(LOG_JSONPATHS))
+    if song_data:
+        yield 'staging_songs', typed_rows('staging_songs', read_records(song_data))
+
+
+def cache_scope(name, *identity):
+    """ Result cache scope of a database: the backend name and a hash of what locates it """
+    digest = hashlib.sha1('\x00'.join(map(str, identity)).encode('utf-8')).hexdigest()
+    return '{}-{}'.format(name, digest[:12])
+
+
+class RedshiftBackend:
+    """ The cluster from dwh.cfg, staged from S3 by etl.py """
+
+    name = 'redshift'
+    local = False
+
+    @property
+    def scope(self):
+        return cache_scope(self.name, *(config.get('DB', key, fallback='')
+                                        for key in ('HOST', 'DB_PORT', 'DB_NAME')))
+
+    def session(self):
+        from db import session
+        return session()
+
+    def ddl(self, query):
+        return [query]
+
+    def drops(self, create_queries):
+        return []
+
+
+class PostgresBackend:
+    """ A local Postgres reached through psycopg2, staged with binary COPY """
+
+    name = 'postgres'
+    local = True
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.scope = cache_scope(self.name, dsn)
+
+    @contextmanager
+    def session(self):
+        import psycopg2
+        from instrument import InstrumentedConnection
+        conn = psycopg2.connect(self.dsn, connection_factory=InstrumentedConnection)
+        try:
+            yield conn.cursor(), conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def ddl(self, query):
+        return [postgres_ddl(query)]
+
+    def drops(self, create_queries):
+        return []
+
+    def load_rows(self, cur, conn, table, rows, batch_size=BATCH_ROWS):
+        """
+        Binary COPY typed_rows into a staging table, batch_size rows per COPY
+
+        Returns:
+            number of rows loaded
+        """
+        count = copy_rows(cur, table, ddl_columns(TABLES[table]), rows, batch_size)
+        conn.commit()
+        return count
+
+    def load_staging(self, cur, conn):
+        """
+        Load the local log and song data into the staging tables
+
+        Returns:
+            number of rows loaded
+        """
+        return load_staged_rows(self, cur, conn)
+
+
+class DuckDBSession:
+    """
+    DB-API cursor and connection over one DuckDB connection, so the code
+    written against psycopg2 sessions runs unchanged. DuckDB commits every
+    statement on its own, so commit and rollback do nothing, and psycopg2
+    %s / %(name)s parameters are rewritten to ? / $name.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self.itersize = None
+
+    def execute(self, query, params=None):
+        if params is None:
+            self._conn.execute(query)
+        elif isinstance(params, dict):
+            self._conn.execute(re.sub(r'%\((\w+)\)s', r'$\1', query), params)
+        else:
+            self._conn.execute(query.replace('%s', '?'), list(params))
+        return self
+
+    def fetchone(self):
+        return self._conn.fetchone()
+
+    def fetchmany(self, size):
+        return self._conn.fetchmany(size)
+
+    def fetchall(self):
+        return self._conn.fetchall()
+
+    @property
+    def description(self):
+        return self._conn.description
+
+    def insert_arrow(self, table, data):
+        """ Insert a pyarrow Table into a table with the same columns """
+        self._conn.register('staged', data)
+        try:
+            self._conn.execute('INSERT INTO {} SELECT * FROM staged;'.format(table))
+        finally:
+            self._conn.unregister('staged')
+
+    def cursor(self, name=None):
+        return DuckDBSession(self._conn.cursor())
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class DuckDBBackend:
+    """ In-process DuckDB in a local file, staged from Arrow tables """
+
+    name = 'duckdb'
+    local = True
+
+    def __init__(self, path):
+        self.path = path
+        self.scope = cache_scope(self.name, path)
+
+    @contextmanager
+    def session(self):
+        import duckdb
+        conn = duckdb.connect(self.path)
+        try:
+            session = DuckDBSession(conn)
+            yield session, session
+        finally:
+            conn.close()
+
+    def ddl(self, query):
+        return duckdb_ddl(query)
+
+    def drops(self, create_queries):
+        return duckdb_sequence_drops(create_queries)
+
+    def load_rows(self, cur, conn, table, rows, batch_size=BATCH_ROWS):
+        """
+        Insert typed_rows into a staging table, one Arrow table of batch_size rows at a time
+
+        Returns:
+            number of rows loaded
+        """
+        count = 0
+        for batch in batched(rows, batch_size):
+            cur.insert_arrow(table, arrow_table(table, batch))
+            count += len(batch)
+        return count
+
+    def load_staging(self, cur, conn):
+        """
+        Load the local log and song data into the staging tables
+
+        Returns:
+            number of rows loaded
+        """
+        return load_staged_rows(self, cur, conn)
+
+
+def load_staged_rows(backend, cur, conn):
+    """
+    Load the local log and song data into the staging tables of a local backend
+
+    Returns:
+        number of rows loaded
+    """
+    total = 0
+    for table, rows in staged_rows():
+        count = backend.load_rows(cur, conn, table, rows)
+        print('{} rows COPIED to {}.'.format(count, table))
+        total += count
+    return total
+
+
+def get_backend(name, config=config):
+    """
+    Backend by name
+
+    Args:
+        name: 'redshift', 'postgres' or 'duckdb'
+        config: config object, [LOCAL] DSN and DUCKDB locate the local databases
+    """
+    if name == 'postgres':
+        return PostgresBackend(config.get('LOCAL', 'DSN', fallback='dbname=sparkify'))
+    if name == 'duckdb':
+        path = config.get('LOCAL', 'DUCKDB', fallback='sparkify.duckdb')
+        return DuckDBBackend(path if path == ':memory:' or os.path.isabs(path)
+                             else os.path.join(ROOT_PATH, path))
+    return RedshiftBackend()
+
+
+def add_backend_argument(parser):
+    parser.add_argument('--backend', dest='backend', default='redshift', choices=BACKENDS,
+                        help='run against the cluster or a local Postgres/DuckDB ([LOCAL])')
+
+
+def main(args):
+    """ Rebuild the star schema from the local data and run the test queries """
+    import analytics
+    import create_tables
+    import etl
+    from result_cache import bump_load_versions, cache_dir
+    from sampling import refresh_samples
+    from schema import table_name
+
+    settings = config.settings
+    backend = get_backend(args.backend)
+    with backend.session() as (cur, conn):
+        create_tables.drop_tables(cur, conn, backend.drops(create_table_queries(settings)))
+        create_tables.create_tables(cur, conn, settings, backend.ddl)
+        conn.commit()
+        backend.load_staging(cur, conn)
+        etl.insert_tables(cur, conn, settings)
+        refresh_samples(cur, ddl=backend.ddl)
+        conn.commit()
+        bump_load_versions([table_name(q) for q in create_table_queries(settings)],
+                           cache_dir(config, backend.scope))
+        analytics.table_counts(cur, conn)
+        analytics.execute_test_queries(cur, conn)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Build the star schema from the local data and run the test queries')
+    parser.add_argument('--backend', dest='backend', default='duckdb', choices=BACKENDS[1:])
+    args = parser.parse_args()
+    main(args)
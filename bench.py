@@ -0,0 +1,212 @@
+import argparse
+import copy
+import hashlib
+import json
+import logging
+import random
+import time
+
+from backends import DuckDBBackend, PostgresBackend
+from config import config
+from local_loader import LOG_JSONPATHS, LOG_ZIP, batched, iter_records, read_jsonpaths
+from parquet_converter import typed_rows
+from time_dimension import extend_time_dimension
+from sql_queries import create_table_queries, drop_table_queries, insert_table_graph, \
+    rollup_queries, test_queries
+
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def read_events(zip_path=LOG_ZIP):
+    """ The bundled log events, used as templates for synthetic data """
+    return [record for _, _, record in iter_records(zip_path)]
+
+
+def synthetic_events(templates, scale, seed=0):
+    """
+    Generate scale times as many events as the templates. Every copy of the
+    template set gets its own users, sessions, song titles and time window,
+    so the dimension tables grow with the scale factor too.
+
+    Args:
+        templates: list of event records
+        scale: scale factor, 1 gives as many events as data/log_data.zip
+        seed: random seed
+    Yields:
+        event records
+    """
+    rng = random.Random(seed)
+    span = max(r['ts'] for r in templates) - min(r['ts'] for r in templates) + DAY_MS
+    for i in range(int(len(templates) * scale)):
+        block = i // len(templates)
+        event = copy.copy(rng.choice(templates))
+        if block:
+            if event.get('userId'):
+                event['userId'] = str(int(event['userId']) + 1000 * block)
+            event['sessionId'] = event['sessionId'] + 100000 * block
+            event['ts'] = event['ts'] + span * block
+            if event.get('song'):
+                event['song'] = '{} #{}'.format(event['song'], block)
+        yield event
+
+
+def synthetic_songs(templates, scale, match_rate=0.5, seed=0):
+    """
+    Generate staging_songs rows for a share of the songs played in the
+    synthetic events, so the songplay join finds matches
+
+    Args:
+        templates: list of event records
+        scale: scale factor used for the events
+        match_rate: share of played songs that exist in the song data
+        seed: random seed
+    Yields:
+        staging_songs records
+    """
+    rng = random.Random(seed)
+    played = sorted({(r['song'], r['artist'], r['length']) for r in templates if r.get('song')})
+    for block in range(max(1, int(scale + 0.999))):
+        for song, artist, length in played:
+            if rng.random() > match_rate:
+                continue
+            title = '{} #{}'.format(song, block) if block else song
+            artist_id = stable_id('AR', artist)
+            yield dict(num_songs=1,
+                       artist_id=artist_id,
+                       artist_latitude=round(rng.uniform(-60, 60), 5),
+                       artist_longitude=round(rng.uniform(-180, 180), 5),
+                       artist_location='',
+                       artist_name=artist,
+                       song_id=stable_id('SO', title, artist),
+                       title=title,
+                       duration=length,
+                       year=rng.choice([0, rng.randint(1960, 2018)]))
+
+
+def stable_id(prefix, *parts):
+    """ Deterministic 18 character id, e.g. SO0123456789ABCDEF """
+    digest = hashlib.md5('|'.join(map(str, parts)).encode('utf-8')).hexdigest()
+    return prefix + digest[:16].upper()
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a list of numbers """
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, int(round(pct / 100.0 * len(values) + 0.5)) - 1))]
+
+
+def run_scale(backend, settings, templates, scale, repeat=5, batch_size=50000, seed=0):
+    """
+    Build the star schema from synthetic data at one scale factor and time
+    every insert and test query
+
+    Args:
+        backend: backends.PostgresBackend or DuckDBBackend, loaded as by etl.py
+        settings: config.Settings the statements are built from
+        templates: bundled log events
+        scale: scale factor
+        repeat: runs per test query
+        batch_size: rows per load batch
+        seed: random seed
+    Returns:
+        dict with load, insert and query measurements
+    """
+    with backend.session() as (cur, conn):
+        for query in drop_table_queries + backend.drops(create_table_queries(settings)):
+            cur.execute(query)
+        for query in create_table_queries(settings):
+            for statement in backend.ddl(query):
+                cur.execute(statement)
+        conn.commit()
+
+        result = dict(scale=scale, engine=backend.name, inserts={}, queries={})
+        staging = (('staging_events', synthetic_events(templates, scale, seed),
+                    read_jsonpaths(LOG_JSONPATHS)),
+                   ('staging_songs', synthetic_songs(templates, scale, seed=seed), None))
+        start, staged, staged_bytes = time.perf_counter(), 0, 0
+        for table, records, jsonpaths in staging:
+            for batch in batched(records, batch_size):
+                # size of the batch as raw JSON, comparable to the S3 source files
+                staged_bytes += sum(len(json.dumps(record)) + 1 for record in batch)
+                staged += backend.load_rows(cur, conn, table, typed_rows(table, batch, jsonpaths),
+                                            batch_size)
+        seconds = time.perf_counter() - start
+        result['load'] = dict(rows=staged, bytes=staged_bytes, seconds=seconds,
+                              rows_per_second=staged / seconds,
+                              bytes_per_second=staged_bytes / seconds)
+
+        build_start = time.perf_counter()
+        extend_time_dimension(cur, settings, conn)
+        result['inserts']['time'] = time.perf_counter() - build_start
+        for name, (queries, _) in insert_table_graph(settings).items():
+            start = time.perf_counter()
+            for query in ((queries,) if isinstance(queries, str) else queries):
+                cur.execute(query)
+                conn.commit()
+            result['inserts'][name] = time.perf_counter() - start
+        seconds = time.perf_counter() - build_start
+        result['build'] = dict(seconds=seconds, rows_per_second=staged / seconds)
+
+        queries = [('test{}'.format(i), query) for i, query in enumerate(test_queries, 1)]
+        queries += [('test{}_rollup'.format(i), rollup_queries[query][0])
+                    for i, query in enumerate(test_queries, 1) if query in rollup_queries]
+        for name, query in queries:
+            latencies = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                cur.execute(query)
+                cur.fetchall()
+                latencies.append(time.perf_counter() - start)
+                conn.rollback()
+            result['queries'][name] = dict(
+                p50=percentile(latencies, 50),
+                p95=percentile(latencies, 95),
+                queries_per_second=len(latencies) / sum(latencies))
+    return result
+
+
+def print_report(result):
+    print('\nScale {scale} on {engine}'.format(**result))
+    print('  load   {rows:>10} rows {seconds:8.3f}s {rows_per_second:12.0f} rows/s'.format(
+        **result['load']))
+    print('  build  {:>10} {:>4} {seconds:8.3f}s {rows_per_second:12.0f} rows/s'.format(
+        '', '', **result['build']))
+    for name, seconds in result['inserts'].items():
+        print('    {:<22} {:8.3f}s'.format(name, seconds))
+    print('  {:<14} {:>10} {:>10} {:>10}'.format('query', 'p50 ms', 'p95 ms', 'qps'))
+    for name, stats in result['queries'].items():
+        print('  {:<14} {:10.2f} {:10.2f} {:10.1f}'.format(
+            name, stats['p50'] * 1000, stats['p95'] * 1000, stats['queries_per_second']))
+
+
+def main(args):
+    settings = config.settings
+    templates = read_events(args.zip_path)
+    results = []
+    for scale in args.scales:
+        backend = DuckDBBackend(':memory:') if args.engine == 'duckdb' else \
+            PostgresBackend(args.dsn)
+        results.append(run_scale(backend, settings, templates, scale, args.repeat,
+                                 seed=args.seed))
+        print_report(results[-1])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results written to {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', dest='engine', default='duckdb', choices=('duckdb', 'postgres'))
+    parser.add_argument('--dsn', dest='dsn', default=None,
+                        help='local Postgres DSN, defaults to [LOCAL] DSN')
+    parser.add_argument('--scale', dest='scales', type=float, nargs='+', default=[1, 10])
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5)
+    parser.add_argument('--seed', dest='seed', type=int, default=0)
+    parser.add_argument('--zip', dest='zip_path', default=LOG_ZIP)
+    parser.add_argument('--output', dest='output', default=None, help='write results as JSON')
+    args = parser.parse_args()
+    if args.engine == 'postgres' and not args.dsn:
+        args.dsn = config.get('LOCAL', 'DSN', fallback='dbname=sparkify')
+    main(args)
@@ -0,0 +1,49 @@
+import argparse
+import runpy
+import sys
+
+# command -> (script it runs, summary). Only the script of the command run is
+# imported, so a database command never loads boto3 or pandas.
+COMMANDS = {
+    'create-cluster':   ('create_cluster', 'create the IAM role, cluster and ingress rule'),
+    'delete-cluster':   ('delete_cluster', 'delete the cluster, IAM role and ingress rule'),
+    'lifecycle':        ('lifecycle', 'pause, resume, snapshot or restore the cluster'),
+    'sizing':           ('sizing_planner', 'recommend the node type and count for the data'),
+    'create-tables':    ('create_tables', 'drop and create, or --apply, the tables'),
+    'etl':              ('etl', 'load staging and the star schema'),
+    'load-errors':      ('load_errors', 'list the files with quarantined records'),
+    'analytics':        ('analytics', 'row counts and test queries'),
+    'time-dimension':   ('time_dimension', 'generate the time dimension'),
+    'local':            ('backends', 'build the star schema on a local Postgres or DuckDB'),
+    'local-load':       ('local_loader', 'load data/log_data.zip into a local Postgres'),
+    'parquet':          ('parquet_converter', 'convert raw JSON to typed Parquet'),
+    'bench':            ('bench', 'benchmark loads and queries on synthetic data'),
+    'key-advisor':      ('key_advisor', 'recommend distribution and sort keys'),
+    'storage-advisor':  ('storage_advisor', 'recommend column types and encodings'),
+}
+
+
+def main(argv=None):
+    """
+    Run the script of a command as if it were started on its own
+
+    Args:
+        argv: command followed by its arguments, defaults to sys.argv[1:]
+    """
+    commands = '\n'.join('  {:<17} {}'.format(c, s) for c, (_, s) in COMMANDS.items())
+    parser = argparse.ArgumentParser(
+        prog='cli.py', description='Sparkify data warehouse',
+        epilog='commands:\n{}\n\n"cli.py COMMAND --help" lists the options of a command'.format(
+            commands),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=list(COMMANDS), metavar='COMMAND')
+    parser.add_argument('args', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    module = COMMANDS[args.command][0]
+    sys.argv = ['{} {}'.format(parser.prog, args.command)] + args.args
+    runpy.run_module(module, run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,233 @@
 import configparser
+import datetime
 import os
-
-from dotenv import load_dotenv
+from dataclasses import dataclass
+from typing import Optional
 
 ROOT_PATH = os.path.dirname(__file__)
 
-load_dotenv(os.path.join(ROOT_PATH, ".env"))
-CONFIG = configparser.ConfigParser()
-CONFIG.read(os.path.join(ROOT_PATH, "dwh.cfg"))
+config_file = 'dwh.cfg'
+
+# Slices per compute node for each Redshift node type
+# https://docs.aws.amazon.com/redshift/latest/mgmt/working-with-clusters.html
+SLICES_PER_NODE = {
+    'dc2.large':    2,
+    'dc2.8xlarge':  16,
+    'ds2.xlarge':   2,
+    'ds2.8xlarge':  16,
+    'ra3.xlplus':   2,
+    'ra3.4xlarge':  4,
+    'ra3.16xlarge': 16,
+}
+
+# time dimension granularity -> seconds per time_key
+GRANULARITY_SECONDS = {
+    'second':   1,
+    'minute':   60,
+    'hour':     3600,
+}
+
+# [AWS] keys filled from the environment (or .env) when dwh.cfg leaves them empty
+ENVIRONMENT_KEYS = {
+    'AWS_ACCESS_KEY_ID':        ('AWS_ACCESS_KEY_ID', 'AWS_KEY'),
+    'AWS_SECRET_ACCESS_KEY':    ('AWS_SECRET_ACCESS_KEY', 'AWS_SECRET'),
+}
+
+
+def load_env(path=os.path.join(ROOT_PATH, '.env')):
+    """ Load .env into the environment, if python-dotenv is installed """
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        return
+    load_dotenv(path)
+
+
+def get_config(filepath=config_file):
+    """
+    Read a config file, with the [AWS] keys filled from the environment
+
+    Args:
+        filepath: path to the config file
+    Returns:
+        ConfigParser object
+    """
+    load_env()
+    parser = configparser.ConfigParser()
+    try:
+        with open(filepath) as f:
+            parser.read_file(f)
+    except Exception as e:
+        print(e)
+    if not parser.has_section('AWS'):
+        parser.add_section('AWS')
+    for key, names in ENVIRONMENT_KEYS.items():
+        value = next((os.environ[n] for n in names if os.environ.get(n)), None)
+        if value and not parser.get('AWS', key, fallback=''):
+            parser.set('AWS', key, value)
+    return parser
+
+
+class Config:
+    """
+    dwh.cfg, read on first use. Behaves as the ConfigParser it wraps, so
+    config['DB']['HOST'] and config.getint('ETL', 'MAX_PARALLEL', fallback=1)
+    work as before, and importing a module no longer reads the file.
+    """
+
+    def __init__(self, filepath=config_file):
+        self.filepath = filepath
+        self._parser = None
+        self._settings = None
+
+    @property
+    def parser(self):
+        if self._parser is None:
+            self._parser = get_config(self.filepath)
+        return self._parser
+
+    @property
+    def settings(self):
+        """ The Settings the SQL statements are built from, parsed on first use """
+        if self._settings is None:
+            self._settings = Settings.from_config(self)
+        return self._settings
+
+    def reload(self):
+        """ Forget the parsed file, it is read again on next use """
+        self._parser = None
+        self._settings = None
+
+    def __getattr__(self, name):
+        return getattr(self.parser, name)
+
+    def __getitem__(self, section):
+        return self.parser[section]
+
+    def __contains__(self, section):
+        return section in self.parser
+
+
+@dataclass(frozen=True)
+class Settings:
+    """
+    The dwh.cfg values the sql_queries statement builders depend on, parsed
+    and typed. S3 sources are kept as written, quotes included, since the
+    COPY statements use them verbatim.
+    """
+
+    arn: Optional[str] = None
+    log_data: Optional[str] = None
+    log_jsonpath: Optional[str] = None
+    song_data: Optional[str] = None
+    songs_jsonpath: Optional[str] = None
+    manifest_prefix: Optional[str] = None
+    # Parquet written by parquet_converter.py, loaded instead of the JSON when set
+    parquet_log_data: Optional[str] = None
+    parquet_song_data: Optional[str] = None
+    # bad records a JSON COPY skips, and quarantines in load_errors, before it fails
+    max_errors: int = 50
+    user_history: bool = False
+    time_granularity: str = 'hour'
+    time_start: Optional[datetime.datetime] = None
+    time_end: Optional[datetime.datetime] = None
+
+    def __post_init__(self):
+        if self.time_granularity not in GRANULARITY_SECONDS:
+            raise ValueError('[TIME] GRANULARITY must be one of {}, not {!r}'.format(
+                ', '.join(GRANULARITY_SECONDS), self.time_granularity))
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Args:
+            config: ConfigParser or Config object
+        Returns:
+            Settings object
+        """
+        def text(section, key):
+            return config.get(section, key, fallback=None) or None
+
+        def date(key):
+            value = text('TIME', key)
+            return datetime.datetime.fromisoformat(value) if value else None
+
+        return cls(arn=text('IAM_ROLE', 'ARN'),
+                   log_data=text('S3', 'LOG_DATA'),
+                   log_jsonpath=text('S3', 'LOG_JSONPATH'),
+                   song_data=text('S3', 'SONG_DATA'),
+                   songs_jsonpath=text('S3', 'SONGS_JSONPATH'),
+                   manifest_prefix=text('S3', 'MANIFEST_PREFIX'),
+                   parquet_log_data=text('S3', 'PARQUET_LOG_DATA'),
+                   parquet_song_data=text('S3', 'PARQUET_SONG_DATA'),
+                   max_errors=config.getint('ETL', 'MAX_ERRORS', fallback=50),
+                   user_history=config.getboolean('ETL', 'USER_HISTORY', fallback=False),
+                   time_granularity=config.get('TIME', 'GRANULARITY', fallback='hour'),
+                   time_start=date('START'),
+                   time_end=date('END'))
+
+    @property
+    def granularity_seconds(self):
+        return GRANULARITY_SECONDS[self.time_granularity]
+
+
+config = Config()
+# previous name of the shared config object
+CONFIG = config
+
+
+def cluster_slices(config=config):
+    """
+    Total number of slices of the cluster described in the config file
+
+    Args:
+        config: config object with DWH_NUM_NODES and DWH_NODE_TYPE in [CLUSTER]
+    Returns:
+        number of slices (at least 1)
+    """
+    num_nodes = int(config['CLUSTER'].get('DWH_NUM_NODES', 1))
+    node_type = config['CLUSTER'].get('DWH_NODE_TYPE', 'dc2.large')
+    return max(1, num_nodes * SLICES_PER_NODE.get(node_type, 2))
+
+
+def write_config(updates, config_file=config_file):
+    """
+    Write several values to the config file at once. The file is written to a
+    temporary file next to it and swapped in, so it is never left half written.
+
+    Args:
+        updates: dict of section -> dict of key -> value
+        config_file: path to the config file
+    """
+    import tempfile
+
+    parser = configparser.ConfigParser()
+    parser.read(config_file)
+    for section, values in updates.items():
+        if not parser.has_section(section):
+            parser.add_section(section)
+        for key, value in values.items():
+            parser.set(section, key, value)
 
-# CONFIG.add_section("AWS")
-CONFIG.set("AWS", "KEY", os.environ.get("AWS_KEY"))
-CONFIG.set("AWS", "SECRET", os.environ.get("AWS_SECRET"))
+    directory = os.path.dirname(os.path.abspath(config_file))
+    fd, path = tempfile.mkstemp(prefix='.dwh-', suffix='.cfg', dir=directory)
+    try:
+        with os.fdopen(fd, 'w') as f:
+            parser.write(f)
+        if os.path.exists(config_file):
+            os.chmod(path, os.stat(config_file).st_mode)
+        os.replace(path, config_file)
+    except BaseException:
+        os.unlink(path)
+        raise
+    # the shared object is read again only if it is the file just written
+    if os.path.abspath(config_file) == os.path.abspath(config.filepath):
+        config.reload()
 
 
-# Get environment variables
-USER = os.getenv('API_USER')
-PASSWORD = os.environ.get('API_PASSWORD')
\ No newline at end of file
+def __getattr__(name):
+    # API credentials, read once .env is loaded
+    if name in ('USER', 'PASSWORD'):
+        load_env()
+        return os.environ.get('API_' + name)
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
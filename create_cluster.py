@@ -2,46 +2,58 @@ import argparse
 import configparser
 import json
 import logging
-import boto3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from botocore.exceptions import ClientError
 
+from config import config, config_file, write_config
 
-#CONFIG
-config = configparser.ConfigParser()
-config_file = 'dwh.cfg'
-config.read(config_file)
 
-def get_config(filepath=config_file):
-    """
-    Get config object from config file
+S3_READ_ARN         = "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
 
-    Arg(s):
-        filepath: path to the config file
-    Return(s):
-        config object
-    """
-    config = configparser.ConfigParser()
-    try:
-        config.read_file(open(config_file))
-    except Exception as e:
-        print(e)
+# Adaptive polling: the first checks come quickly, the delay then grows by
+# POLL_FACTOR up to POLL_MAX, and drops back to POLL_MIN when the status changes
+POLL_MIN            = 2.0
+POLL_MAX            = 10.0
+POLL_FACTOR         = 1.5
+POLL_TIMEOUT        = 30 * 60
+# A new role can take a few seconds to be visible to Redshift
+ROLE_RETRIES        = 5
 
-    return config
 
+# The [CLUSTER] settings are read when used, so importing this module does
+# not need a complete config file
+def dwh_cluster_id():
+    return config['CLUSTER']['DWH_CLUSTER_IDENTIFIER']
 
 
-KEY                 = config['AWS']['AWS_ACCESS_KEY_ID']
-SECRET              = config['AWS']['AWS_SECRET_ACCESS_KEY']
-DWH_IAM_ROLE_NAME   = config['CLUSTER']['DWH_IAM_ROLE_NAME']
-DWH_CLUSTER_ID      = config['CLUSTER']['DWH_CLUSTER_IDENTIFIER']
-REGION              = config['CLUSTER']['REGION']
-DB_PORT             = config['DB']['DB_PORT']
-S3_READ_ARN         = "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
+def dwh_role_name():
+    return config['CLUSTER']['DWH_IAM_ROLE_NAME']
+
+
+def cluster_port():
+    return int(config['CLUSTER']['CLUSTER_PORT'])
 
 
-def create_resources():
-    """ Create required AWS resources """
-    options = dict(region_name=REGION, aws_access_key_id=KEY, aws_secret_access_key=SECRET)
+def create_resources(endpoint_url=None):
+    """
+    Create required AWS resources
+
+    Arg(s):
+        endpoint_url: local AWS stand-in (e.g. moto_server), defaults to [AWS] ENDPOINT_URL
+    Return(s):
+        (ec2 resource, iam client, redshift client)
+    """
+    import boto3
+
+    options = dict(region_name=config['CLUSTER']['REGION'])
+    if config.get('AWS', 'AWS_ACCESS_KEY_ID', fallback=''):
+        options.update(aws_access_key_id=config.get('AWS', 'AWS_ACCESS_KEY_ID'),
+                       aws_secret_access_key=config.get('AWS', 'AWS_SECRET_ACCESS_KEY', fallback=''))
+    endpoint_url = endpoint_url or config['AWS'].get('ENDPOINT_URL')
+    if endpoint_url:
+        options['endpoint_url'] = endpoint_url
     ec2 = boto3.resource('ec2', **options)
     iam = boto3.client('iam', **options)
     redshift = boto3.client('redshift', **options)
@@ -50,10 +62,11 @@ def create_resources():
 
 def create_iam_role(iam):
     """ Create IAM role for Redshift cluster """
+    role_name = dwh_role_name()
     try:
         dwh_role = iam.create_role(
             Path='/',
-            RoleName=DWH_IAM_ROLE_NAME,
+            RoleName=role_name,
             AssumeRolePolicyDocument=json.dumps({
                 'Statement': [{
                     'Action': 'sts:AssumeRole',
@@ -64,7 +77,7 @@ def create_iam_role(iam):
             })
         )
         iam.attach_role_policy(
-            RoleName=DWH_IAM_ROLE_NAME,
+            RoleName=role_name,
             PolicyArn=S3_READ_ARN
         )
         # print('IAM Role Created: %s.' % (config_file.get('IAM_ROLE', 'arn')))
@@ -72,32 +85,37 @@ def create_iam_role(iam):
     except ClientError as e:
         logging.warning(e)
 
-    role_arn = iam.get_role(RoleName=DWH_IAM_ROLE_NAME)['Role']['Arn']
-    logging.info('Role {} with arn {}'.format(DWH_IAM_ROLE_NAME, role_arn))
+    role_arn = iam.get_role(RoleName=role_name)['Role']['Arn']
+    logging.info('Role {} with arn {}'.format(role_name, role_arn))
     return role_arn
 
 
+def cluster_options(role_arn):
+    """ create_cluster arguments for the cluster described in the config file """
+    return dict(
+        ClusterType=config['CLUSTER']['DWH_CLUSTER_TYPE'],
+        NodeType=config['CLUSTER']['DWH_NODE_TYPE'],
+        NumberOfNodes=int(config['CLUSTER']['DWH_NUM_NODES']),
+        DBName=config['DB']['DB_NAME'],
+        ClusterIdentifier=dwh_cluster_id(),
+        MasterUsername=config['DB']['DB_USER'],
+        MasterUserPassword=config['DB']['DB_PASSWORD'],
+        IamRoles=[role_arn],
+    )
+
+
 def create_redshift_cluster(redshift, role_arn):
     """ Create Redshift cluster """
+    cluster_id = dwh_cluster_id()
     try:
-        response = redshift.create_cluster(
-            ClusterType=config['CLUSTER']['DWH_CLUSTER_TYPE'],
-            NodeType=config['CLUSTER']['DWH_NODE_TYPE'],
-            NumberOfNodes=int(config['CLUSTER']['DWH_NUM_NODES']),
-            DBName=config['DB']['DB_NAME'],
-            ClusterIdentifier=DWH_CLUSTER_ID,
-            MasterUsername=config['DB']['DB_USER'],
-            MasterUserPassword=config['DB']['DB_PASSWORD'],
-            IamRoles=[role_arn],
-           # VpcSecurityGroupIds=[cluster_sg_id]
-        )
-        logging.info('Creating cluster {}...'.format(DWH_CLUSTER_ID))
+        response = redshift.create_cluster(**cluster_options(role_arn))
+        logging.info('Creating cluster {}...'.format(cluster_id))
         
         # Wait for up to 30 minutes until the cluster is created successfully
         redshift.get_waiter('cluster_available').wait(
-            ClusterIdentifier=DWH_CLUSTER_ID,
+            ClusterIdentifier=cluster_id,
             WaiterConfig={'Delay': 30, 'MaxAttempts': 60})
-        logging.info('Wait for cluster to become available {}...'.format(DWH_CLUSTER_ID))
+        logging.info('Wait for cluster to become available {}...'.format(cluster_id))
 
         return response['Cluster']
     except ClientError as e:
@@ -106,10 +124,11 @@ def create_redshift_cluster(redshift, role_arn):
 
 def delete_iam_role(iam):
     """ Delete IAM role """
-    role_arn = iam.get_role(RoleName=DWH_IAM_ROLE_NAME)['Role']['Arn']
-    iam.detach_role_policy(RoleName=DWH_IAM_ROLE_NAME, PolicyArn=S3_READ_ARN)
-    iam.delete_role(RoleName=DWH_IAM_ROLE_NAME)
-    logging.info('Deleted role {} with {}'.format(DWH_IAM_ROLE_NAME, role_arn))
+    role_name = dwh_role_name()
+    role_arn = iam.get_role(RoleName=role_name)['Role']['Arn']
+    iam.detach_role_policy(RoleName=role_name, PolicyArn=S3_READ_ARN)
+    iam.delete_role(RoleName=role_name)
+    logging.info('Deleted role {} with {}'.format(role_name, role_arn))
 
 
 def delete_redshift_cluster(redshift):
@@ -123,20 +142,21 @@ def delete_redshift_cluster(redshift):
         redshift.get_waiter('cluster_deleted').wait(ClusterIdentifier=config['CLUSTER']['DWH_CLUSTER_IDENTIFIER'],
                                                     WaiterConfig={'Delay': 30, 'MaxAttempts': 60})
 
-        logging.info('Deleted cluster {}'.format(DWH_CLUSTER_ID))
+        logging.info('Deleted cluster {}'.format(config['CLUSTER']['DWH_CLUSTER_IDENTIFIER']))
     except Exception as e:
         logging.error(e)
 
-def revoke_ingress_rules(ec2):
+def revoke_ingress_rules(ec2, vpc_id=None):
+    """ Revoke the rule open_ingress added, in the same security group """
     try:
         # revoke ingress rules
-        sg = list(ec2.security_groups.all())[0]
+        sg = cluster_security_group(ec2, vpc_id)
         print('Revoking Ingress rules for SecurityGroup {}'.format(sg))
         sg.revoke_ingress(GroupName=sg.group_name,
                             CidrIp='0.0.0.0/0',
                             IpProtocol='tcp',
-                            FromPort=int(config['CLUSTER']['CLUSTER_PORT']),
-                            ToPort=int(config['CLUSTER']['CLUSTER_PORT']))
+                            FromPort=cluster_port(),
+                            ToPort=cluster_port())
     except Exception as e:
         print(e)
 
@@ -192,10 +212,8 @@ def create_ec2_sg(ec2, config, cluster_props):
         sg: a default security group
     """
     try:
-        vpc = ec2.Vpc(id=cluster_props['VpcId'])
-        logging.info('ec2.Vpc {}'.format(cluster_props['VpcId']))
-        print(vpc)
-        defaultSg = list(vpc.security_groups.all())[0]
+        defaultSg = cluster_security_group(ec2, cluster_props.get('VpcId'))
+        logging.info('ec2.SecurityGroup {}'.format(defaultSg.id))
         #print(defaultSg)
         # logging.info('Allow TCP connections from {}'.format(defaultSg))
         # logging.info('Allow TCP connections group name {}'.format(defaultSg.group_name))
@@ -236,21 +254,173 @@ def update_config_file(config_file, section, key, value):
         print(f'ERROR: {e}')
 
 
+def poll(check, timeout=POLL_TIMEOUT, initial=POLL_MIN, maximum=POLL_MAX, factor=POLL_FACTOR):
+    """
+    Call check until it reports done, sleeping with adaptive backoff
+
+    Arg(s):
+        check: function returning (done, status, result)
+        timeout: seconds before giving up
+        initial, maximum, factor: first delay, largest delay and growth per check.
+            The delay starts over from initial whenever the status changes.
+    Return(s):
+        result of the last check
+    """
+    deadline = time.monotonic() + timeout
+    delay, last = initial, None
+    while True:
+        done, status, result = check()
+        if done:
+            return result
+        if status != last:
+            logging.info('Status {}'.format(status))
+            delay, last = initial, status
+        else:
+            delay = min(delay * factor, maximum)
+        if time.monotonic() + delay > deadline:
+            raise TimeoutError('Still {} after {} seconds'.format(status, timeout))
+        time.sleep(delay)
+
+
+def wait_for_cluster(redshift, cluster_id=None, **kwargs):
+    """
+    Wait until the cluster is available and has an endpoint
+
+    Arg(s):
+        cluster_id: defaults to [CLUSTER] DWH_CLUSTER_IDENTIFIER
+    Return(s):
+        cluster description
+    """
+    cluster_id = cluster_id or dwh_cluster_id()
+
+    def check():
+        cluster = redshift.describe_clusters(ClusterIdentifier=cluster_id)['Clusters'][0]
+        status = cluster['ClusterStatus']
+        return status == 'available' and bool(cluster.get('Endpoint')), status, cluster
+    return poll(check, **kwargs)
+
+
+def start_redshift_cluster(redshift, role_future):
+    """
+    Start creating the cluster as soon as the role exists, without waiting for it
+
+    Arg(s):
+        redshift: Redshift client
+        role_future: future of the IAM role arn
+    Return(s):
+        cluster description, as returned by create_cluster or describe_clusters
+    """
+    role_arn = role_future.result()
+    for attempt in range(ROLE_RETRIES):
+        try:
+            cluster = redshift.create_cluster(**cluster_options(role_arn))['Cluster']
+            logging.info('Creating cluster {}...'.format(dwh_cluster_id()))
+            return cluster
+        except ClientError as e:
+            code = e.response['Error']['Code']
+            if code == 'ClusterAlreadyExists':
+                logging.warning(e)
+                return redshift.describe_clusters(
+                    ClusterIdentifier=dwh_cluster_id())['Clusters'][0]
+            # the role is not visible to Redshift yet
+            if code != 'InvalidParameterValue' or attempt == ROLE_RETRIES - 1:
+                raise
+            logging.warning('{}, retrying'.format(e))
+            time.sleep(POLL_MIN * POLL_FACTOR ** attempt)
+
+
+def default_vpc(ec2):
+    """ The default VPC, where a cluster created without a subnet group runs """
+    vpcs = list(ec2.vpcs.filter(Filters=[{'Name': 'isDefault', 'Values': ['true']}]))
+    return vpcs[0] if vpcs else list(ec2.vpcs.all())[0]
+
+
+def cluster_security_group(ec2, vpc_id=None):
+    """
+    Security group a cluster created without one gets: the default group of
+    its VPC. open_ingress and revoke_ingress_rules both go through it.
+
+    Arg(s):
+        ec2: an EC2 resource
+        vpc_id: VPC of the cluster, defaults to the default VPC
+    """
+    vpc = ec2.Vpc(id=vpc_id) if vpc_id else default_vpc(ec2)
+    groups = list(vpc.security_groups.filter(GroupNames=['default'])) or \
+        list(vpc.security_groups.all())
+    return groups[0]
+
+
+def open_ingress(ec2, vpc_id=None):
+    """
+    Allow TCP connections to the cluster port in the default security group
+
+    Arg(s):
+        ec2: an EC2 resource
+        vpc_id: VPC of the cluster, defaults to the default VPC
+    Return(s):
+        the security group
+    """
+    sg = cluster_security_group(ec2, vpc_id)
+    port = cluster_port()
+    try:
+        sg.authorize_ingress(GroupName=sg.group_name, CidrIp='0.0.0.0/0', IpProtocol='tcp',
+                             FromPort=port, ToPort=port)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'InvalidPermission.Duplicate':
+            raise
+        logging.info('Ingress on port {} already open in {}'.format(port, sg.id))
+    return sg
+
+
+def provision(ec2, iam, redshift, **poll_options):
+    """
+    Create the IAM role, the ingress rule and the cluster concurrently. The
+    cluster is started as soon as the role exists and the ingress rule is
+    opened while it is being created.
+
+    Arg(s):
+        ec2, iam, redshift: from create_resources
+        poll_options: passed to poll
+    Return(s):
+        (cluster description, role arn, security group)
+    """
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        role = pool.submit(create_iam_role, iam)
+        ingress = pool.submit(open_ingress, ec2)
+        start_redshift_cluster(redshift, role)
+        cluster = wait_for_cluster(redshift, **poll_options)
+        return cluster, role.result(), ingress.result()
+
+
 def main(args):
     """ Main function """
-    ec2, iam, redshift = create_resources()
+    ec2, iam, redshift = create_resources(args.endpoint_url)
+    start = time.monotonic()
     if args.delete:
-        delete_redshift_cluster(redshift)
-        delete_iam_role(iam)
+        if args.snapshot:
+            import lifecycle
+            lifecycle.snapshot_and_delete(redshift, args.config_file)
+        else:
+            delete_redshift_cluster(redshift)
+        # before the role, so a failed role deletion never leaves the port open
         revoke_ingress_rules(ec2)
+        delete_iam_role(iam)
         print('Clean up completed. All resources deleted.')
+    elif not args.sequential:
+        cluster, role_arn, sg = provision(ec2, iam, redshift)
+        print("SecurityGroup {} open on port {}".format(sg.id, config['CLUSTER']['CLUSTER_PORT']))
+        print(f"Endpoint={cluster['Endpoint']['Address']}")
+        write_config({'DB': {'HOST': cluster['Endpoint']['Address']},
+                      'IAM_ROLE': {'ARN': role_arn}}, args.config_file)
+        print('CFG file Updated.')
+        print('Cluster ready in {:.0f} seconds.'.format(time.monotonic() - start))
     else:
         role_arn = create_iam_role(iam)
         print(role_arn)
         ##cluster_sg_id = create_cluster_security_group(ec2)
         cluster_props = create_redshift_cluster(redshift, role_arn)#, cluster_sg_id )
         logging.info('cluster created {}'.format(cluster_props))
-        cluster = redshift.describe_clusters(ClusterIdentifier=DWH_CLUSTER_ID)['Clusters'][0]
+        cluster = redshift.describe_clusters(ClusterIdentifier=dwh_cluster_id())['Clusters'][0]
         print(cluster)
        # print('username', config_file['DB']['db_user'])
        # print('password', config_file['DB']['db_password'])
@@ -271,13 +441,14 @@ def main(args):
         
         
 
-        role_arn = iam.get_role(RoleName=DWH_IAM_ROLE_NAME)['Role']['Arn']
-        logging.info('Role {} with arn {}'.format(DWH_IAM_ROLE_NAME, role_arn))
+        role_arn = iam.get_role(RoleName=dwh_role_name())['Role']['Arn']
+        logging.info('Role {} with arn {}'.format(dwh_role_name(), role_arn))
         
-        update_config_file(config_file, 'DB', 'HOST', cluster['Endpoint']['Address'])
-        update_config_file(config_file, 'IAM_ROLE', 'ARN', role_arn)
+        update_config_file(args.config_file, 'DB', 'HOST', cluster['Endpoint']['Address'])
+        update_config_file(args.config_file, 'IAM_ROLE', 'ARN', role_arn)
         #update_config_file(config_file, 'SECURITY', 'SG_NAME', cluster_sg_id)
         print('CFG file Updated.')
+        print('Cluster ready in {:.0f} seconds.'.format(time.monotonic() - start))
         # else:
         #     logging.error('Could not connect to cluster')
         
@@ -289,5 +460,13 @@ if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
     parser = argparse.ArgumentParser()
     parser.add_argument('--delete', dest='delete', default=False, action='store_true')
+    parser.add_argument('--snapshot', dest='snapshot', default=False, action='store_true',
+                        help='with --delete, take a final snapshot that lifecycle.py restore brings back')
+    parser.add_argument('--sequential', dest='sequential', default=False, action='store_true',
+                        help='create the role, cluster and ingress rule one after the other')
+    parser.add_argument('--endpoint-url', dest='endpoint_url', default=None,
+                        help='local AWS stand-in such as moto_server, defaults to [AWS] ENDPOINT_URL')
+    parser.add_argument('--config', dest='config_file', default=config_file,
+                        help='config file the endpoint and role arn are written to')
     args = parser.parse_args()
     main(args)
\ No newline at end of file
@@ -1,25 +1,53 @@
+import argparse
 import logging
-from sql_queries import create_connection, create_table_queries, drop_table_queries
+from backends import add_backend_argument, get_backend
+from config import config
+from instrument import add_metrics_arguments, write_metrics
+from result_cache import bump_load_versions, cache_dir
+from schema import apply_schema, changed_tables, table_name
+from sql_queries import create_table_queries, drop_table_queries
+
+# Statements are not committed one by one: main commits the whole rebuild
+# once, so a failure leaves the previous schema in place.
 
 # drop staging tables?
-def drop_tables(cur, conn):
-    for query in drop_table_queries:
+def drop_tables(cur, conn, drops=()):
+    for query in drop_table_queries + list(drops):
         cur.execute(query)
-        conn.commit()
 
 
-def create_tables(cur, conn):
-    for query in create_table_queries:
+def create_tables(cur, conn, settings, ddl=lambda query: [query]):
+    for query in create_table_queries(settings):
         logging.info('Create table {}'.format(query))
-        cur.execute(query)
-        conn.commit()
+        for statement in ddl(query):
+            cur.execute(statement)
 
-def main():
-    cur, conn = create_connection()
-    print('Connected to Redshift Cluster...')
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
-    conn.close()
+def main(args):
+    settings = config.settings
+    backend = get_backend(args.backend)
+    with backend.session() as (cur, conn):
+        print('Connected to {}...'.format(backend.name))
+        if args.apply:
+            changed = changed_tables(apply_schema(
+                cur, conn, [backend.ddl(q)[-1] for q in create_table_queries(settings)],
+                drop_table_queries))
+        else:
+            drop_tables(cur, conn, backend.drops(create_table_queries(settings)))
+            create_tables(cur, conn, settings, backend.ddl)
+            conn.commit()
+            changed = [table_name(q) for q in create_table_queries(settings)]
+        write_metrics(args, cur)
+    # no cached result of a recreated or altered table holds
+    if changed:
+        bump_load_versions(changed, cache_dir(config, backend.scope))
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--apply', dest='apply', default=False, action='store_true',
+                        help='only apply the changes between sql_queries and the live schema')
+    add_backend_argument(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    if args.apply and args.backend == 'duckdb':
+        parser.error('--apply needs the IDENTITY columns of Redshift or Postgres')
+    main(args)
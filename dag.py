@@ -0,0 +1,107 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+def topological_order(deps):
+    """
+    Order the nodes of a dependency graph so every node follows its deps
+
+    Args:
+        deps: dict of node -> iterable of nodes it depends on
+    Returns:
+        list of nodes
+    """
+    order, done, visiting = [], set(), set()
+
+    def visit(node):
+        if node in done:
+            return
+        if node in visiting:
+            raise ValueError('Dependency cycle through {}'.format(node))
+        visiting.add(node)
+        for dep in deps[node]:
+            if dep not in deps:
+                raise ValueError('{} depends on unknown node {}'.format(node, dep))
+            visit(dep)
+        visiting.discard(node)
+        done.add(node)
+        order.append(node)
+
+    for node in deps:
+        visit(node)
+    return order
+
+
+def run_dag(tasks, deps, max_parallel=1):
+    """
+    Run callables as soon as their dependencies have finished, with at most
+    max_parallel running at once. A failure stops new tasks from starting
+    and is re-raised once the running ones have finished.
+
+    Args:
+        tasks: dict of node -> callable taking no arguments
+        deps: dict of node -> iterable of nodes it depends on
+        max_parallel: number of worker threads
+    Returns:
+        dict of node -> seconds the task took
+    """
+    topological_order(deps)
+    pending = {node: set(deps[node]) for node in tasks}
+    durations, running = {}, {}
+
+    def timed(node):
+        start = time.perf_counter()
+        tasks[node]()
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as pool:
+        error = None
+        while pending or running:
+            if error is None:
+                for node in [n for n, waiting in pending.items() if not waiting]:
+                    del pending[node]
+                    running[pool.submit(timed, node)] = node
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                node = running.pop(future)
+                try:
+                    durations[node] = future.result()
+                except Exception as e:
+                    logging.error('{} failed: {}'.format(node, e))
+                    error = error or e
+                    continue
+                logging.info('{} finished in {:.2f}s'.format(node, durations[node]))
+                for waiting in pending.values():
+                    waiting.discard(node)
+        if error is not None:
+            raise error
+    return durations
+
+
+def critical_path(durations, deps):
+    """
+    Longest chain of dependent nodes, the lower bound on wall time however
+    many workers run the graph
+
+    Args:
+        durations: dict of node -> seconds
+        deps: dict of node -> iterable of nodes it depends on
+    Returns:
+        (list of nodes on the path, total seconds)
+    """
+    finish, previous = {}, {}
+    for node in topological_order(deps):
+        before = max(deps[node], key=lambda dep: finish[dep], default=None)
+        finish[node] = durations.get(node, 0.0) + (finish[before] if before else 0.0)
+        previous[node] = before
+    if not finish:
+        return [], 0.0
+    node = max(finish, key=finish.get)
+    total, path = finish[node], []
+    while node is not None:
+        path.append(node)
+        node = previous[node]
+    return path[::-1], total
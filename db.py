@@ -0,0 +1,177 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+from config import config
+from instrument import InstrumentedConnection
+
+
+def connection_params(config=config):
+    """
+    Connection keyword arguments for the cluster in the config file
+
+    Arg(s):
+        config: config object with a [DB] section
+    Return(s):
+        dict of psycopg2.connect keyword arguments
+    """
+    return dict(host=config.get('DB', 'HOST'),
+                dbname=config.get('DB', 'DB_NAME'),
+                user=config.get('DB', 'DB_USER'),
+                password=config.get('DB', 'DB_PASSWORD'),
+                port=config.getint('DB', 'DB_PORT'),
+                connect_timeout=config.getint('DB', 'CONNECT_TIMEOUT', fallback=10),
+                # keep idle pooled connections from being dropped by NAT/firewalls
+                keepalives=1,
+                keepalives_idle=30,
+                keepalives_interval=10,
+                keepalives_count=3,
+                connection_factory=InstrumentedConnection)
+
+
+def connect(params=None, retries=3, backoff=1.0):
+    """
+    Open a connection, retrying with exponential backoff
+
+    Arg(s):
+        params: psycopg2.connect keyword arguments, defaults to the [DB] section
+        retries: attempts after the first failure
+        backoff: seconds to wait before the first retry, doubled every retry
+    Return(s):
+        psycopg2 connection
+    """
+    params = params or connection_params()
+    for attempt in range(retries + 1):
+        try:
+            return psycopg2.connect(**params)
+        except psycopg2.OperationalError as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            logging.warning('Connection failed ({}), retrying in {:.1f}s'.format(e, delay))
+            time.sleep(delay)
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of reusable connections. Checkouts block while all
+    connections are in use, idle connections are health-checked before they
+    are handed out and broken ones are replaced.
+    """
+
+    def __init__(self, size=4, params=None, retries=3, backoff=1.0):
+        self.size = size
+        self.params = params or connection_params()
+        self.retries = retries
+        self.backoff = backoff
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _healthy(self, conn):
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extensions.cursor) as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        """ Check out a healthy connection, opening a new one if needed """
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    return connect(self.params, self.retries, self.backoff)
+                if self._healthy(conn):
+                    return conn
+                logging.info('Discarding broken pooled connection')
+                self._close(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn, discard=False):
+        """ Return a connection to the pool, or close it if discard is set """
+        if discard or conn.closed:
+            self._close(conn)
+        else:
+            with self._lock:
+                self._idle.append(conn)
+        self._slots.release()
+
+    @contextmanager
+    def session(self):
+        """
+        Check out a connection for the duration of a with block
+
+        Yields:
+            (cursor, connection); committed on success, rolled back on error
+        """
+        conn = self.getconn()
+        discard = False
+        try:
+            cur = conn.cursor()
+            yield cur, conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def closeall(self):
+        """ Close every idle connection """
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(min_size=1):
+    """
+    Shared pool for the cluster in dwh.cfg, sized by [DB] POOL_SIZE
+
+    Arg(s):
+        min_size: grow the pool to at least this many connections
+    Return(s):
+        ConnectionPool
+    """
+    global _pool
+    with _pool_lock:
+        size = max(min_size, config.getint('DB', 'POOL_SIZE', fallback=4))
+        if _pool is None or _pool.size < size:
+            if _pool is not None:
+                _pool.closeall()
+            _pool = ConnectionPool(size=size,
+                                   retries=config.getint('DB', 'CONNECT_RETRIES', fallback=3),
+                                   backoff=config.getfloat('DB', 'CONNECT_BACKOFF', fallback=1.0))
+        return _pool
+
+
+def session():
+    """ Context-managed (cursor, connection) from the shared pool """
+    return get_pool().session()
@@ -1,8 +1,10 @@
+import argparse
 import logging
-from create_cluster import get_config, create_resources
+from config import get_config
+from create_cluster import cluster_security_group, create_resources
 
 
-def main():
+def main(args):
 
     # parse config file
     config = get_config()
@@ -14,32 +16,41 @@ def main():
     # Create resources & clients
     ec2, iam, redshift = create_resources()
     try:
-        # delete cluster
-        logging.info('Deleting Redshift cluster {}. This might take a few minutes ...'.format(id))
-        response = redshift.delete_cluster( ClusterIdentifier=id,  
-                                            SkipFinalClusterSnapshot=True)
-        # Wait for up to 30 minutes until the cluster is deleted successfully
-        redshift.get_waiter('cluster_deleted').wait(ClusterIdentifier=id,
-                                                    WaiterConfig={'Delay': 30, 'MaxAttempts': 60})
+        if args.snapshot:
+            # keep the loaded tables in a final snapshot, see lifecycle.py restore
+            import lifecycle
+            lifecycle.snapshot_and_delete(redshift)
+        else:
+            # delete cluster
+            logging.info('Deleting Redshift cluster {}. This might take a few minutes ...'.format(id))
+            response = redshift.delete_cluster( ClusterIdentifier=id,  
+                                                SkipFinalClusterSnapshot=True)
+            # Wait for up to 30 minutes until the cluster is deleted successfully
+            redshift.get_waiter('cluster_deleted').wait(ClusterIdentifier=id,
+                                                        WaiterConfig={'Delay': 30, 'MaxAttempts': 60})
 
-        # Delete IAM role and attached policy
-        logging.info('Deleting IAM Role {}'.format(role))
-        iam.detach_role_policy(RoleName=role,
-                               PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess")
-        iam.delete_role(RoleName=role)
-
-        # revoke ingress rules
-        sg = list(ec2.security_groups.all())[0]
+        # revoke ingress rules, in the group create_cluster.open_ingress opened
+        sg = cluster_security_group(ec2)
         logging.info('Revoking Ingress rules for SecurityGroup {}'.format(sg))
         sg.revoke_ingress(GroupName=sg.group_name,
                           CidrIp='0.0.0.0/0',
                           IpProtocol='tcp',
                           FromPort=int(port),
                           ToPort=int(port))
+
+        # Delete IAM role and attached policy
+        logging.info('Deleting IAM Role {}'.format(role))
+        iam.detach_role_policy(RoleName=role,
+                               PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess")
+        iam.delete_role(RoleName=role)
     except Exception as e:
         print(e)
 
     print('Clean up complete. All resources deleted.')
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--snapshot', dest='snapshot', default=False, action='store_true',
+                        help='take a final snapshot that lifecycle.py restore can bring back')
+    args = parser.parse_args()
+    main(args)
\ No newline at end of file
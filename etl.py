@@ -1,38 +1,441 @@
+import argparse
 import configparser
+import datetime
 import psycopg2
 import logging
-from sql_queries import create_connection, copy_table_queries, insert_table_queries
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from backends import add_backend_argument, get_backend
+from config import cluster_slices, config
+from db import get_pool, session
+from sql_queries import copy_table_queries, insert_table_queries, \
+    staging_sources, truncate_staging_queries, merge_table_queries, \
+    staging_events_max_ts, insert_table_graph, keyed_insert_queries, truncate_load_queries, \
+    reload_table_queries
+from dag import run_dag, critical_path
+from instrument import add_metrics_arguments, write_metrics
+from load_errors import capture_load_errors, ensure_load_errors_table, pending_files, \
+    quarantine_failed_copy, reload_manifest, resolve_files
+from result_cache import bump_load_versions, cache_dir
+from sampling import refresh_samples
+from staging import list_modified, list_objects, s3_client, shard_manifests, parse_s3_url
+from time_dimension import extend_time_dimension
+from watermarks import ensure_watermark_table, get_watermark, get_timestamp_watermark, \
+    set_watermark, EPOCH
 
+# Song files are not named in arrival order, so staging_songs is tracked by
+# the newest LastModified staged, under its own watermark source, rather than
+# by the last key. Files modified up to MODIFIED_MARGIN before it are staged
+# again with any newer ones, in case S3 listed them late; the songs and
+# artists merges are idempotent.
+MODIFIED_WATERMARKS = {'staging_songs': 'staging_songs.modified'}
+MODIFIED_MARGIN = datetime.timedelta(minutes=15)
 
-def load_staging_tables(cur, conn):
-    for query in copy_table_queries:
-        print('\n'.join(('', 'Running:', query)))
+
+def copy_shard(table, query, objects):
+    """
+    Run one shard COPY on its own pooled connection and quarantine the records
+    it rejected. A shard that fails on more than MAXERROR bad records
+    quarantines them and its other files instead of failing the load; any
+    other error fails it.
+
+    Args:
+        table: staging table the shard is loaded into
+        query: COPY statement of the shard
+        objects: list of (s3 url, size) tuples in the shard's manifest
+    Returns:
+        (query, records or records and files quarantined, error message or None)
+    """
+    with session() as (cur, conn):
+        try:
+            cur.execute(query)
+        except psycopg2.Error as e:
+            conn.rollback()
+            error = str(e).strip()
+            quarantined = quarantine_failed_copy(cur, table, objects, error)
+            if not quarantined:
+                raise
+            return query, quarantined, error
+        return query, capture_load_errors(cur, table), None
+
+
+def watermark_source(table):
+    """ Name the watermark of a staging table is recorded under """
+    return MODIFIED_WATERMARKS.get(table, table)
+
+
+def list_sources(settings, watermarks=None):
+    """
+    List the files of each staging source that are not staged yet
+
+    Args:
+        settings: config.Settings
+        watermarks: dict of watermark source -> recorded value, None lists every file
+    Returns:
+        (dict of staging table -> sorted list of (s3 url, size),
+         dict of watermark source -> value to record once they are staged)
+    """
+    watermarks = watermarks or {}
+    s3 = s3_client(config)
+    objects, staged = {}, {}
+    for table, (source, _) in staging_sources(settings).items():
+        name = watermark_source(table)
+        last = watermarks.get(name)
+        if table in MODIFIED_WATERMARKS:
+            last = datetime.datetime.fromisoformat(last) if last else None
+            listed = list_modified(s3, source, last - MODIFIED_MARGIN if last else None)
+            # files within the margin alone are not new
+            if last and not any(modified > last for _, _, modified in listed):
+                listed = []
+            objects[table] = [(url, size) for url, size, _ in listed]
+            newest = max((modified for _, _, modified in listed), default=last)
+            staged[name] = newest.isoformat() if newest else None
+        else:
+            objects[table] = list_objects(s3, source,
+                                          start_after=parse_s3_url(last)[1] if last else None)
+            staged[name] = objects[table][-1][0] if objects[table] else last
+        print('{}: {} files to stage'.format(table, len(objects[table])))
+    return objects, staged
+
+
+def stage_manifests(settings, objects, max_parallel):
+    """
+    Split the listed files of each staging source into prefix shards and
+    write a manifest per shard
+
+    Args:
+        settings: config.Settings
+        objects: dict of staging table -> sorted list of (s3 url, size), see list_sources
+        max_parallel: maximum number of shards per source
+    Returns:
+        dict of staging table -> list of (manifest url, objects)
+    """
+    s3 = s3_client(config)
+    slices = cluster_slices(config)
+    manifests = {}
+    for table, table_objects in objects.items():
+        manifests[table] = shard_manifests(s3, table, table_objects, settings.manifest_prefix,
+                                           slices, max(1, max_parallel))
+        print('{}: {} shards for {} slices'.format(table, len(manifests[table]), slices))
+    return manifests
+
+
+def copy_manifests(settings, manifests, max_parallel):
+    """
+    Run the shard COPYs concurrently, one connection per worker
+
+    Args:
+        settings: config.Settings
+        manifests: dict of staging table -> list of (manifest url, objects)
+        max_parallel: number of concurrent COPYs
+    """
+    sources = staging_sources(settings)
+    shards = [(table, sources[table][1].format(manifest=url), objects)
+              for table, table_shards in manifests.items() for url, objects in table_shards]
+    rejected, failed = 0, 0
+    with ThreadPoolExecutor(max_workers=max(1, max_parallel)) as pool:
+        futures = [pool.submit(copy_shard, *shard) for shard in shards]
+        for future in as_completed(futures):
+            query, quarantined, error = future.result()
+            if error:
+                failed += 1
+                print('{} FAILED, {} records and files quarantined: {}'.format(
+                    query, quarantined, error))
+            else:
+                rejected += quarantined
+                print('{} processed OK.'.format(query))
+    print('All shards COPIED to staging tables.')
+    report_quarantine(rejected, failed)
+
+
+def report_quarantine(rejected, failed=0):
+    """ Print what the staging COPYs left in load_errors """
+    if rejected or failed:
+        print('{} rejected records and {} failed shards quarantined in load_errors; '
+              'fix the files and run etl.py --reload.'.format(rejected, failed))
+
+
+def key_staging_tables(cur, conn):
+    """
+    Move the rows just copied into the load tables into the staging tables,
+    with their match key, then empty the load tables
+    """
+    for query in keyed_insert_queries:
+        print('\n'.join(('', 'Keying:', query)))
+        cur.execute(query)
+    conn.commit()
+    # TRUNCATE commits on Redshift, so it runs once the keyed rows are in
+    for query in truncate_load_queries:
+        cur.execute(query)
+    conn.commit()
+    print('Staging tables keyed on match_key.')
+
+
+def load_staging_tables(cur, conn, settings, max_parallel=1):
+    """
+    Stage every source file. With [S3] MANIFEST_PREFIX the sources are listed
+    and copied through manifests, max_parallel shards at a time, and the
+    listing gives the watermarks the next incremental load starts from.
+
+    Returns:
+        dict of watermark source -> value, None without MANIFEST_PREFIX
+    """
+    ensure_load_errors_table(cur)
+    # rows a failed run left in the load tables would be keyed twice
+    for query in truncate_load_queries:
         cur.execute(query)
+    conn.commit()
+    if settings.manifest_prefix:
+        objects, watermarks = list_sources(settings)
+        copy_manifests(settings, stage_manifests(settings, objects, max_parallel), max_parallel)
+        key_staging_tables(cur, conn)
+        return watermarks
+
+    # copy_table_queries are in staging_sources order. A COPY over MAXERROR
+    # still fails the load, once its rejected records are quarantined:
+    # without a manifest the files rolled back with them are not known.
+    rejected = 0
+    for table, query in zip(staging_sources(settings), copy_table_queries(settings)):
+        print('\n'.join(('', 'Running:', query)))
+        try:
+            cur.execute(query)
+        except psycopg2.Error:
+            conn.rollback()
+            capture_load_errors(cur, table)
+            conn.commit()
+            raise
+        rejected += capture_load_errors(cur, table)
         conn.commit()
         print('{} processed OK.'.format(query))
     print('All files COPIED to staging tables.')
+    report_quarantine(rejected)
+    key_staging_tables(cur, conn)
+
+
+def run_insert(name, queries):
+    """ Run the statement(s) loading one table in a transaction on its own pooled connection """
+    queries = (queries,) if isinstance(queries, str) else queries
+    with session() as (cur, conn):
+        for query in queries:
+            print('\n'.join(('', 'Inserting into STAR SCHEMA {}:'.format(name), query)))
+            cur.execute(query)
+    print('{} processed OK.'.format(name))
+
 
+def insert_tables_parallel(settings, max_parallel):
+    """
+    Run the star schema inserts as a dependency graph, independent inserts
+    concurrently on separate connections
 
-def insert_tables(cur, conn):
-    for query in insert_table_queries:
+    Args:
+        settings: config.Settings
+        max_parallel: number of inserts running at once
+    Returns:
+        dict of table -> seconds its insert took
+    """
+    graph = insert_table_graph(settings)
+    tasks = {name: partial(run_insert, name, query) for name, (query, _) in graph.items()}
+    deps = {name: deps for name, (_, deps) in graph.items()}
+
+    start = time.perf_counter()
+    durations = run_dag(tasks, deps, max_parallel)
+    elapsed = time.perf_counter() - start
+    path, path_seconds = critical_path(durations, deps)
+    print('Transform took {:.2f}s wall, {:.2f}s summed over all inserts.'.format(
+        elapsed, sum(durations.values())))
+    print('Critical path {} took {:.2f}s.'.format(' -> '.join(path), path_seconds))
+    return durations
+
+
+def insert_tables(cur, conn, settings, max_parallel=1):
+    extend_time_dimension(cur, settings, conn)
+    if max_parallel > 1:
+        return insert_tables_parallel(settings, max_parallel)
+
+    for query in insert_table_queries(settings):
         print('\n'.join(('', 'Inserting into STAR SCHEMA:', query)))
         cur.execute(query)
         conn.commit()
         print('{} processed OK.'.format(query))
     print('All files INSERTED into staging tables.')
 
-def main():
+
+def load_incremental(cur, conn, settings, max_parallel=1):
+    """
+    Stage only the S3 files added since the last run and merge them into the
+    star schema. log_data files are named by date, so their keys sort in
+    arrival order and the listing starts after the last key staged; song
+    files are picked by LastModified, see MODIFIED_WATERMARKS.
+
+    Args:
+        cur: cursor to the db connection
+        conn: db connection
+        settings: config.Settings
+        max_parallel: number of concurrent shard COPYs
+    Returns:
+        True if new files were merged
+    """
+    if not settings.manifest_prefix:
+        raise ValueError('Incremental loads need [S3] MANIFEST_PREFIX')
+
+    ensure_watermark_table(cur)
+    ensure_load_errors_table(cur)
+    conn.commit()
+    watermarks = {watermark_source(table): get_watermark(cur, watermark_source(table))
+                  for table in staging_sources(settings)}
+    max_ts = get_timestamp_watermark(cur, 'songplay.ts')
+
+    for query in truncate_staging_queries:
+        cur.execute(query)
+    conn.commit()
+
+    objects, staged = list_sources(settings, watermarks)
+    if not any(objects.values()):
+        print('No new files since the last load.')
+        return False
+    copy_manifests(settings, stage_manifests(settings, objects, max_parallel), max_parallel)
+    key_staging_tables(cur, conn)
+
+    extend_time_dimension(cur, settings, conn)
+    # Merge and advance the watermarks in a single transaction, so a failed
+    # merge stages the same files again on the next run.
+    for query in merge_table_queries(settings):
+        print('\n'.join(('', 'Merging into STAR SCHEMA:', query)))
+        cur.execute(query, {'max_ts': max_ts})
+    refresh_samples(cur, params={'max_ts': max_ts})
+    record_watermarks(cur, conn, staged, max_ts)
+    print('New files MERGED into star schema.')
+    return True
+
+
+def reload_quarantined(cur, conn, settings):
+    """
+    Stage again only the files with quarantined records, once they are fixed,
+    add the events they did not load the first time to the star schema and
+    match the songplays still without a song to the reloaded songs. The
+    watermarks are left alone: the files were already counted as loaded.
+
+    Args:
+        cur: cursor to the db connection
+        conn: db connection
+        settings: config.Settings
+    Returns:
+        number of files reloaded
+    """
+    if not settings.manifest_prefix:
+        raise ValueError('Reloads need [S3] MANIFEST_PREFIX')
+
+    ensure_load_errors_table(cur)
+    conn.commit()
+    pending = pending_files(cur, s3_only=True)
+    if not pending:
+        print('No quarantined files to reload.')
+        return 0
+
+    for query in truncate_staging_queries:
+        cur.execute(query)
+    conn.commit()
+
+    # Resolve, stage and merge in a single transaction, so a failed reload
+    # leaves the files quarantined.
+    s3 = s3_client(config)
+    sources, rejected = staging_sources(settings), 0
+    for table, files in pending.items():
+        filenames = [filename for filename, _ in files]
+        manifest = reload_manifest(s3, table, filenames, settings.manifest_prefix)
+        resolve_files(cur, table, filenames)
+        print('\n'.join(('', 'Reloading {} files:'.format(len(filenames)), *filenames)))
+        cur.execute(sources[table][1].format(manifest=manifest))
+        rejected += capture_load_errors(cur, table)
+    for query in keyed_insert_queries:
+        cur.execute(query)
+    extend_time_dimension(cur, settings)
+    for query in reload_table_queries(settings):
+        print('\n'.join(('', 'Merging into STAR SCHEMA:', query)))
+        cur.execute(query)
+    refresh_samples(cur)
+    conn.commit()
+    reloaded = sum(len(files) for files in pending.values())
+    print('{} quarantined files RELOADED into star schema.'.format(reloaded))
+    report_quarantine(rejected)
+    return reloaded
+
+
+def record_watermarks(cur, conn, watermarks, max_ts=EPOCH):
+    """
+    Advance the watermarks past what is in staging now
+
+    Args:
+        cur: cursor to the db connection
+        conn: db connection
+        watermarks: dict of watermark source -> value from list_sources, or None
+        max_ts: previous songplay.ts watermark, a datetime
+    """
+    ensure_watermark_table(cur)
+    for source, value in (watermarks or {}).items():
+        if value is not None:
+            set_watermark(cur, source, value)
+    cur.execute(staging_events_max_ts)
+    new_max_ts = cur.fetchone()[0]
+    if new_max_ts is not None:
+        set_watermark(cur, 'songplay.ts', max(max_ts, new_max_ts))
+    conn.commit()
+
+
+def main(args):
     print('Initiate ETL...')
+    settings = config.settings
+    loaded_tables = list(staging_sources(settings)) + list(insert_table_graph(settings))
+    backend = get_backend(args.backend)
+    if backend.local:
+        print('Loading local data into {}...'.format(backend.name))
+        with backend.session() as (cur, conn):
+            backend.load_staging(cur, conn)
+            insert_tables(cur, conn, settings)
+            refresh_samples(cur, ddl=backend.ddl)
+            conn.commit()
+            write_metrics(args, cur)
+        bump_load_versions(loaded_tables, cache_dir(config, backend.scope))
+        return
+
     print('Connecting to Redshift Cluster...')
-    cur, conn = create_connection()
-    
-    load_staging_tables(cur, conn)  
-    insert_tables(cur, conn)
+    # one connection for the driver plus one per concurrent shard COPY
+    with get_pool(args.max_parallel + 1).session() as (cur, conn):
+        if args.reload:
+            loaded = reload_quarantined(cur, conn, settings) > 0
+        elif args.incremental:
+            loaded = load_incremental(cur, conn, settings, max_parallel=args.max_parallel)
+        else:
+            watermarks = load_staging_tables(cur, conn, settings, max_parallel=args.max_parallel)
+            insert_tables(cur, conn, settings, max_parallel=args.max_parallel)
+            refresh_samples(cur)
+            record_watermarks(cur, conn, watermarks)
+            loaded = True
+        write_metrics(args, cur)
 
-    print('Staging tables created and hydrated.')
+    if loaded:
+        # invalidate cached analytics results that read the reloaded tables
+        bump_load_versions(loaded_tables, cache_dir(config, backend.scope))
 
-    conn.close()
+    print('Staging tables created and hydrated.')
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max-parallel', dest='max_parallel', type=int,
+                        default=config.getint('ETL', 'MAX_PARALLEL', fallback=1),
+                        help='number of concurrent shard COPYs (needs [S3] MANIFEST_PREFIX) '
+                             'and concurrent star schema inserts')
+    parser.add_argument('--incremental', dest='incremental', default=False, action='store_true',
+                        help='only stage and merge files added since the last run')
+    parser.add_argument('--reload', dest='reload', default=False, action='store_true',
+                        help='stage and merge again only the files with quarantined records')
+    add_backend_argument(parser)
+    add_metrics_arguments(parser)
+    args = parser.parse_args()
+    if args.incremental and args.backend != 'redshift':
+        parser.error('--incremental stages from S3 and needs the redshift backend')
+    if args.reload and args.backend != 'redshift':
+        parser.error('--reload stages from S3 and needs the redshift backend')
+    main(args)
@@ -0,0 +1,198 @@
+import datetime
+import json
+import logging
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from psycopg2.extensions import connection, cursor
+
+LABEL_RE = re.compile(
+    r'^\s*(COPY|INSERT\s+INTO|DELETE\s+FROM|UPDATE|TRUNCATE|CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?'
+    r'|DROP\s+TABLE(?:\s+IF\s+EXISTS)?|ALTER\s+TABLE|SELECT|WITH)\s+(\w+)?',
+    re.IGNORECASE)
+
+bytes_scanned_query = """
+    SELECT query, SUM(bytes)
+      FROM stl_scan
+     WHERE query IN ({})
+     GROUP BY query;
+"""
+
+
+def statement_label(query):
+    """
+    Short label for a statement, e.g. 'COPY staging_events' or 'INSERT songplay'
+
+    Args:
+        query: SQL text
+    Returns:
+        label string
+    """
+    text = re.sub(r'--[^\n]*', '', query)
+    match = LABEL_RE.match(text)
+    if not match:
+        return ' '.join(text.split()[:2])
+    verb = match.group(1).split()[0].upper()
+    if verb in ('SELECT', 'WITH'):
+        tables = re.findall(r'\bFROM\s+(\w+)', text, re.IGNORECASE)
+        return 'SELECT {}'.format(tables[0] if tables else '').strip()
+    return '{} {}'.format(verb, match.group(2) or '').strip()
+
+
+_context = threading.local()
+
+
+@contextmanager
+def label(name):
+    """ Record the statements run inside the with block under name """
+    previous = getattr(_context, 'label', None)
+    _context.label = name
+    try:
+        yield
+    finally:
+        _context.label = previous
+
+
+class Recorder:
+    """ Thread-safe collection of per-statement measurements """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self.records.append(record)
+
+    def fill_bytes_scanned(self, cur):
+        """
+        Look up bytes scanned for every recorded Redshift query id in one
+        system table query, once the statements have finished
+
+        Args:
+            cur: cursor on a Redshift connection
+        """
+        ids = [r['query_id'] for r in self.records
+               if r.get('query_id') is not None and r.get('bytes_scanned') is None]
+        if not ids:
+            return
+        cur.execute(bytes_scanned_query.format(', '.join(str(int(i)) for i in ids)))
+        scanned = dict(cur.fetchall())
+        for record in self.records:
+            if record.get('query_id') in scanned:
+                record['bytes_scanned'] = int(scanned[record['query_id']])
+
+    def to_json_lines(self):
+        """ One JSON object per statement """
+        return ''.join(json.dumps(record, default=str) + '\n' for record in self.records)
+
+    def to_prometheus(self):
+        """ Per-label totals in Prometheus text exposition format """
+        totals = {}
+        for record in self.records:
+            total = totals.setdefault(record['label'], dict(count=0, seconds=0.0, rows=0, bytes=0))
+            total['count'] += 1
+            total['seconds'] += record['seconds']
+            total['rows'] += max(record['rows'] or 0, 0)
+            total['bytes'] += record.get('bytes_scanned') or 0
+
+        metrics = (('sparkify_statement_count', 'counter', 'count', 'Statements executed'),
+                   ('sparkify_statement_seconds', 'counter', 'seconds', 'Wall time of statements'),
+                   ('sparkify_statement_rows', 'counter', 'rows', 'Rows affected by statements'),
+                   ('sparkify_statement_bytes_scanned', 'counter', 'bytes', 'Bytes scanned'))
+        lines = []
+        for name, kind, key, help_text in metrics:
+            lines += ['# HELP {} {}'.format(name, help_text), '# TYPE {} {}'.format(name, kind)]
+            lines += ['{}{{statement="{}"}} {}'.format(name, label.replace('"', '\\"'), total[key])
+                      for label, total in sorted(totals.items())]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path=None, fmt='jsonl'):
+        """
+        Write the run summary
+
+        Args:
+            path: output file, stdout if None or '-'
+            fmt: 'jsonl' or 'prometheus'
+        """
+        text = self.to_prometheus() if fmt == 'prometheus' else self.to_json_lines()
+        if path in (None, '-'):
+            sys.stdout.write(text)
+        else:
+            with open(path, 'w') as f:
+                f.write(text)
+            logging.info('Wrote {} statement metrics to {}'.format(len(self.records), path))
+
+
+RECORDER = Recorder()
+
+
+class InstrumentedCursor(cursor):
+    """ Cursor that records wall time, rows and query id of every execute """
+
+    def execute(self, query, vars=None):
+        started_at = datetime.datetime.utcnow()
+        start = time.perf_counter()
+        error = None
+        try:
+            return super().execute(query, vars)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            text = query if isinstance(query, str) else str(query)
+            record = dict(label=getattr(_context, 'label', None) or statement_label(text),
+                          started_at=started_at.isoformat(),
+                          seconds=round(time.perf_counter() - start, 6),
+                          rows=self.rowcount,
+                          bytes_scanned=None,
+                          query_id=None,
+                          error=str(error) if error else None)
+            if error is None and getattr(self.connection, 'is_redshift', False):
+                record['query_id'] = self.connection.last_query_id(record['label'])
+            RECORDER.add(record)
+
+
+class InstrumentedConnection(connection):
+    """ Connection whose cursors are instrumented and which knows its backend """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cursor_factory = InstrumentedCursor
+        with self.cursor(cursor_factory=cursor) as cur:
+            cur.execute('SELECT version()')
+            self.is_redshift = 'redshift' in cur.fetchone()[0].lower()
+        self.rollback()
+
+    def last_query_id(self, label):
+        """ Backend id of the last statement, pg_last_copy_id() for COPY """
+        function = 'pg_last_copy_id' if label.startswith('COPY') else 'pg_last_query_id'
+        with self.cursor(cursor_factory=cursor) as cur:
+            cur.execute('SELECT {}()'.format(function))
+            return cur.fetchone()[0]
+
+
+def add_metrics_arguments(parser):
+    """ Add the --metrics and --metrics-format options to a CLI parser """
+    parser.add_argument('--metrics', dest='metrics', default=None,
+                        help='write per-statement metrics to this file, - for stdout')
+    parser.add_argument('--metrics-format', dest='metrics_format', default='jsonl',
+                        choices=('jsonl', 'prometheus'))
+
+
+def write_metrics(args, cur=None):
+    """
+    Write the run summary if --metrics was given
+
+    Args:
+        args: parsed CLI arguments
+        cur: open cursor, used to look up bytes scanned on Redshift
+    """
+    if not getattr(args, 'metrics', None):
+        return
+    if getattr(getattr(cur, 'connection', None), 'is_redshift', False):
+        RECORDER.fill_bytes_scanned(cur)
+    RECORDER.write(args.metrics, args.metrics_format)
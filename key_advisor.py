@@ -0,0 +1,258 @@
+import argparse
+import json
+import logging
+import re
+from collections import defaultdict
+
+from config import cluster_slices, config
+from instrument import statement_label
+from schema import ddl_columns, table_name
+from sql_queries import create_table_queries, insert_table_graph, merge_table_queries, \
+    test_queries
+
+# Row counts of a full load, from the README, used when no sizes are given
+DEFAULT_ROWS = {
+    'staging_events': 8056,
+    'staging_songs': 24,
+    'songplay': 6820,
+    'users': 104,
+    'songs': 24,
+    'artists': 24,
+    'time': 6813,
+}
+
+# Tables up to this many rows are cheap enough to copy to every node
+ALL_MAX_ROWS = 3000000
+
+TABLE_REF_RE = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(\w+))?', re.IGNORECASE)
+JOIN_RE = re.compile(r'(\w+)\.(\w+)\s*=\s*(\w+)\.(\w+)')
+FILTER_RE = re.compile(r'(?:(\w+)\.)?(\w+)\s*(?:=|<|>|<=|>=|\bBETWEEN\b|\bIN\b)\s*(?:\'|\d|\()',
+                       re.IGNORECASE)
+KEYWORDS = {'where', 'on', 'join', 'left', 'right', 'inner', 'outer', 'group', 'order', 'limit',
+            'select', 'and', 'or', 'using', 'as'}
+
+
+class Workload:
+    """ Joins and filters found in a set of queries, weighted by their cost """
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.joins = defaultdict(float)
+        self.filters = defaultdict(float)
+
+    def add(self, query, weight=1.0):
+        aliases = {}
+        for table, alias in TABLE_REF_RE.findall(query):
+            table = table.lower()
+            if table in self.tables:
+                aliases[table] = table
+                if alias and alias.lower() not in KEYWORDS:
+                    aliases[alias.lower()] = table
+
+        for a1, c1, a2, c2 in JOIN_RE.findall(query):
+            t1, t2 = aliases.get(a1.lower()), aliases.get(a2.lower())
+            if t1 and t2 and t1 != t2:
+                key = tuple(sorted(((t1, c1.lower()), (t2, c2.lower()))))
+                self.joins[key] += weight
+
+        where = re.split(r'\bWHERE\b', query, maxsplit=1, flags=re.IGNORECASE)
+        if len(where) == 2:
+            for alias, column in FILTER_RE.findall(where[1]):
+                column = column.lower()
+                for table in ([aliases.get(alias.lower())] if alias else set(aliases.values())):
+                    if table and column in self.tables[table]:
+                        self.filters[(table, column)] += weight
+
+
+def statement_weights(metrics_path):
+    """
+    Seconds spent per statement label in a metrics file from --metrics
+
+    Args:
+        metrics_path: JSON lines written by instrument.Recorder
+    Returns:
+        dict of label -> seconds
+    """
+    weights = defaultdict(float)
+    with open(metrics_path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                weights[record['label']] += record['seconds']
+    return weights
+
+
+def build_workload(tables, settings, weights=None):
+    """
+    Workload of the star schema build and the test queries
+
+    Args:
+        tables: dict of table -> column names
+        settings: config.Settings the statements are built from
+        weights: dict of statement label -> seconds, every statement weighs 1 if None
+    """
+    weights = weights or {}
+    workload = Workload(tables)
+    for queries, _ in insert_table_graph(settings).values():
+        for query in ((queries,) if isinstance(queries, str) else queries):
+            workload.add(query, weights.get(statement_label(query), 1.0))
+    for query in merge_table_queries(settings):
+        workload.add(query, weights.get(statement_label(query), 1.0))
+    for i, query in enumerate(test_queries, 1):
+        workload.add(query, weights.get('test{}'.format(i), 1.0))
+    return workload
+
+
+def current_layout(ddl):
+    """
+    Distribution and sort key declared in a CREATE TABLE statement
+
+    Returns:
+        (diststyle, distkey, sortkey), diststyle is 'all', 'key' or 'even'
+    """
+    distkey = sortkey = None
+    for definition in ddl[ddl.index('(') + 1:ddl.rindex(')')].split(','):
+        words = definition.split()
+        if not words:
+            continue
+        if re.search(r'\bdistkey\b', definition, re.IGNORECASE):
+            distkey = words[0].lower()
+        if re.search(r'\bsortkey\b', definition, re.IGNORECASE):
+            sortkey = words[0].lower()
+    if re.search(r'\bdiststyle\s+all\b', ddl, re.IGNORECASE):
+        return 'all', None, sortkey
+    return ('key', distkey, sortkey) if distkey else ('even', None, sortkey)
+
+
+def join_cost(layout, rows, join, slices):
+    """
+    Rows moved between slices to run one join
+
+    * collocated (both sides on the join column) or one side ALL: nothing
+    * one side on the join column: the other side is redistributed
+    * neither: the cheaper of redistributing both and broadcasting the smaller
+    """
+    (t1, c1), (t2, c2) = join
+    style1, key1 = layout[t1][:2]
+    style2, key2 = layout[t2][:2]
+    if style1 == 'all' or style2 == 'all':
+        return 0
+    on1, on2 = key1 == c1, key2 == c2
+    if on1 and on2:
+        return 0
+    if on1:
+        return rows[t2]
+    if on2:
+        return rows[t1]
+    return min(rows[t1] + rows[t2], min(rows[t1], rows[t2]) * slices)
+
+
+def workload_cost(workload, layout, rows, slices):
+    """ Weighted rows moved by the whole workload, plus the copies DISTSTYLE ALL stores """
+    moved = sum(weight * join_cost(layout, rows, join, slices)
+                for join, weight in workload.joins.items())
+    # ALL keeps a copy per node, charged as if one copy were moved per load
+    stored = sum(rows[t] * (slices - 1) / max(slices, 1) for t, l in layout.items() if l[0] == 'all')
+    return moved + stored
+
+
+def candidates(table, workload, rows):
+    """ DISTSTYLE candidates for a table: its join columns, EVEN and small-table ALL """
+    options = [('even', None)]
+    options += sorted({('key', column) for join in workload.joins for t, column in join
+                       if t == table})
+    if rows[table] <= ALL_MAX_ROWS:
+        options.append(('all', None))
+    return options
+
+
+def best_sortkey(table, workload, current):
+    """ Most heavily filtered column, else the most joined one, else the current key """
+    filtered = {c: w for (t, c), w in workload.filters.items() if t == table}
+    if filtered:
+        return max(sorted(filtered), key=filtered.get)
+    joined = defaultdict(float)
+    for join, weight in workload.joins.items():
+        for t, column in join:
+            if t == table:
+                joined[column] += weight
+    return max(sorted(joined), key=joined.get) if joined else current
+
+
+def advise(workload, layout, rows, slices, rounds=5):
+    """
+    Coordinate descent over per-table distribution choices: each round gives
+    every table the choice that minimizes the workload cost with the others
+    fixed, until nothing changes
+
+    Returns:
+        recommended layout, dict of table -> (diststyle, distkey, sortkey)
+    """
+    layout = dict(layout)
+    for _ in range(rounds):
+        changed = False
+        for table in sorted(layout):
+            def cost(option):
+                trial = dict(layout)
+                trial[table] = option + (layout[table][2],)
+                return workload_cost(workload, trial, rows, slices)
+            best = min(candidates(table, workload, rows), key=cost)
+            if cost(best) < cost(layout[table][:2]):
+                layout[table] = best + (layout[table][2],)
+                changed = True
+        if not changed:
+            break
+    return {t: (style, key, best_sortkey(t, workload, sort))
+            for t, (style, key, sort) in layout.items()}
+
+
+def rewrite_ddl(ddl, diststyle, distkey, sortkey):
+    """ CREATE TABLE statement with its distribution and sort keys replaced """
+    ddl = re.sub(r'[ \t]+(distkey|sortkey)\b', '', ddl, flags=re.IGNORECASE)
+    ddl = re.sub(r'\)\s*diststyle\s+\w+', ')', ddl, flags=re.IGNORECASE)
+    attributes = ['DISTSTYLE {}'.format(diststyle.upper())]
+    if distkey:
+        attributes.append('DISTKEY ({})'.format(distkey))
+    if sortkey:
+        attributes.append('SORTKEY ({})'.format(sortkey))
+    end = ddl.rindex(')') + 1
+    return ddl[:end] + '\n    ' + '\n    '.join(attributes) + ';'
+
+
+def main(args):
+    settings = config.settings
+    ddls = {table_name(ddl): ddl for ddl in create_table_queries(settings)}
+    tables = {t: {c[0].lower() for c in ddl_columns(ddl)} for t, ddl in ddls.items()}
+    rows = {t: DEFAULT_ROWS.get(t, 1000) for t in tables}
+    if args.sizes:
+        with open(args.sizes) as f:
+            rows.update(json.load(f))
+    slices = args.slices or cluster_slices(config)
+    weights = statement_weights(args.metrics) if args.metrics else None
+
+    workload = build_workload(tables, settings, weights)
+    layout = {t: current_layout(ddl) for t, ddl in ddls.items()}
+    advice = advise(workload, layout, rows, slices)
+
+    before = workload_cost(workload, layout, rows, slices)
+    after = workload_cost(workload, advice, rows, slices)
+    print('Estimated rows moved between slices: {:.0f} now, {:.0f} with the advice '
+          '({:.0f} saved).'.format(before, after, before - after))
+    for table in ddls:
+        if advice[table] != layout[table]:
+            print('\n-- {}: {} -> {}'.format(table, layout[table], advice[table]))
+            print(rewrite_ddl(ddls[table], *advice[table]))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Recommend DISTKEY/SORTKEY/DISTSTYLE from the query workload')
+    parser.add_argument('--metrics', dest='metrics', default=None,
+                        help='JSON lines from --metrics, to weight statements by their run time')
+    parser.add_argument('--sizes', dest='sizes', default=None,
+                        help='JSON object of table -> row count, defaults to a full load')
+    parser.add_argument('--slices', dest='slices', type=int, default=None,
+                        help='defaults to the slices of the cluster in dwh.cfg')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,163 @@
+import argparse
+import datetime
+import logging
+
+from botocore.exceptions import ClientError
+
+from create_cluster import config, config_file, create_iam_role, create_resources, \
+    dwh_cluster_id, open_ingress, poll, wait_for_cluster, write_config
+
+# [LIFECYCLE] STATE values
+AVAILABLE = 'available'
+PAUSED = 'paused'
+SNAPSHOTTED = 'snapshotted'
+
+
+def utcnow():
+    return datetime.datetime.utcnow().replace(microsecond=0)
+
+
+def record_state(state, operation, config_file=config_file, **values):
+    """
+    Record the outcome of a lifecycle operation in [LIFECYCLE] of dwh.cfg
+
+    Args:
+        state: AVAILABLE, PAUSED or SNAPSHOTTED
+        operation: name of the operation
+        config_file: path to the config file
+        values: other [LIFECYCLE] keys, e.g. SNAPSHOT
+    """
+    lifecycle = {'STATE': state, 'OPERATION': operation, 'UPDATED': utcnow().isoformat()}
+    lifecycle.update({k.upper(): v for k, v in values.items()})
+    write_config({'LIFECYCLE': lifecycle}, config_file)
+    logging.info('Cluster {} {}'.format(dwh_cluster_id(), state))
+
+
+def cluster_status(redshift, cluster_id=None):
+    """ Status of the cluster, None if it does not exist """
+    try:
+        clusters = redshift.describe_clusters(ClusterIdentifier=cluster_id or dwh_cluster_id())
+        return clusters['Clusters'][0]['ClusterStatus']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ClusterNotFound':
+            return None
+        raise
+
+
+def wait_for_status(redshift, wanted, cluster_id=None):
+    """ Poll until the cluster has the wanted status, None waits for it to be gone """
+    def check():
+        status = cluster_status(redshift, cluster_id)
+        return status == wanted, status, status
+    return poll(check)
+
+
+def pause(redshift, config_file=config_file):
+    """ Pause the cluster; storage is kept and compute is no longer billed """
+    if cluster_status(redshift) != PAUSED:
+        redshift.pause_cluster(ClusterIdentifier=dwh_cluster_id())
+        wait_for_status(redshift, PAUSED)
+    record_state(PAUSED, 'pause', config_file)
+
+
+def resume(redshift, config_file=config_file):
+    """
+    Resume a paused cluster, with its tables as they were
+
+    Returns:
+        cluster description
+    """
+    if cluster_status(redshift) == PAUSED:
+        redshift.resume_cluster(ClusterIdentifier=dwh_cluster_id())
+    cluster = wait_for_cluster(redshift)
+    write_config({'DB': {'HOST': cluster['Endpoint']['Address']}}, config_file)
+    record_state(AVAILABLE, 'resume', config_file)
+    return cluster
+
+
+def snapshot_and_delete(redshift, config_file=config_file, snapshot_id=None):
+    """
+    Delete the cluster with a final snapshot, so it can be restored loaded
+
+    Args:
+        redshift: Redshift client
+        config_file: path to the config file
+        snapshot_id: name of the snapshot, defaults to <cluster>-<utc time>
+    Returns:
+        snapshot identifier
+    """
+    snapshot_id = snapshot_id or '{}-{}'.format(dwh_cluster_id(), utcnow().strftime('%Y%m%d%H%M%S'))
+    logging.info('Deleting cluster {} with final snapshot {}'.format(dwh_cluster_id(), snapshot_id))
+    redshift.delete_cluster(ClusterIdentifier=dwh_cluster_id(), SkipFinalClusterSnapshot=False,
+                            FinalClusterSnapshotIdentifier=snapshot_id)
+    wait_for_status(redshift, None)
+    record_state(SNAPSHOTTED, 'snapshot', config_file, snapshot=snapshot_id)
+    return snapshot_id
+
+
+def latest_snapshot(redshift, cluster_id=None):
+    """ Newest available snapshot of the cluster, None if there is none """
+    snapshots = []
+    for page in redshift.get_paginator('describe_cluster_snapshots').paginate(
+            ClusterIdentifier=cluster_id or dwh_cluster_id()):
+        snapshots += [s for s in page['Snapshots'] if s['Status'] == 'available']
+    return max(snapshots, key=lambda s: s['SnapshotCreateTime']) if snapshots else None
+
+
+def restore_latest(ec2, iam, redshift, config_file=config_file):
+    """
+    Restore the cluster from its newest snapshot, with the configured node
+    type and count. The role and ingress rule are created if a teardown
+    removed them.
+
+    Returns:
+        cluster description
+    """
+    snapshot = latest_snapshot(redshift)
+    if snapshot is None:
+        raise RuntimeError('No available snapshot of cluster {}'.format(dwh_cluster_id()))
+    role_arn = create_iam_role(iam)
+    open_ingress(ec2)
+    logging.info('Restoring cluster {} from {}'.format(dwh_cluster_id(),
+                                                       snapshot['SnapshotIdentifier']))
+    redshift.restore_from_cluster_snapshot(
+        ClusterIdentifier=dwh_cluster_id(),
+        SnapshotIdentifier=snapshot['SnapshotIdentifier'],
+        NodeType=config['CLUSTER']['DWH_NODE_TYPE'],
+        NumberOfNodes=int(config['CLUSTER']['DWH_NUM_NODES']),
+        IamRoles=[role_arn])
+    cluster = wait_for_cluster(redshift)
+    write_config({'DB': {'HOST': cluster['Endpoint']['Address']},
+                  'IAM_ROLE': {'ARN': role_arn}}, config_file)
+    record_state(AVAILABLE, 'restore', config_file, snapshot=snapshot['SnapshotIdentifier'])
+    return cluster
+
+
+def main(args):
+    ec2, iam, redshift = create_resources(args.endpoint_url)
+    if args.command == 'pause':
+        pause(redshift, args.config_file)
+    elif args.command == 'resume':
+        resume(redshift, args.config_file)
+    elif args.command == 'snapshot':
+        snapshot_and_delete(redshift, args.config_file, args.snapshot_id)
+    elif args.command == 'restore':
+        restore_latest(ec2, iam, redshift, args.config_file)
+    print('Cluster {}: {}'.format(dwh_cluster_id(), cluster_status(redshift) or 'deleted'))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Pause, resume, snapshot or restore the cluster instead of recreating it')
+    parser.add_argument('command', choices=('pause', 'resume', 'snapshot', 'restore', 'status'),
+                        help='snapshot deletes the cluster with a final snapshot, restore '
+                             'brings back the newest one')
+    parser.add_argument('--snapshot-id', dest='snapshot_id', default=None,
+                        help='name of the final snapshot, defaults to <cluster>-<utc time>')
+    parser.add_argument('--endpoint-url', dest='endpoint_url', default=None,
+                        help='local AWS stand-in such as moto_server, defaults to [AWS] ENDPOINT_URL')
+    parser.add_argument('--config', dest='config_file', default=config_file,
+                        help='config file the state, endpoint and role arn are written to')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,172 @@
+import argparse
+import datetime
+import logging
+
+from sql_queries import load_errors_capture, load_errors_copy_files, load_errors_insert, \
+    load_errors_pending, load_errors_resolve, load_errors_table_create
+
+# Width of the text columns of load_errors
+MAX_TEXT = 1024
+
+
+def ensure_load_errors_table(cur, ddl=lambda q: [q]):
+    """
+    Create the quarantine table if it does not exist yet
+
+    Args:
+        cur: cursor to the db connection
+        ddl: translates the CREATE TABLE into statements for the backend, e.g. Backend.ddl
+    """
+    for query in ddl(load_errors_table_create):
+        cur.execute(query)
+
+
+def capture_load_errors(cur, table):
+    """
+    Quarantine the records the last COPY of this session rejected, as listed
+    in stl_load_errors. Not committed, so it shares the COPY's transaction.
+
+    Args:
+        cur: cursor to the db connection the COPY ran on
+        table: staging table the COPY loaded
+    Returns:
+        number of records quarantined
+    """
+    cur.execute(load_errors_capture, (table,))
+    count = max(cur.rowcount, 0)
+    if count:
+        logging.warning('{} records rejected by the COPY into {} quarantined'.format(count, table))
+    return count
+
+
+def quarantine_record(cur, table, filename, line_number, reason, raw_line=None, colname=None,
+                      raw_field_value=None, err_code=None, query_id=None):
+    """
+    Quarantine one rejected record, or a whole file with line_number 0. Not committed.
+
+    Args:
+        cur: cursor to the db connection
+        table: staging table the record was loaded into
+        filename: file the record came from, an s3:// url or a zip member
+        line_number: line of the record in the file, 0 for the whole file
+        reason: why it was rejected
+        raw_line, colname, raw_field_value: the record and the column and value at fault
+    """
+    cur.execute(load_errors_insert, (
+        table, filename, line_number, colname, err_code, _clip(reason), _clip(raw_line),
+        _clip(raw_field_value), query_id, datetime.datetime.utcnow()))
+
+
+def quarantine_files(cur, table, objects, reason):
+    """
+    Quarantine every file of a COPY that failed, so they are reloaded once fixed
+
+    Args:
+        cur: cursor to the db connection
+        table: staging table the COPY loaded
+        objects: list of (s3 url, size) tuples
+        reason: error the COPY failed with
+    """
+    for url, _ in objects:
+        quarantine_record(cur, table, url, 0, reason)
+    logging.warning('{} files of {} quarantined: {}'.format(len(objects), table, reason))
+
+
+def quarantine_failed_copy(cur, table, objects, reason):
+    """
+    Quarantine what a COPY that failed over MAXERROR leaves to reload: the
+    records it rejected, which stl_load_errors keeps through the rollback,
+    and the other files of its manifest, rolled back with it, with line
+    number 0. Not committed.
+
+    Args:
+        cur: cursor to the db connection the COPY failed on, rolled back
+        table: staging table the COPY loaded
+        objects: list of (s3 url, size) tuples the COPY read
+        reason: error the COPY failed with
+    Returns:
+        number of records and files quarantined, 0 if stl_load_errors lists
+        nothing for the COPY, when the data is not what it failed on
+    """
+    captured = capture_load_errors(cur, table)
+    if not captured:
+        return 0
+    cur.execute(load_errors_copy_files)
+    rejected = {filename for filename, in cur.fetchall()}
+    rolled_back = [obj for obj in objects if obj[0] not in rejected]
+    quarantine_files(cur, table, rolled_back, 'rolled back with the failed COPY: {}'.format(reason))
+    return captured + len(rolled_back)
+
+
+def _clip(value):
+    return None if value is None else str(value)[:MAX_TEXT]
+
+
+def pending_files(cur, s3_only=False):
+    """
+    Files with quarantined records not reloaded yet
+
+    Returns:
+        dict of staging table -> list of (filename, quarantined records) tuples
+    """
+    cur.execute(load_errors_pending)
+    pending = {}
+    for table, filename, count in cur.fetchall():
+        if not s3_only or filename.startswith('s3://'):
+            pending.setdefault(table, []).append((filename, count))
+    return pending
+
+
+def resolve_files(cur, table, filenames):
+    """ Mark the quarantined records of reloaded files as resolved. Not committed. """
+    for filename in filenames:
+        cur.execute(load_errors_resolve, (table, filename))
+
+
+def reload_manifest(s3, table, filenames, manifest_prefix):
+    """
+    Write a COPY manifest listing the files to reload
+
+    Args:
+        s3: boto3 S3 client
+        table: staging table the files are for, used to name the manifest
+        filenames: s3 urls of the files
+        manifest_prefix: s3 prefix the manifest is written under
+    Returns:
+        manifest url
+    """
+    from staging import parse_s3_url, write_manifest
+
+    objects = []
+    for url in filenames:
+        bucket, key = parse_s3_url(url)
+        objects.append((url, s3.head_object(Bucket=bucket, Key=key)['ContentLength']))
+    manifest_prefix = manifest_prefix.strip().strip("'\"").rstrip('/')
+    return write_manifest(s3, objects, '{}/{}-reload.manifest'.format(manifest_prefix, table))
+
+
+def main(args):
+    from backends import get_backend
+
+    backend = get_backend(args.backend)
+    with backend.session() as (cur, conn):
+        ensure_load_errors_table(cur, backend.ddl)
+        pending = pending_files(cur)
+        conn.commit()
+    if not pending:
+        print('No quarantined records.')
+    for table, files in pending.items():
+        print('{}: {} records in {} files'.format(table, sum(c for _, c in files), len(files)))
+        for filename, count in files:
+            print('  {:>6}  {}'.format(count, filename))
+
+
+if __name__ == '__main__':
+    from backends import add_backend_argument
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='List the files with records quarantined by the staging loads')
+    add_backend_argument(parser)
+    args = parser.parse_args()
+    main(args)
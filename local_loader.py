@@ -0,0 +1,352 @@
+import argparse
+import datetime
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import re
+import struct
+import zipfile
+
+import psycopg2
+
+from config import config
+from load_errors import ensure_load_errors_table, quarantine_record
+from sampling import Reservoir, store_sample
+from schema import ddl_columns, postgres_ddl
+from sql_queries import SAMPLE_SIZE, staging_events_table_create
+
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+LOG_ZIP = os.path.join(ROOT_PATH, 'data', 'log_data.zip')
+LOG_JSONPATHS = os.path.join(ROOT_PATH, 'data', 'log_json_path.json')
+
+# Binary COPY framing
+# https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+COPY_TRAILER = struct.pack('!h', -1)
+NULL_FIELD = struct.pack('!i', -1)
+
+# Binary timestamps count microseconds from 2000-01-01, the Postgres epoch
+PG_EPOCH_MS = 946684800000
+PG_EPOCH = datetime.datetime(2000, 1, 1)
+
+# Raised by encode_field for a value that does not fit its column
+ENCODE_ERRORS = (ValueError, TypeError, OverflowError, struct.error)
+
+# staging table -> (fields of its match key, fields of the key of rows without one)
+MATCH_KEY_FIELDS = {
+    'staging_events':   (('song', 'artist', 'length'), ('sessionId', 'itemInSession')),
+    'staging_songs':    (('title', 'artist_name', 'duration'), ('song_id',)),
+}
+
+NUMERIC_FORMATS = {
+    'SMALLINT':         ('!h', int),
+    'INTEGER':          ('!i', int),
+    'BIGINT':           ('!q', int),
+    'REAL':             ('!f', float),
+    'FLOAT':            ('!d', float),
+    'DOUBLE PRECISION': ('!d', float),
+}
+
+
+def read_jsonpaths(filepath=LOG_JSONPATHS):
+    """
+    Read the keys selected by a Redshift jsonpaths file
+
+    Args:
+        filepath: path to a jsonpaths file such as data/log_json_path.json
+    Returns:
+        list of top-level keys, in column order
+    """
+    with open(filepath) as f:
+        paths = json.load(f)['jsonpaths']
+    return [re.match(r"^\$\['(.+)'\]$", path).group(1) for path in paths]
+
+
+def iter_records(zip_path=LOG_ZIP, rejected=None):
+    """
+    Yield the JSON records of every file in the zip, one member at a time
+
+    Args:
+        zip_path: path to the zipped log data
+        rejected: list the lines that are not UTF-8 JSON are appended to, as
+            (member, line number, reason, line, None, None); they raise if not given
+    Yields:
+        (member name, line number, record) tuples
+    """
+    with zipfile.ZipFile(zip_path) as archive:
+        for member in sorted(archive.namelist()):
+            if not member.endswith('.json'):
+                continue
+            with archive.open(member) as f:
+                for line_no, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError as e:
+                        if rejected is None:
+                            raise
+                        rejected.append((member, line_no, str(e),
+                                         line.decode('utf-8', 'replace').rstrip('\r\n'), None, None))
+                        continue
+                    yield member, line_no, record
+
+
+def match_key(title, artist, duration):
+    """
+    Python twin of sql_queries.match_key: the first 60 bits of the MD5 of
+    the trimmed, lowercased title and artist and the rounded duration
+
+    Returns:
+        int, or None if any part is missing
+    """
+    if any(part is None or (isinstance(part, str) and not part.strip(' '))
+           for part in (title, artist, duration)):
+        return None
+    text = '{}|{}|{}'.format(title.strip(' ').lower(), artist.strip(' ').lower(),
+                             int(math.floor(float(duration) + 0.5)))
+    return int(hashlib.md5(text.encode('utf-8')).hexdigest()[:15], 16)
+
+
+def fallback_key(*parts):
+    """
+    Python twin of sql_queries.fallback_key: the first 60 bits of the MD5 of
+    the parts, negated so it never equals a match key. Missing and blank
+    parts hash as empty strings, as BLANKSASNULL loads them as NULL.
+    """
+    text = '|'.join('' if part is None or (isinstance(part, str) and not part.strip())
+                    else str(part) for part in parts)
+    return -1 - int(hashlib.md5(text.encode('utf-8')).hexdigest()[:15], 16)
+
+
+def row_match_key(table, record):
+    """
+    match_key column of a staging record: its match key, or for records
+    without a song, a fallback_key that spreads them over the slices
+    """
+    key_fields, fallback_fields = MATCH_KEY_FIELDS[table]
+    key = match_key(*(record.get(field) for field in key_fields))
+    if key is None:
+        key = fallback_key(*(record.get(field) for field in fallback_fields))
+    return key
+
+
+def project_event(record, keys):
+    """ staging_events values of a log record: the jsonpaths keys, then match_key """
+    return [record.get(key) for key in keys] + [row_match_key('staging_events', record)]
+
+
+def encode_field(value, col_type, length):
+    """
+    Encode one value in binary COPY format. Blank strings become NULL and
+    long strings are cut to the column width, like BLANKSASNULL and
+    TRUNCATECOLUMNS in the Redshift COPY. TIMESTAMP values are datetimes or
+    epoch millis, like TIMEFORMAT 'epochmillisecs'.
+    """
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return NULL_FIELD
+    if isinstance(value, datetime.datetime):
+        delta = value - PG_EPOCH
+        data = struct.pack('!q', (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+    elif col_type == 'TIMESTAMP':
+        data = struct.pack('!q', (int(value) - PG_EPOCH_MS) * 1000)
+    elif col_type in NUMERIC_FORMATS:
+        fmt, cast = NUMERIC_FORMATS[col_type]
+        data = struct.pack(fmt, cast(value))
+    else:
+        value = str(value)
+        data = (value[:length] if length else value).encode('utf-8')
+    return struct.pack('!i', len(data)) + data
+
+
+def sql_value(value, col_type, length):
+    """ A value as encode_field loads it, for a parameter of an INSERT """
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    if col_type == 'TIMESTAMP' and not isinstance(value, datetime.datetime):
+        return PG_EPOCH + datetime.timedelta(milliseconds=int(value) - PG_EPOCH_MS)
+    if col_type in NUMERIC_FORMATS:
+        return NUMERIC_FORMATS[col_type][1](value)
+    value = str(value)
+    return value[:length] if length else value
+
+
+def encode_row(values, columns):
+    """ Encode one projected row in binary COPY format """
+    fields = [encode_field(value, col_type, length)
+              for value, (_, col_type, length) in zip(values, columns)]
+    return struct.pack('!h', len(fields)) + b''.join(fields)
+
+
+def rejected_field(values, columns):
+    """ Name and value of the first field encode_row cannot encode """
+    for value, (name, col_type, length) in zip(values, columns):
+        try:
+            encode_field(value, col_type, length)
+        except ENCODE_ERRORS:
+            return name, value
+    return None, None
+
+
+def iter_batches(records, keys, columns, batch_size, rejected=None, reservoir=None):
+    """
+    Project records through the jsonpaths keys, add their match key and
+    encode them into binary COPY payloads of at most batch_size rows each
+
+    Args:
+        rejected: list the records that do not fit the columns are appended to,
+            as (member, line number, reason, record, column, value); they raise
+            if not given
+        reservoir: sampling.Reservoir fed with the values of every row encoded
+    Yields:
+        (payload bytes, number of rows) tuples
+    """
+    buf, rows = io.BytesIO(), 0
+    for member, line_no, record in records:
+        values = project_event(record, keys)
+        try:
+            row = encode_row(values, columns)
+        except ENCODE_ERRORS as e:
+            if rejected is None:
+                raise
+            rejected.append((member, line_no, str(e), json.dumps(record))
+                            + rejected_field(values, columns))
+            continue
+        if reservoir is not None:
+            reservoir.add(values)
+        if rows == 0:
+            buf.write(COPY_HEADER)
+        buf.write(row)
+        rows += 1
+        if rows == batch_size:
+            buf.write(COPY_TRAILER)
+            yield buf.getvalue(), rows
+            buf, rows = io.BytesIO(), 0
+    if rows:
+        buf.write(COPY_TRAILER)
+        yield buf.getvalue(), rows
+
+
+def batched(iterable, size):
+    """ Lists of at most size consecutive items of an iterable """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def copy_rows(cur, table, columns, rows, batch_size=10000):
+    """
+    Binary COPY rows into a table, one COPY per batch_size rows, so memory
+    is bounded by one batch
+
+    Args:
+        cur: cursor to the db connection
+        table: table name
+        columns: ddl_columns of the table
+        rows: iterable of value lists, in column order
+        batch_size: rows per COPY
+    Returns:
+        number of rows copied
+    """
+    copy_sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT binary)'.format(
+        table, ', '.join(name for name, _, _ in columns))
+    total = 0
+    for batch in batched(rows, batch_size):
+        payload = io.BytesIO()
+        payload.write(COPY_HEADER)
+        for row in batch:
+            payload.write(encode_row(row, columns))
+        payload.write(COPY_TRAILER)
+        payload.seek(0)
+        cur.copy_expert(copy_sql, payload)
+        total += len(batch)
+    return total
+
+
+def load_staging_events(cur, conn, zip_path=LOG_ZIP, jsonpaths=LOG_JSONPATHS,
+                        batch_size=10000, reservoir=None):
+    """
+    Stream data/log_data.zip into staging_events with binary COPY FROM STDIN.
+    Memory is bounded by one batch and nothing is written to disk. Lines that
+    are not JSON or do not fit the columns are quarantined in load_errors,
+    like the records MAXERROR lets the Redshift COPY skip. The reservoir
+    drawn along the way replaces staging_events_sample.
+
+    Args:
+        cur: cursor to the db connection
+        conn: db connection
+        zip_path: path to the zipped log data
+        jsonpaths: path to the jsonpaths file mapping JSON keys to columns
+        batch_size: rows per COPY
+        reservoir: sampling.Reservoir fed with every loaded row
+    Returns:
+        (rows loaded, records quarantined)
+    """
+    columns = ddl_columns(staging_events_table_create)
+    keys = read_jsonpaths(jsonpaths)
+    copy_sql = 'COPY staging_events ({}) FROM STDIN WITH (FORMAT binary)'.format(
+        ', '.join(name for name, _, _ in columns))
+
+    rejected = []
+    records = iter_records(zip_path, rejected)
+
+    total = 0
+    for payload, rows in iter_batches(records, keys, columns, batch_size, rejected, reservoir):
+        cur.copy_expert(copy_sql, io.BytesIO(payload))
+        total += rows
+        logging.info('Copied {} rows into staging_events'.format(total))
+    for member, line_no, reason, raw_line, colname, value in rejected:
+        quarantine_record(cur, 'staging_events', member, line_no, reason, raw_line, colname, value)
+    if reservoir is not None:
+        store_sample(cur, 'staging_events', [name for name, _, _ in columns],
+                     [(priority, [sql_value(value, *column[1:])
+                                  for value, column in zip(values, columns)])
+                      for priority, values in reservoir.sample],
+                     lambda q: [postgres_ddl(q)])
+    conn.commit()
+    return total, len(rejected)
+
+
+def main(args):
+    conn = psycopg2.connect(args.dsn)
+    cur = conn.cursor()
+    print('Connected to local Postgres...')
+    if args.create:
+        cur.execute(postgres_ddl(staging_events_table_create))
+    ensure_load_errors_table(cur, lambda q: [postgres_ddl(q)])
+    conn.commit()
+    reservoir = Reservoir(args.sample) if args.sample else None
+    total, rejected = load_staging_events(cur, conn, args.zip_path, args.jsonpaths,
+                                          args.batch_size, reservoir)
+    print('{} rows COPIED to staging_events.'.format(total))
+    if rejected:
+        print('{} records quarantined in load_errors.'.format(rejected))
+    if reservoir is not None:
+        print('Sample of {} loaded events kept in staging_events_sample.'.format(
+            len(reservoir.items)))
+    conn.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', dest='dsn',
+                        default=config.get('LOCAL', 'DSN', fallback='dbname=sparkify'))
+    parser.add_argument('--zip', dest='zip_path', default=LOG_ZIP)
+    parser.add_argument('--jsonpaths', dest='jsonpaths', default=LOG_JSONPATHS)
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=10000)
+    parser.add_argument('--create', dest='create', default=False, action='store_true',
+                        help='create staging_events if it does not exist')
+    parser.add_argument('--sample', dest='sample', type=int, default=SAMPLE_SIZE,
+                        help='events of the uniform sample drawn while loading and kept in '
+                             'staging_events_sample, 0 to skip it')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,377 @@
+import argparse
+import datetime
+import glob
+import io
+import json
+import logging
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from config import config
+from load_errors import ensure_load_errors_table, quarantine_record
+from local_loader import LOG_JSONPATHS, LOG_ZIP, read_jsonpaths, row_match_key
+from schema import ddl_columns
+from sql_queries import staging_events_table_create, staging_songs_table_create
+from staging import list_objects, parse_s3_url, s3_client
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Uncompressed JSON read per output file; Redshift wants Parquet files of
+# 64 MB to 1 GB, and JSON compacts several times over into typed columns
+TARGET_BYTES = 512 * 1024 * 1024
+
+# Rows buffered per partition before they are written out as a row group,
+# which bounds the memory of a worker whatever the size of its chunk
+BATCH_ROWS = 100000
+
+# Worker processes by default, each holding up to BATCH_ROWS rows per partition
+MAX_WORKERS = 4
+
+# Width of the integer column types
+INT_BITS = {'SMALLINT': 16, 'INTEGER': 32, 'BIGINT': 64}
+
+# Errors of typed_value on a value that does not fit its column
+TYPED_ERRORS = (ValueError, TypeError, OverflowError)
+
+# staging table -> CREATE TABLE statement
+TABLES = {
+    'staging_events':   staging_events_table_create,
+    'staging_songs':    staging_songs_table_create,
+}
+
+
+def arrow_type(col_type, pa):
+    """ pyarrow type of a DDL column type """
+    return {
+        'SMALLINT':         pa.int16(),
+        'INTEGER':          pa.int32(),
+        'BIGINT':           pa.int64(),
+        'REAL':             pa.float32(),
+        'FLOAT':            pa.float64(),
+        'DOUBLE PRECISION': pa.float64(),
+        'BOOLEAN':          pa.bool_(),
+        'TIMESTAMP':        pa.timestamp('us'),
+    }.get(col_type, pa.string())
+
+
+def typed_value(value, col_type, length):
+    """
+    Convert one JSON value to its column type the way the JSON COPY does:
+    blank strings are NULL, strings are cut to the column width in UTF-8
+    bytes, as Redshift counts VARCHAR lengths, and TIMESTAMP values are
+    epoch millis
+    """
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    if col_type == 'TIMESTAMP':
+        return EPOCH + datetime.timedelta(milliseconds=int(value))
+    if col_type in INT_BITS:
+        number = int(value)
+        if not -2 ** (INT_BITS[col_type] - 1) <= number < 2 ** (INT_BITS[col_type] - 1):
+            raise OverflowError('{} out of range for {}'.format(number, col_type))
+        return number
+    if col_type in ('REAL', 'FLOAT', 'DOUBLE PRECISION'):
+        return float(value)
+    value = str(value)
+    if not length:
+        return value
+    return value.encode('utf-8')[:length].decode('utf-8', 'ignore')
+
+
+def iter_input(source):
+    """
+    Yield the JSON records of one input file
+
+    Args:
+        source: ('zip', zip path, member), ('file', path) or ('s3', url)
+    """
+    for _, record in iter_lines(source):
+        yield record
+
+
+def source_name(source):
+    """ Zip member, path or url of an input, as load_errors records it """
+    return source[-1]
+
+
+def iter_lines(source, rejected=None):
+    """
+    Yield the JSON records of one input file with their line numbers
+
+    Args:
+        source: ('zip', zip path, member), ('file', path) or ('s3', url)
+        rejected: list the lines that are not JSON are appended to, as
+            (file, line number, reason, line, None, None); they raise if not given
+    Yields:
+        (line number, record) tuples
+    """
+    kind = source[0]
+    if kind == 'zip':
+        with zipfile.ZipFile(source[1]) as archive:
+            data = archive.read(source[2])
+    elif kind == 's3':
+        bucket, key = parse_s3_url(source[1])
+        data = s3_client(config).get_object(Bucket=bucket, Key=key)['Body'].read()
+    else:
+        with open(source[1], 'rb') as f:
+            data = f.read()
+    for line_no, line in enumerate(io.BytesIO(data), 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line.decode('utf-8'))
+        except ValueError as e:
+            if rejected is None:
+                raise
+            rejected.append((source_name(source), line_no, str(e),
+                             line.decode('utf-8', 'replace').rstrip('\r\n'), None, None))
+            continue
+        yield line_no, record
+
+
+def list_inputs(source):
+    """
+    Input files of a source: a zip, a local directory or an S3 prefix
+
+    Returns:
+        sorted list of (input, size in bytes) tuples
+    """
+    if source.startswith('s3://') or source.startswith("'s3://"):
+        return [(('s3', url), size) for url, size in list_objects(s3_client(config), source)]
+    if zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            return [(('zip', source, info.filename), info.file_size)
+                    for info in sorted(archive.infolist(), key=lambda i: i.filename)
+                    if info.filename.endswith('.json')]
+    paths = sorted(glob.glob(os.path.join(source, '**', '*.json'), recursive=True))
+    return [(('file', path), os.path.getsize(path)) for path in paths]
+
+
+def chunk_inputs(inputs, target_bytes=TARGET_BYTES):
+    """ Group sorted inputs into contiguous chunks of about target_bytes each """
+    chunks, chunk, size = [], [], 0
+    for source, source_size in inputs:
+        chunk.append(source)
+        size += source_size
+        if size >= target_bytes:
+            chunks.append(chunk)
+            chunk, size = [], 0
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def typed_rows(table, records, jsonpaths=None):
+    """
+    Project JSON records onto the columns of a staging table, typed and with
+    their match key, as the COPY would load them
+
+    Args:
+        table: 'staging_events' or 'staging_songs'
+        records: iterable of JSON records
+        jsonpaths: keys selected by the jsonpaths file, None to match columns by name
+    Yields:
+        lists of values, in column order
+    """
+    data_columns = [c for c in ddl_columns(TABLES[table]) if c[0] != 'match_key']
+    keys = jsonpaths or [name for name, _, _ in data_columns]
+    for record in records:
+        yield typed_row(table, record, keys, data_columns)
+
+
+def typed_row(table, record, keys, data_columns):
+    """ One record as typed_rows yields it; raises one of TYPED_ERRORS if it does not fit """
+    row = [typed_value(record.get(key), col_type, length)
+           for key, (_, col_type, length) in zip(keys, data_columns)]
+    row.append(row_match_key(table, record))
+    return row
+
+
+def rejected_field(record, keys, data_columns):
+    """ Name and value of the first field typed_value cannot convert """
+    for key, (name, col_type, length) in zip(keys, data_columns):
+        try:
+            typed_value(record.get(key), col_type, length)
+        except TYPED_ERRORS:
+            return name, record.get(key)
+    return None, None
+
+
+def checked_rows(table, sources, rejected, jsonpaths=None):
+    """
+    typed_rows of the records of every input. The lines that are not JSON
+    or do not fit the columns are appended to rejected, as (file, line
+    number, reason, record, column, value), instead of failing the chunk.
+    """
+    data_columns = [c for c in ddl_columns(TABLES[table]) if c[0] != 'match_key']
+    keys = jsonpaths or [name for name, _, _ in data_columns]
+    for source in sources:
+        for line_no, record in iter_lines(source, rejected):
+            try:
+                yield typed_row(table, record, keys, data_columns)
+            except TYPED_ERRORS as e:
+                rejected.append((source_name(source), line_no, str(e), json.dumps(record))
+                                + rejected_field(record, keys, data_columns))
+
+
+def arrow_table(table, rows):
+    """ pyarrow Table of typed_rows, with the schema of the staging table """
+    import pyarrow as pa
+
+    schema = pa.schema([(name, arrow_type(col_type, pa))
+                        for name, col_type, _ in ddl_columns(TABLES[table])])
+    columns = list(zip(*rows)) or [[] for _ in schema]
+    return pa.Table.from_arrays([pa.array(list(values), type=field.type)
+                                 for values, field in zip(columns, schema)], schema=schema)
+
+
+def partition_of(table, row, columns):
+    """ year=/month= partition of an event by ts; songs are not partitioned """
+    if table != 'staging_events':
+        return ''
+    ts = row[[name for name, _, _ in columns].index('ts')]
+    return 'year={}/month={:02d}'.format(ts.year, ts.month) if ts else 'year=unknown'
+
+
+def convert_chunk(table, sources, output_dir, batch, chunk_id, jsonpaths=None,
+                  batch_rows=BATCH_ROWS):
+    """
+    Convert one chunk of JSON inputs to typed Parquet, one file per partition.
+    Rows are streamed into a ParquetWriter per partition, batch_rows at a
+    time, so memory does not grow with the chunk. Records that do not fit
+    the columns are returned for quarantine instead of failing the chunk.
+    Runs in a worker process.
+
+    Args:
+        table: 'staging_events' or 'staging_songs'
+        sources: list of inputs, see iter_input
+        output_dir: local directory the files are written under
+        batch: name of the conversion run, the first path level
+        chunk_id: number of the chunk, used in the file names
+        jsonpaths: keys selected by the jsonpaths file, None to match columns by name
+        batch_rows: rows buffered per partition before they are written
+    Returns:
+        (list of (file path, rows) tuples, list of rejected records, see checked_rows)
+    """
+    import pyarrow.parquet as pq
+
+    columns = ddl_columns(TABLES[table])
+    rejected = []
+    buffers, writers, counts = {}, {}, {}
+
+    def flush(partition):
+        data = arrow_table(table, buffers.pop(partition))
+        if partition not in writers:
+            directory = os.path.join(output_dir, batch, partition)
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(directory, 'part-{:05d}.parquet'.format(chunk_id))
+            writers[partition] = (path, pq.ParquetWriter(path, data.schema, compression='snappy'))
+        writers[partition][1].write_table(data)
+        counts[partition] = counts.get(partition, 0) + data.num_rows
+
+    try:
+        for row in checked_rows(table, sources, rejected, jsonpaths):
+            partition = partition_of(table, row, columns)
+            buffers.setdefault(partition, []).append(row)
+            if len(buffers[partition]) >= batch_rows:
+                flush(partition)
+        for partition in list(buffers):
+            flush(partition)
+    finally:
+        for _, writer in writers.values():
+            writer.close()
+    return sorted((path, counts[partition]) for partition, (path, _) in writers.items()), rejected
+
+
+def convert(table, source, output_dir, workers=None, target_bytes=TARGET_BYTES, jsonpaths=None):
+    """
+    Compact the JSON files of a source into large typed Parquet files, one
+    chunk of inputs per worker process
+
+    Args:
+        table: 'staging_events' or 'staging_songs'
+        source: zip file, local directory or s3:// prefix
+        output_dir: local directory to write to
+        workers: number of worker processes, defaults to the CPU count up to MAX_WORKERS
+        target_bytes: JSON bytes per output file
+        jsonpaths: path to a jsonpaths file, None to match columns by name
+    Returns:
+        (list of (file path, rows) tuples, list of rejected records, see checked_rows)
+    """
+    keys = read_jsonpaths(jsonpaths) if jsonpaths else None
+    chunks = chunk_inputs(list_inputs(source), target_bytes)
+    batch = 'batch={}'.format(datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S'))
+    print('{}: {} chunks from {}'.format(table, len(chunks), source))
+
+    written, rejected = [], []
+    workers = workers or min(MAX_WORKERS, os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(convert_chunk, table, chunk, output_dir, batch, i, keys)
+                   for i, chunk in enumerate(chunks)]
+        for future in as_completed(futures):
+            files, records = future.result()
+            written.extend(files)
+            rejected.extend(records)
+    written.sort()
+    print('{} rows written to {} Parquet files.'.format(sum(r for _, r in written), len(written)))
+    return written, rejected
+
+
+def quarantine(backend, table, rejected):
+    """ Record the rejected records in load_errors, like local_loader does """
+    with backend.session() as (cur, conn):
+        ensure_load_errors_table(cur, backend.ddl)
+        for filename, line_no, reason, raw_line, colname, value in rejected:
+            quarantine_record(cur, table, filename, line_no, reason, raw_line, colname, value)
+        conn.commit()
+    logging.warning('{} records of {} quarantined in load_errors'.format(len(rejected), table))
+
+
+def upload(files, output_dir, url):
+    """ Upload converted files to an S3 prefix, keeping their relative paths """
+    s3 = s3_client(config)
+    bucket, prefix = parse_s3_url(url)
+    for path, _ in files:
+        key = '/'.join(p for p in (prefix.rstrip('/'), os.path.relpath(path, output_dir)) if p)
+        s3.upload_file(path, bucket, key.replace(os.sep, '/'))
+        logging.info('Uploaded s3://{}/{}'.format(bucket, key))
+
+
+def main(args):
+    jsonpaths = args.jsonpaths if args.table == 'staging_events' else None
+    output_dir = args.output
+    if args.output.startswith('s3://'):
+        output_dir = args.local_dir
+    files, rejected = convert(args.table, args.source, output_dir, args.workers,
+                              int(args.target_mb * 1024 * 1024), jsonpaths)
+    if rejected:
+        from backends import get_backend
+        quarantine(get_backend(args.backend), args.table, rejected)
+        print('{} records quarantined in load_errors.'.format(len(rejected)))
+    if args.output.startswith('s3://'):
+        upload(files, output_dir, args.output)
+
+
+if __name__ == '__main__':
+    from backends import add_backend_argument
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Compact raw JSON into typed, partitioned Parquet for COPY FORMAT AS PARQUET')
+    parser.add_argument('table', choices=sorted(TABLES))
+    parser.add_argument('--source', dest='source', default=LOG_ZIP,
+                        help='zip file, local directory or s3:// prefix of JSON files')
+    parser.add_argument('--output', dest='output', required=True,
+                        help='local directory or s3:// prefix, e.g. [S3] PARQUET_LOG_DATA')
+    parser.add_argument('--local-dir', dest='local_dir', default='parquet',
+                        help='where files are written before an upload to S3')
+    parser.add_argument('--jsonpaths', dest='jsonpaths', default=LOG_JSONPATHS,
+                        help='jsonpaths file applied to staging_events')
+    parser.add_argument('--workers', dest='workers', type=int, default=None,
+                        help='worker processes, defaults to the CPU count up to {}'.format(
+                            MAX_WORKERS))
+    parser.add_argument('--target-mb', dest='target_mb', type=float, default=TARGET_BYTES / 2 ** 20,
+                        help='JSON megabytes per Parquet file')
+    add_backend_argument(parser)
+    args = parser.parse_args()
+    main(args)
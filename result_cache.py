@@ -0,0 +1,202 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+
+from config import config
+from streaming import unique_columns
+
+ROOT_PATH = os.path.dirname(os.path.abspath(__file__))
+TABLE_RE = re.compile(r'\b(?:FROM|JOIN)\s+(\w+)', re.IGNORECASE)
+
+
+def normalize_sql(query):
+    """ Query text without comments, repeated whitespace or a trailing ; """
+    query = re.sub(r'--[^\n]*', '', query)
+    return ' '.join(query.split()).rstrip(';').strip()
+
+
+def referenced_tables(query):
+    """ Tables a query reads, excluding CTE names """
+    ctes = {name.lower() for name in re.findall(r'(\w+)\s+AS\s*\(', query, re.IGNORECASE)}
+    return sorted({t.lower() for t in TABLE_RE.findall(query)} - ctes)
+
+
+def cache_dir(config=config, scope=None):
+    """
+    Directory of the result cache, [CACHE] DIR
+
+    Args:
+        config: config object
+        scope: database the results come from, e.g. Backend.scope; each gets
+            its own subdirectory, so backends never serve each other's results
+    """
+    path = config.get('CACHE', 'DIR', fallback=os.path.join(ROOT_PATH, '.cache', 'results'))
+    path = os.path.join(ROOT_PATH, path) if not os.path.isabs(path) else path
+    return os.path.join(path, scope) if scope else path
+
+
+def _write_json(path, data):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def load_versions(directory=None):
+    """ Per-table load versions written by the ETL """
+    return _read_json(os.path.join(directory or cache_dir(), 'load_versions.json'))
+
+
+def bump_load_versions(tables, directory=None):
+    """
+    Mark tables as reloaded, which invalidates every cached result reading them
+
+    Args:
+        tables: names of the tables the ETL just loaded
+        directory: cache directory, defaults to [CACHE] DIR
+    """
+    directory = directory or cache_dir()
+    os.makedirs(directory, exist_ok=True)
+    versions = load_versions(directory)
+    for table in tables:
+        versions[table.lower()] = versions.get(table.lower(), 0) + 1
+    _write_json(os.path.join(directory, 'load_versions.json'), versions)
+    logging.info('Bumped load versions of {}'.format(', '.join(tables)))
+
+
+class ResultCache:
+    """
+    On-disk cache of query results as Arrow IPC files, keyed on normalized
+    SQL and parameters. Entries expire after ttl seconds, the least recently
+    used are evicted beyond max_entries, and an entry is stale as soon as the
+    load version of any table it reads has changed.
+    """
+
+    def __init__(self, directory=None, ttl=86400, max_entries=64, max_rows=100000):
+        self.directory = directory or cache_dir()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.index_path = os.path.join(self.directory, 'index.json')
+        os.makedirs(self.directory, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config=config, scope=None):
+        return cls(directory=cache_dir(config, scope),
+                   ttl=config.getint('CACHE', 'TTL', fallback=86400),
+                   max_entries=config.getint('CACHE', 'MAX_ENTRIES', fallback=64),
+                   max_rows=config.getint('CACHE', 'MAX_ROWS', fallback=100000))
+
+    @staticmethod
+    def key(query, params=None):
+        text = normalize_sql(query) + '\x00' + json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.arrow')
+
+    def get(self, query, params=None):
+        """
+        Cached result of a query
+
+        Returns:
+            pandas DataFrame, or None on a miss
+        """
+        import pyarrow as pa
+
+        key = self.key(query, params)
+        index = _read_json(self.index_path)
+        entry = index.get(key)
+        if entry is None or not os.path.exists(self._path(key)):
+            return None
+        versions = load_versions(self.directory)
+        if time.time() - entry['created'] > self.ttl or \
+                any(versions.get(t, 0) != v for t, v in entry['versions'].items()):
+            self._evict(index, key)
+            _write_json(self.index_path, index)
+            return None
+
+        with pa.memory_map(self._path(key)) as source:
+            frame = pa.ipc.open_file(source).read_all().to_pandas()
+        entry['last_access'] = time.time()
+        _write_json(self.index_path, index)
+        return frame
+
+    def put(self, query, frame, params=None):
+        """
+        Store a query result, unless it is larger than max_rows
+
+        Args:
+            query: SQL text
+            frame: pandas DataFrame with the full result
+            params: query parameters
+        """
+        import pyarrow as pa
+
+        if len(frame) > self.max_rows:
+            return
+        key = self.key(query, params)
+        table = pa.Table.from_pandas(unique_columns(frame), preserve_index=False)
+        tmp = self._path(key) + '.tmp'
+        with pa.OSFile(tmp, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, self._path(key))
+
+        versions = load_versions(self.directory)
+        index = _read_json(self.index_path)
+        now = time.time()
+        index[key] = dict(created=now, last_access=now, rows=len(frame),
+                          versions={t: versions.get(t, 0) for t in referenced_tables(query)})
+        for old in sorted(index, key=lambda k: index[k]['last_access'])[:-self.max_entries]:
+            self._evict(index, old)
+        _write_json(self.index_path, index)
+
+    def record(self, query, chunks, params=None):
+        """
+        Pass DataFrame chunks through and cache the complete result once they
+        are exhausted. Results over max_rows are streamed but not cached, and
+        a result that fails to cache is only logged, the query did not fail.
+
+        Yields:
+            the chunks, unchanged
+        """
+        import pandas as pd
+
+        frames, rows = [], 0
+        for frame in chunks:
+            rows += len(frame)
+            if frames is not None and rows <= self.max_rows:
+                frames.append(frame)
+            else:
+                frames = None
+            yield frame
+        if frames is not None:
+            try:
+                self.put(query, pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(),
+                         params)
+            except Exception as e:
+                logging.warning('Result not cached: {}'.format(e))
+
+    def _evict(self, index, key):
+        index.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for key in list(_read_json(self.index_path)):
+            self._evict({}, key)
+        _write_json(self.index_path, {})
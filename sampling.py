@@ -0,0 +1,231 @@
+import heapq
+import logging
+import random
+
+from schema import ddl_columns
+from sql_queries import SAMPLE_SIZE, sample_changed_rows, sample_table_create, \
+    sample_table_delete, sample_table_offer, sample_table_status, sample_table_trim, \
+    sampled_tables
+
+# Rows requested from the sampling clause per row wanted, so a sample of
+# pages or vectors still yields enough rows after LIMIT
+OVERSAMPLE = 4
+
+# DuckDB system sampling keeps or skips whole vectors of this many rows
+DUCKDB_VECTOR_SIZE = 2048
+
+row_estimate_queries = {
+    'redshift': "SELECT tbl_rows FROM svv_table_info WHERE \"table\" = %s;",
+    'postgres': "SELECT reltuples::BIGINT FROM pg_class WHERE relname = %s;",
+    'duckdb':   "SELECT estimated_size FROM duckdb_tables() WHERE table_name = ?;",
+}
+
+table_exists_query = "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = %s;"
+
+
+def backend_name(cur):
+    """ 'redshift', 'postgres' or 'duckdb' for the connection behind a cursor """
+    conn = getattr(cur, 'connection', None)
+    if conn is None:
+        return 'duckdb'
+    return 'redshift' if getattr(conn, 'is_redshift', False) else 'postgres'
+
+
+def estimate_rows(cur, table, backend):
+    """
+    Row count of a table from the catalog statistics, without scanning it
+
+    Returns:
+        estimated rows, or None if the catalog has no estimate
+    """
+    query = row_estimate_queries.get(backend)
+    if query is None:
+        return None
+    cur.execute(query, (table,))
+    row = cur.fetchone()
+    return int(row[0]) if row and row[0] is not None and row[0] >= 0 else None
+
+
+def sample_query(table, n, backend, rows=None, boost=1):
+    """
+    Cheapest sampling statement the backend supports. None of them sorts a
+    table that has more than n * OVERSAMPLE * boost rows.
+
+    * postgres: TABLESAMPLE SYSTEM reads whole random pages only
+    * duckdb: system sampling of whole vectors
+    * redshift has no TABLESAMPLE: filter on RANDOM() at the rate that
+      yields about n rows and stop at LIMIT n. It still scans the table,
+      which is why refresh_samples keeps a sample at load time.
+    * tables small enough to be read whole are shuffled with ORDER BY RANDOM()
+
+    Args:
+        table: table name
+        n: rows wanted
+        backend: 'redshift', 'postgres' or 'duckdb'
+        rows: table size, if known
+        boost: multiplies the sampling rate, for retries that came back short
+    Returns:
+        SELECT statement
+    """
+    percent = 100.0 if not rows else min(100.0, 100.0 * n * OVERSAMPLE * boost / rows)
+    if percent >= 100.0:
+        return 'SELECT * FROM {} ORDER BY RANDOM() LIMIT {};'.format(table, n)
+    if backend == 'postgres':
+        return 'SELECT * FROM {} TABLESAMPLE SYSTEM ({:.6f}) LIMIT {};'.format(table, percent, n)
+    if backend == 'duckdb':
+        percent = min(100.0, max(percent, 100.0 * DUCKDB_VECTOR_SIZE * OVERSAMPLE * boost / rows))
+        return 'SELECT * FROM {} USING SAMPLE {:.6f}% (system) LIMIT {};'.format(table, percent, n)
+    return 'SELECT * FROM {} WHERE RANDOM() < {:.8f} LIMIT {};'.format(table, percent / 100.0, n)
+
+
+def table_exists(cur, table):
+    cur.execute(table_exists_query, (table,))
+    return cur.fetchone()[0] > 0
+
+
+def count_rows(cur, table):
+    cur.execute('SELECT COUNT(*) FROM {};'.format(table))
+    return cur.fetchone()[0]
+
+
+def sample_rows(cur, table, n=20):
+    """
+    Fetch about n random rows of a table: the lowest priorities of its
+    <table>_sample if the loads keep one, else a sample drawn by the
+    backend. A sample that comes back short is retried at a ten times
+    higher rate, and returned short after that rather than padded with
+    rows that are not random.
+
+    Args:
+        cur: cursor to the db connection
+        table: table name
+        n: rows wanted
+    Returns:
+        (column names, list of rows)
+    """
+    sample_table = '{}_sample'.format(table)
+    if table_exists(cur, sample_table):
+        cur.execute('SELECT * FROM {} ORDER BY sample_priority LIMIT {};'.format(sample_table, n))
+        names = [column[0] for column in cur.description]
+        rows = cur.fetchall()
+        if rows:
+            keep = [i for i, name in enumerate(names) if name.lower() != 'sample_priority']
+            return [names[i] for i in keep], [tuple(row[i] for i in keep) for row in rows]
+
+    backend = backend_name(cur)
+    rows = estimate_rows(cur, table, backend)
+    if rows is None:
+        rows = count_rows(cur, table)
+    sample = []
+    for boost in (1, 10, 100):
+        query = sample_query(table, n, backend, rows, boost)
+        logging.info('Sample of data in final tables. {}'.format(query))
+        cur.execute(query)
+        sample = cur.fetchall()
+        if len(sample) >= n or 'ORDER BY RANDOM()' in query:
+            break
+    return [column[0] for column in cur.description], sample
+
+
+def refresh_samples(cur, tables=None, params=None, ddl=lambda q: [q]):
+    """
+    Maintain the <table>_sample of sampled tables after a load. Not committed.
+
+    A full refresh offers every row at the rate that yields about
+    SAMPLE_SIZE * OVERSAMPLE of them. An incremental one (params given)
+    deletes the sample entries of the rows in sample_changed_rows and offers
+    those rows again below the highest priority the sample held, so the
+    sample stays the rows below that priority. Samples not full yet, and the
+    tables without changed rows, are recomputed.
+
+    Args:
+        cur: cursor to the db connection
+        tables: names of sampled_tables to refresh, all of them if None
+        params: dict with the max_ts of an incremental load, None for a full refresh
+        ddl: translates the CREATE TABLE into statements for the backend, e.g. Backend.ddl
+    """
+    for table in tables or sampled_tables:
+        for query in ddl(sample_table_create(table)):
+            cur.execute(query)
+        columns = ', '.join(name for name, _, _ in ddl_columns(sampled_tables[table]))
+        where = sample_changed_rows.get(table) if params is not None else None
+        if where:
+            cur.execute(sample_table_status.format(table=table))
+            kept, threshold = cur.fetchone()
+            if kept < SAMPLE_SIZE:
+                where = None
+        if where:
+            where = '\n             WHERE ' + where
+            _execute(cur, sample_table_delete.format(table=table, where=where), params)
+        else:
+            rows = count_rows(cur, table)
+            threshold = min(1.0, float(SAMPLE_SIZE * OVERSAMPLE) / max(rows, 1))
+            cur.execute(sample_table_delete.format(table=table, where=''))
+            where = ''
+        _execute(cur, sample_table_offer.format(table=table, columns=columns, where=where,
+                                                threshold=repr(float(threshold)),
+                                                size=SAMPLE_SIZE), params)
+        cur.execute(sample_table_trim.format(table=table, size=SAMPLE_SIZE))
+        logging.info('Sample of {} refreshed'.format(table))
+
+
+def _execute(cur, query, params):
+    # DuckDB rejects parameters a statement does not use
+    if '%(' in query:
+        cur.execute(query, params)
+    else:
+        cur.execute(query)
+
+
+def store_sample(cur, table, columns, sample, ddl=lambda q: [q]):
+    """
+    Replace the <table>_sample of a table with a sample drawn while loading
+    it, e.g. by a Reservoir. Not committed.
+
+    Args:
+        cur: cursor to the db connection
+        table: one of sampled_tables
+        columns: names of the values of the sampled rows, in order
+        sample: list of (priority, values) tuples
+        ddl: translates the CREATE TABLE into statements for the backend, e.g. Backend.ddl
+    """
+    for query in ddl(sample_table_create(table)):
+        cur.execute(query)
+    cur.execute(sample_table_delete.format(table=table, where=''))
+    insert = 'INSERT INTO {}_sample ({}, sample_priority) VALUES ({});'.format(
+        table, ', '.join(columns), ', '.join(['%s'] * (len(columns) + 1)))
+    for priority, values in sample:
+        cur.execute(insert, tuple(values) + (priority,))
+
+
+class Reservoir:
+    """
+    Uniform sample of fixed size over a stream of unknown length. Every item
+    gets a random priority and the size lowest are kept (bottom-k), the same
+    rule as the <table>_sample tables, so a sample drawn while loading can
+    be stored as one for free.
+    """
+
+    def __init__(self, size=SAMPLE_SIZE, seed=None):
+        self.size = size
+        self.seen = 0
+        self._heap = []
+        self._rng = random.Random(seed)
+
+    def add(self, item):
+        self.seen += 1
+        priority = self._rng.random()
+        if len(self._heap) < self.size:
+            heapq.heappush(self._heap, (-priority, self.seen, item))
+        elif priority < -self._heap[0][0]:
+            heapq.heapreplace(self._heap, (-priority, self.seen, item))
+
+    @property
+    def sample(self):
+        """ (priority, item) tuples, lowest priority first """
+        return sorted(((-priority, item) for priority, _, item in self._heap),
+                      key=lambda entry: entry[0])
+
+    @property
+    def items(self):
+        return [item for _, item in self.sample]
@@ -0,0 +1,241 @@
+import logging
+import re
+import time
+
+COLUMN_RE = re.compile(r'^\s*(\w+)\s+(DOUBLE PRECISION|[A-Za-z]+\w*)(?:\((\d+)\))?',
+                       re.IGNORECASE)
+TABLE_RE = re.compile(r'CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)', re.IGNORECASE)
+CHANGED_TABLE_RE = re.compile(
+    r'\b(?:CREATE|DROP|ALTER)\s+TABLE\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)', re.IGNORECASE)
+IDENTITY_RE = re.compile(r'(\w+)\s+(\w+)\s+IDENTITY\s*\(\s*(\d+)\s*,\s*\d+\s*\)', re.IGNORECASE)
+CONSTRAINTS = ('PRIMARY', 'UNIQUE', 'FOREIGN', 'CONSTRAINT')
+
+# DDL type -> information_schema.columns.data_type
+INFORMATION_SCHEMA_TYPES = {
+    'SMALLINT':         'smallint',
+    'INTEGER':          'integer',
+    'INT':              'integer',
+    'BIGINT':           'bigint',
+    'REAL':             'real',
+    'FLOAT':            'double precision',
+    'DOUBLE PRECISION': 'double precision',
+    'BOOLEAN':          'boolean',
+    'DATE':             'date',
+    'TIMESTAMP':        'timestamp without time zone',
+    'VARCHAR':          'character varying',
+    'CHAR':             'character',
+    'TEXT':             'text',
+}
+
+# Column attributes that ALTER TABLE ADD COLUMN can't add to an existing table
+RECREATE_ATTRIBUTES = re.compile(r'\b(IDENTITY|PRIMARY\s+KEY|NOT\s+NULL|DISTKEY|SORTKEY)\b',
+                                 re.IGNORECASE)
+
+existing_columns_query = """
+    SELECT table_name, column_name, data_type, character_maximum_length
+      FROM information_schema.columns
+     WHERE table_schema = current_schema()
+     ORDER BY table_name, ordinal_position;
+"""
+
+
+def split_columns(ddl):
+    """
+    Split the body of a CREATE TABLE statement on its top-level commas
+
+    Args:
+        ddl: CREATE TABLE statement
+    Returns:
+        list of column and constraint definitions
+    """
+    body = ddl[ddl.index('(') + 1:ddl.rindex(')')]
+    parts, depth, current = [], 0, ''
+    for char in body:
+        if char == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+            continue
+        depth += {'(': 1, ')': -1}.get(char, 0)
+        current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def table_name(ddl):
+    """ Name of the table a CREATE TABLE statement creates """
+    return TABLE_RE.search(ddl).group(1).lower()
+
+
+def ddl_columns(ddl):
+    """
+    Parse the column names and types out of a CREATE TABLE statement
+
+    Args:
+        ddl: CREATE TABLE statement from sql_queries
+    Returns:
+        list of (name, type, length) tuples, length is None unless declared
+    """
+    columns = []
+    for definition in split_columns(ddl):
+        match = COLUMN_RE.match(definition)
+        if match and match.group(1).upper() not in CONSTRAINTS:
+            name, col_type, length = match.groups()
+            columns.append((name, col_type.upper(), int(length) if length else None))
+    return columns
+
+
+def postgres_ddl(ddl):
+    """
+    Strip the Redshift-only clauses from a CREATE TABLE statement. Primary
+    keys are dropped too, Redshift declares but never enforces them.
+    """
+    ddl = re.sub(r'\bIDENTITY\s*\(\s*\d+\s*,\s*\d+\s*\)', 'GENERATED BY DEFAULT AS IDENTITY',
+                 ddl, flags=re.IGNORECASE)
+    ddl = re.sub(r'\b(DISTKEY|SORTKEY)\b(\s*\([^)]*\))?', '', ddl, flags=re.IGNORECASE)
+    ddl = re.sub(r'\bPRIMARY\s+KEY\b', '', ddl, flags=re.IGNORECASE)
+    ddl = re.sub(r'\b(DISTSTYLE|ENCODE)\s+\w+', '', ddl, flags=re.IGNORECASE)
+    return TABLE_RE.sub(lambda m: 'CREATE TABLE IF NOT EXISTS ' + m.group(1), ddl, count=1)
+
+
+def duckdb_ddl(ddl):
+    """
+    Translate a CREATE TABLE statement for DuckDB, which has no IDENTITY
+    columns: each one is backed by a sequence instead
+
+    Returns:
+        list of statements
+    """
+    table = table_name(ddl)
+    statements = []
+
+    def sequence(match):
+        name = sequence_name(table, match.group(1))
+        statements.append('CREATE SEQUENCE IF NOT EXISTS {} MINVALUE {} START {};'.format(
+            name, match.group(3), match.group(3)))
+        return '{} {} DEFAULT nextval(\'{}\')'.format(match.group(1), match.group(2), name)
+
+    ddl = IDENTITY_RE.sub(sequence, ddl)
+    return statements + [postgres_ddl(ddl)]
+
+
+def sequence_name(table, column):
+    """ Sequence duckdb_ddl backs an IDENTITY column with """
+    return '{}_{}_seq'.format(table, column)
+
+
+def duckdb_sequence_drops(create_queries):
+    """
+    Drop the sequences duckdb_ddl creates for the given CREATE TABLE
+    statements, so a rebuilt table numbers its rows from the start again.
+    Run after the tables are dropped: DuckDB keeps a sequence a column
+    default uses.
+
+    Returns:
+        list of statements
+    """
+    return ['DROP SEQUENCE IF EXISTS {};'.format(sequence_name(table_name(ddl), match.group(1)))
+            for ddl in create_queries for match in IDENTITY_RE.finditer(ddl)]
+
+
+def same_type(declared, existing):
+    """
+    Whether a declared column matches what information_schema reports.
+    Redshift stores TEXT as VARCHAR(256).
+    """
+    _, col_type, length = declared
+    data_type, max_length = existing
+    if col_type == 'TEXT':
+        return data_type == 'text' or (data_type == 'character varying' and max_length == 256)
+    if INFORMATION_SCHEMA_TYPES.get(col_type) != data_type:
+        return False
+    return length is None or max_length is None or int(length) == int(max_length)
+
+
+def existing_schema(cur):
+    """
+    Columns of every table in the current schema
+
+    Returns:
+        dict of table -> list of (column, data_type, character_maximum_length)
+    """
+    cur.execute(existing_columns_query)
+    tables = {}
+    for table, column, data_type, max_length in cur.fetchall():
+        tables.setdefault(table.lower(), []).append((column.lower(), data_type, max_length))
+    return tables
+
+
+def plan_changes(create_queries, drop_queries, existing):
+    """
+    Diff the desired DDL against the existing schema
+
+    Args:
+        create_queries: CREATE TABLE statements, in dependency order
+        drop_queries: DROP TABLE statements, used for tables that must be rebuilt
+        existing: result of existing_schema
+    Returns:
+        list of statements that bring the schema up to date, empty if it is
+    """
+    drops = {re.search(r'EXISTS\s+(\w+)', q).group(1).lower(): q for q in drop_queries}
+    changes = []
+    for ddl in create_queries:
+        table = table_name(ddl)
+        if table not in existing:
+            changes.append(ddl)
+            continue
+
+        declared = {column[0].lower(): column for column in ddl_columns(ddl)}
+        current = {name: (data_type, length) for name, data_type, length in existing[table]}
+        definitions = {COLUMN_RE.match(d).group(1).lower(): d for d in split_columns(ddl)
+                       if COLUMN_RE.match(d)}
+
+        added = [name for name in declared if name not in current]
+        dropped = [name for name in current if name not in declared]
+        retyped = [name for name in declared
+                   if name in current and not same_type(declared[name], current[name])]
+        if retyped or any(RECREATE_ATTRIBUTES.search(definitions[name]) for name in added):
+            logging.warning('Rebuilding {}: {} changed'.format(table, retyped or added))
+            changes.extend([drops.get(table, 'DROP TABLE IF EXISTS {};'.format(table)), ddl])
+            continue
+        changes.extend('ALTER TABLE {} ADD COLUMN {};'.format(table, definitions[name])
+                       for name in added)
+        changes.extend('ALTER TABLE {} DROP COLUMN {};'.format(table, name) for name in dropped)
+    return changes
+
+
+def changed_tables(changes):
+    """ Tables the statements of plan_changes create, drop or alter """
+    return sorted({CHANGED_TABLE_RE.search(query).group(1).lower() for query in changes
+                   if CHANGED_TABLE_RE.search(query)})
+
+
+def apply_schema(cur, conn, create_queries, drop_queries):
+    """
+    Bring the schema in line with the desired DDL in a single transaction.
+    An up-to-date schema costs one information_schema query and no commit.
+
+    Args:
+        cur: cursor to the db connection
+        conn: db connection
+        create_queries: CREATE TABLE statements, in dependency order
+        drop_queries: DROP TABLE statements
+    Returns:
+        list of statements that were applied
+    """
+    start = time.perf_counter()
+    changes = plan_changes(create_queries, drop_queries, existing_schema(cur))
+    if not changes:
+        conn.rollback()
+        print('Schema up to date ({:.0f} ms).'.format((time.perf_counter() - start) * 1000))
+        return changes
+    try:
+        for query in changes:
+            logging.info('Apply {}'.format(query))
+            cur.execute(query)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    print('Applied {} schema changes in {:.2f}s.'.format(len(changes), time.perf_counter() - start))
+    return changes
@@ -0,0 +1,163 @@
+import argparse
+import json
+import logging
+import math
+
+from config import SLICES_PER_NODE, config, config_file, write_config
+from parquet_converter import list_inputs
+
+# Compute node types: (storage per node in GB, on-demand USD per node-hour in
+# us-east-1, fewest nodes, most nodes). ra3 storage is Redshift managed storage.
+# https://aws.amazon.com/redshift/pricing/
+# https://docs.aws.amazon.com/redshift/latest/mgmt/working-with-clusters.html
+NODE_TYPES = {
+    'dc2.large':    (160, 0.25, 1, 32),
+    'dc2.8xlarge':  (2560, 4.80, 2, 128),
+    'ra3.xlplus':   (32768, 1.086, 1, 16),
+    'ra3.4xlarge':  (131072, 3.26, 2, 32),
+    'ra3.16xlarge': (131072, 13.04, 2, 128),
+}
+
+# Speedup on n slices is n ** SCALING_EFFICIENCY; 1.0 would be linear
+SCALING_EFFICIENCY = 0.7
+# Disk needed per byte of raw JSON: staging plus the star schema, less compression
+STORAGE_PER_BYTE = 2.0
+
+
+def data_volume(sources):
+    """
+    Files and bytes under each input
+
+    Args:
+        sources: zip files, local directories or s3:// prefixes; [S3] ENDPOINT_URL
+            lists the prefixes through a local S3 stand-in
+    Returns:
+        list of (source, files, bytes) tuples
+    """
+    volume = []
+    for source in sources:
+        inputs = list_inputs(source)
+        volume.append((source, len(inputs), sum(size for _, size in inputs)))
+        logging.info('{}: {} files, {} bytes'.format(*volume[-1]))
+    return volume
+
+
+def read_throughput(bench_path):
+    """
+    Single-stream throughput measured by bench.py, from its largest load
+
+    Returns:
+        dict with bytes_per_second and bytes_per_row of the load and
+        rows_per_second of the star schema build
+    """
+    with open(bench_path) as f:
+        results = json.load(f)
+    result = max(results, key=lambda r: r['load']['bytes'])
+    return dict(bytes_per_second=result['load']['bytes_per_second'],
+                bytes_per_row=result['load']['bytes'] / float(result['load']['rows']),
+                rows_per_second=result['build']['rows_per_second'],
+                engine=result['engine'], scale=result['scale'])
+
+
+def estimate(volume, throughput, node_type, nodes, efficiency=SCALING_EFFICIENCY):
+    """
+    Seconds to COPY and transform the data on a cluster. Every slice is taken
+    to run as fast as the benchmark's single stream; a COPY spreads files over
+    slices, so fewer files than slices leaves slices idle.
+
+    Args:
+        volume: list of (source, files, bytes)
+        throughput: from read_throughput
+        node_type: key of NODE_TYPES
+        nodes: number of compute nodes
+        efficiency: speedup on n slices is n ** efficiency
+    Returns:
+        (copy seconds, transform seconds)
+    """
+    slices = nodes * SLICES_PER_NODE[node_type]
+    scaling = slices ** efficiency
+    copy = 0.0
+    for _, files, size in volume:
+        parallel = min(slices, max(files, 1)) ** efficiency
+        copy += size / (throughput['bytes_per_second'] * parallel)
+    rows = sum(size for _, _, size in volume) / throughput['bytes_per_row']
+    return copy, rows / (throughput['rows_per_second'] * scaling)
+
+
+def plan(volume, throughput, window, efficiency=SCALING_EFFICIENCY, node_types=NODE_TYPES):
+    """
+    Every node type and count that holds the data and loads it within the window
+
+    Args:
+        volume: list of (source, files, bytes)
+        throughput: from read_throughput
+        window: target load time in seconds
+        efficiency: speedup on n slices is n ** efficiency
+        node_types: dict like NODE_TYPES
+    Returns:
+        list of (USD per hour, load seconds, node type, nodes) tuples, cheapest
+        first; the fastest configuration alone if none meets the window
+    """
+    needed_gb = sum(size for _, _, size in volume) * STORAGE_PER_BYTE / 2 ** 30
+    options = []
+    for node_type, (storage_gb, price, fewest, most) in node_types.items():
+        nodes = max(fewest, int(math.ceil(needed_gb / storage_gb)))
+        for nodes in range(nodes, most + 1):
+            seconds = sum(estimate(volume, throughput, node_type, nodes, efficiency))
+            options.append((price * nodes, seconds, node_type, nodes))
+    fitting = sorted(o for o in options if o[1] <= window)
+    return fitting or [min(options, key=lambda o: (o[1], o[0]))]
+
+
+def main(args):
+    sources = args.sources or [s for s in (config['S3'].get('LOG_DATA'),
+                                           config['S3'].get('SONG_DATA')) if s]
+    volume = data_volume(sources)
+    throughput = read_throughput(args.bench)
+    files, size = sum(v[1] for v in volume), sum(v[2] for v in volume)
+    print('{} files, {:.1f} MB; {:.1f} MB/s per slice measured on {} at scale {}.'.format(
+        files, size / 2 ** 20, throughput['bytes_per_second'] / 2 ** 20, throughput['engine'],
+        throughput['scale']))
+
+    node_type = config['CLUSTER'].get('DWH_NODE_TYPE', 'dc2.large')
+    nodes = int(config['CLUSTER'].get('DWH_NUM_NODES', 1))
+    copy, transform = estimate(volume, throughput, node_type, nodes, args.efficiency)
+    print('Now {} x {}: COPY {:.1f}s + transform {:.1f}s, ${:.2f}/hour.'.format(
+        nodes, node_type, copy, transform, NODE_TYPES.get(node_type, (0, 0))[1] * nodes))
+
+    options = plan(volume, throughput, args.window, args.efficiency)
+    if options[0][1] > args.window:
+        print('No configuration loads within {:.0f}s, the fastest is:'.format(args.window))
+    print('  {:>9} {:>10} {:<14} {:>5}'.format('$/hour', 'load s', 'node type', 'nodes'))
+    for price, seconds, option_type, option_nodes in options[:args.top]:
+        print('  {:9.2f} {:10.1f} {:<14} {:>5}'.format(price, seconds, option_type, option_nodes))
+
+    _, _, node_type, nodes = options[0]
+    if args.apply:
+        write_config({'CLUSTER': {
+            'DWH_NODE_TYPE': node_type,
+            'DWH_NUM_NODES': str(nodes),
+            'DWH_CLUSTER_TYPE': 'single-node' if nodes == 1 else 'multi-node',
+        }}, args.config_file)
+        print('{} updated: {} x {}.'.format(args.config_file, nodes, node_type))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Recommend the cheapest node type and count that loads the data in time')
+    parser.add_argument('--source', dest='sources', action='append', default=[],
+                        help='zip, local directory or s3:// prefix (repeatable), '
+                             'defaults to [S3] LOG_DATA and SONG_DATA')
+    parser.add_argument('--bench', dest='bench', default='bench.json',
+                        help='results of bench.py --output')
+    parser.add_argument('--window', dest='window', type=float, default=3600,
+                        help='target load time in seconds')
+    parser.add_argument('--efficiency', dest='efficiency', type=float, default=SCALING_EFFICIENCY,
+                        help='speedup on n slices is n ** efficiency, 1 is linear')
+    parser.add_argument('--top', dest='top', type=int, default=5)
+    parser.add_argument('--apply', dest='apply', default=False, action='store_true',
+                        help='write the recommendation to [CLUSTER] of the config file')
+    parser.add_argument('--config', dest='config_file', default=config_file)
+    args = parser.parse_args()
+    main(args)
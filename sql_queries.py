@@ -1,73 +1,159 @@
-import configparser
-from create_cluster import config_file
 import psycopg2
 import logging
+from config import GRANULARITY_SECONDS
+from db import connect
+from schema import ddl_columns
 
 
 # CONFIG
-config = configparser.ConfigParser()
-config.read(config_file)
-
-ARN             = config['IAM_ROLE']['ARN']
-LOG_DATA        = config['S3']['LOG_DATA']
-LOG_JSONPATH    = config['S3']['LOG_JSONPATH']
-SONG_DATA       = config['S3']['SONG_DATA']
-SONGS_JSONPATH  = config['S3']['SONGS_JSONPATH']
+# Statements that depend on dwh.cfg are built by functions taking a
+# config.Settings, e.g. copy_table_queries(config.settings), so importing
+# the module does not read the file.
 
 
 def create_connection():
     """Creates Redshift Connection
 
+    Prefer db.session(), which reuses pooled connections.
+
     Returns:
         SQL Connection Object: Cursor and Connection objects used to execute queries
     """
-    # Variables to create connection to Redshift Cluster
-    host =          config.get('DB', 'HOST')
-    db_name =       config.get('DB', 'DB_NAME')
-    db_username =   config.get('DB', 'DB_USER')
-    db_password =   config.get('DB', 'DB_PASSWORD')
-    port =          config.getint('DB', 'DB_PORT')
-
-    # Connecting to Redshift Cluster
-    conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(host, db_name, db_username, db_password, port))
+    conn = connect()
     cur = conn.cursor()
     return cur, conn
 
 
 # STAGING TABLES
-# timeformat as 'epochmillisecs' 
-staging_events_copy = ("""
-COPY staging_events
-FROM {0}
-iam_role '{1}'
+# ts is converted from epoch millis to TIMESTAMP once, by the COPY.
+# COPY can't compute columns, so the JSON is copied into the unkeyed
+# staging_*_load tables, and keyed_insert_queries move the rows into the
+# staging tables with their match_key, straight onto the slice of their key.
+STAGING_EVENTS_COLUMNS = ('artist, auth, firstName, gender, itemInSession, lastName, length, '
+                          'level, location, method, page, registration, sessionId, song, status, '
+                          'ts, userAgent, userId')
+STAGING_SONGS_COLUMNS = ('num_songs, artist_id, artist_latitude, artist_longitude, '
+                         'artist_location, artist_name, song_id, title, duration, year')
+
+# {manifest} is empty, or the MANIFEST option of a sharded COPY
+staging_events_json_copy = ("""
+COPY staging_events_load ({columns})
+FROM {source}
+iam_role '{arn}'
 region 'us-west-2'
-json {2}
-                      
+json {jsonpath}{manifest}
+TIMEFORMAT 'epochmillisecs'
+MAXERROR {max_errors}
 BLANKSASNULL
 EMPTYASNULL
 TRUNCATECOLUMNS
-""").format(LOG_DATA, ARN, LOG_JSONPATH)
+""")
 
-staging_songs_copy = ("""
-    COPY staging_songs FROM {}
-    iam_role '{}'
-    region 'us-west-2'
-    JSON 'auto' MAXERROR 50
+staging_songs_json_copy = ("""
+    COPY staging_songs_load FROM {source}
+    iam_role '{arn}'
+    region 'us-west-2'{manifest}
+    JSON 'auto' MAXERROR {max_errors}
     TRUNCATECOLUMNS BLANKSASNULL EMPTYASNULL;
-""").format(SONG_DATA, ARN)
+""")
+
+# Parquet files carry typed columns in table order, match_key included
+staging_parquet_copy = ("""
+    COPY {table} FROM {source}
+    iam_role '{arn}'{manifest}
+    FORMAT AS PARQUET;
+""")
+
+
+def staging_copy(table, settings, manifest=False):
+    """
+    COPY for a staging table from its configured source: the Parquet of
+    parquet_converter.py, keyed already, straight into the table when set,
+    the JSON into its load table otherwise
+
+    Args:
+        table: 'staging_events' or 'staging_songs'
+        settings: config.Settings
+        manifest: COPY the files of a manifest instead of the whole source.
+            The statement then reads '{manifest}', filled in with
+            .format(manifest=url) for each shard (staging.shard_manifests).
+    Returns:
+        COPY statement
+    """
+    events = table == 'staging_events'
+    parquet = settings.parquet_log_data if events else settings.parquet_song_data
+    source = settings.log_data if events else settings.song_data
+    options = dict(source="'{manifest}'" if manifest else (parquet or source),
+                   manifest='\n    MANIFEST' if manifest else '',
+                   arn=settings.arn)
+    if parquet:
+        return staging_parquet_copy.format(table=table, **options)
+    if events:
+        return staging_events_json_copy.format(
+            columns=STAGING_EVENTS_COLUMNS, jsonpath=settings.log_jsonpath,
+            max_errors=settings.max_errors, **options)
+    return staging_songs_json_copy.format(max_errors=settings.max_errors, **options)
+
+
+def match_key(title, artist, duration):
+    """
+    SQL for the songplay match key: the first 60 bits of the MD5 of the
+    trimmed, lowercased title and artist and the rounded duration, as a
+    BIGINT. local_loader.match_key computes the same key in Python.
+    """
+    return ("STRTOL(LEFT(MD5(LOWER(TRIM({0})) || '|' || LOWER(TRIM({1})) || '|' || "
+            "CAST(CAST(FLOOR({2} + 0.5) AS BIGINT) AS VARCHAR)), 15), 16)").format(
+                title, artist, duration)
+
+
+def fallback_key(*parts):
+    """
+    SQL for the distribution key of a staging row without a match key: the
+    first 60 bits of the MD5 of the parts, negated so it never equals a
+    match key. local_loader.fallback_key computes the same key in Python.
+    """
+    return "-1 - STRTOL(LEFT(MD5({}), 15), 16)".format(" || '|' || ".join(
+        "COALESCE(CAST({} AS VARCHAR), '')".format(part) for part in parts))
 
 
+staging_events_keyed_insert = ("""
+    INSERT INTO staging_events ({columns}, match_key)
+    SELECT {columns},
+           COALESCE({match_key}, {fallback_key})
+      FROM staging_events_load;
+""").format(columns=STAGING_EVENTS_COLUMNS,
+            match_key=match_key('song', 'artist', 'length'),
+            fallback_key=fallback_key('sessionId', 'itemInSession'))
+
+staging_songs_keyed_insert = ("""
+    INSERT INTO staging_songs ({columns}, match_key)
+    SELECT {columns},
+           COALESCE({match_key}, {fallback_key})
+      FROM staging_songs_load;
+""").format(columns=STAGING_SONGS_COLUMNS,
+            match_key=match_key('title', 'artist_name', 'duration'),
+            fallback_key=fallback_key('song_id'))
+
 
 # DROP TABLES
 
 logging.info('Dropping tables ... ')
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events;"
 staging_songs_table_drop =  "DROP TABLE IF EXISTS staging_songs;"
+staging_events_load_drop =  "DROP TABLE IF EXISTS staging_events_load;"
+staging_songs_load_drop =   "DROP TABLE IF EXISTS staging_songs_load;"
 songplay_table_drop =       "DROP TABLE IF EXISTS songplay;"
 user_table_drop =           "DROP TABLE IF EXISTS users;"
+user_history_table_drop =   "DROP TABLE IF EXISTS users_history;"
 song_table_drop =           "DROP TABLE IF EXISTS songs;"
 artist_table_drop =         "DROP TABLE IF EXISTS artists;"
 time_table_drop =           "DROP TABLE  IF EXISTS time;"
+watermark_table_drop =      "DROP TABLE IF EXISTS etl_watermarks;"
+load_errors_table_drop =    "DROP TABLE IF EXISTS load_errors;"
+songplay_user_day_drop =    "DROP TABLE IF EXISTS songplay_user_day;"
+songplay_location_day_drop = "DROP TABLE IF EXISTS songplay_location_day;"
+songplay_song_day_drop =    "DROP TABLE IF EXISTS songplay_song_day;"
+songplay_hour_day_drop =    "DROP TABLE IF EXISTS songplay_hour_day;"
 
 
 
@@ -82,7 +168,7 @@ staging_events_table_create= ("""
         auth            VARCHAR(1024),
         firstName       VARCHAR(1024),
         gender          VARCHAR(1024),
-        itemInSession   INTEGER,
+        itemInSession   SMALLINT,
         lastName        VARCHAR(1024),
         length          REAL,
         level           VARCHAR(1024),
@@ -91,11 +177,12 @@ staging_events_table_create= ("""
         page            VARCHAR(1024) sortkey,
         registration    DOUBLE PRECISION,
         sessionId       INTEGER,
-        song            VARCHAR(1024) distkey,
-        status          INTEGER,
-        ts              BIGINT,
+        song            VARCHAR(1024),
+        status          SMALLINT,
+        ts              TIMESTAMP,
         userAgent       VARCHAR(65535),
-        userId          VARCHAR(1024)
+        userId          VARCHAR(1024),
+        match_key       BIGINT distkey
     );
 """)
 
@@ -108,24 +195,68 @@ staging_songs_table_create = ("""
         artist_location     VARCHAR(1024),
         artist_name         VARCHAR(1024),
         song_id             VARCHAR(1024),
-        title               VARCHAR(1024) distkey,
+        title               VARCHAR(1024),
         duration            REAL,
-        year                VARCHAR(1024)
+        year                SMALLINT,
+        match_key           BIGINT distkey
     );
 """)
 
+# The JSON COPYs land here, spread evenly, before keyed_insert_queries
+staging_events_load_create = ("""
+    CREATE TABLE staging_events_load (
+        artist          VARCHAR(1024),
+        auth            VARCHAR(1024),
+        firstName       VARCHAR(1024),
+        gender          VARCHAR(1024),
+        itemInSession   SMALLINT,
+        lastName        VARCHAR(1024),
+        length          REAL,
+        level           VARCHAR(1024),
+        location        VARCHAR(1024),
+        method          VARCHAR(1024),
+        page            VARCHAR(1024),
+        registration    DOUBLE PRECISION,
+        sessionId       INTEGER,
+        song            VARCHAR(1024),
+        status          SMALLINT,
+        ts              TIMESTAMP,
+        userAgent       VARCHAR(65535),
+        userId          VARCHAR(1024)
+    )
+    diststyle even;
+""")
+
+staging_songs_load_create = ("""
+    CREATE TABLE staging_songs_load (
+        num_songs           INTEGER,
+        artist_id           VARCHAR(1024),
+        artist_latitude     REAL,
+        artist_longitude    REAL,
+        artist_location     VARCHAR(1024),
+        artist_name         VARCHAR(1024),
+        song_id             VARCHAR(1024),
+        title               VARCHAR(1024),
+        duration            REAL,
+        year                SMALLINT
+    )
+    diststyle even;
+""")
+
 
 songplay_table_create = ("""
     CREATE TABLE songplay (
         songplay_id     BIGINT IDENTITY(0, 1) NOT NULL PRIMARY KEY, 
-        start_time      BIGINT, 
+        start_time      TIMESTAMP, 
+        time_key        INTEGER,
         user_id         TEXT DISTKEY, 
         level           TEXT,
         song_id         TEXT, 
         artist_id       TEXT, 
         session_id      INTEGER, 
         location        TEXT sortkey, 
-        user_agent      TEXT
+        user_agent      TEXT,
+        match_key       BIGINT
     );
 """)
 
@@ -141,13 +272,29 @@ user_table_create = ("""
 
 """)
 
+# Slowly changing dimension (type 2): one row per user and level period,
+# loaded when [ETL] USER_HISTORY is on
+user_history_table_create = ("""
+    CREATE TABLE users_history (
+        user_id         TEXT NOT NULL DISTKEY,
+        first_name      TEXT,
+        last_name       TEXT,
+        gender          TEXT,
+        level           TEXT,
+        valid_from      TIMESTAMP NOT NULL sortkey,
+        valid_to        TIMESTAMP,
+        is_current      BOOLEAN
+    );
+""")
+
 song_table_create = ("""
     CREATE TABLE songs (
         song_id         TEXT NOT NULL PRIMARY KEY  DISTKEY, 
         title           TEXT, 
         artist_id       TEXT, 
-        year            INTEGER,
-        duration        FLOAT
+        year            SMALLINT,
+        duration        FLOAT,
+        match_key       BIGINT
     );
     """
 )
@@ -165,38 +312,184 @@ artist_table_create = ("""
 
 time_table_create = ("""
     CREATE TABLE time (
-        start_time      BIGINT PRIMARY KEY, 
-        hour            INTEGER, 
-        day             INTEGER, 
-        week            INTEGER, 
-        month           INTEGER, 
-        year            INTEGER, 
-        weekday         INTEGER
+        time_key        INTEGER NOT NULL PRIMARY KEY sortkey,
+        start_time      TIMESTAMP, 
+        hour            SMALLINT, 
+        day             SMALLINT, 
+        week            SMALLINT, 
+        month           SMALLINT, 
+        year            SMALLINT, 
+        weekday         SMALLINT
+    )
+    diststyle all;
+""")
+
+
+
+# High-water mark per source for incremental loads
+watermark_table_create = ("""
+    CREATE TABLE IF NOT EXISTS etl_watermarks (
+        source          VARCHAR(256) NOT NULL PRIMARY KEY,
+        watermark       VARCHAR(1024),
+        updated_at      TIMESTAMP
+    )
+    diststyle all;
+""")
+
+# Records a COPY rejected, with their file and line, until the file is
+# reloaded. line_number 0 stands for a whole file whose COPY failed.
+load_errors_table_create = ("""
+    CREATE TABLE IF NOT EXISTS load_errors (
+        table_name      VARCHAR(128) NOT NULL,
+        filename        VARCHAR(1024) NOT NULL,
+        line_number     BIGINT,
+        colname         VARCHAR(128),
+        err_code        INTEGER,
+        err_reason      VARCHAR(1024),
+        raw_line        VARCHAR(1024),
+        raw_field_value VARCHAR(1024),
+        query_id        INTEGER,
+        recorded_at     TIMESTAMP NOT NULL,
+        resolved        BOOLEAN NOT NULL
     )
     diststyle all;
 """)
 
 
+# SONGPLAY ROLLUPS
+# Play counts per day and user, location, song or hour of day, maintained by
+# the ETL after every songplay insert so dashboards don't scan the fact table
+
+songplay_user_day_create = ("""
+    CREATE TABLE songplay_user_day (
+        day             DATE sortkey,
+        user_id         TEXT distkey,
+        plays           BIGINT
+    );
+""")
+
+songplay_location_day_create = ("""
+    CREATE TABLE songplay_location_day (
+        day             DATE sortkey,
+        location        TEXT,
+        plays           BIGINT
+    )
+    diststyle all;
+""")
+
+songplay_song_day_create = ("""
+    CREATE TABLE songplay_song_day (
+        day             DATE sortkey,
+        song_id         TEXT distkey,
+        plays           BIGINT
+    );
+""")
+
+songplay_hour_day_create = ("""
+    CREATE TABLE songplay_hour_day (
+        day             DATE sortkey,
+        hour            SMALLINT,
+        plays           BIGINT
+    )
+    diststyle all;
+""")
+
+
+
+# SAMPLES
+# <table>_sample keeps a uniform random sample of each table for the
+# analytics printout, so it never scans a table to sample it. Every row
+# offered gets a random sample_priority and the sample keeps the
+# SAMPLE_SIZE lowest (bottom-k). sampling.refresh_samples maintains them at
+# load time: recomputed after a full load or reload, and offered only the
+# changed rows of sample_changed_rows after an incremental one.
+SAMPLE_SIZE = 100
+
+sampled_tables = {
+    'staging_events':   staging_events_table_create,
+    'staging_songs':    staging_songs_table_create,
+    'songplay':         songplay_table_create,
+    'users':            user_table_create,
+    'songs':            song_table_create,
+    'artists':          artist_table_create,
+    'time':             time_table_create,
+}
+
+
+def sample_table_create(table):
+    """ CREATE TABLE statement of the sample of one of sampled_tables """
+    columns = ['        {:<20}{}'.format(name, '{}({})'.format(col_type, length) if length
+                                         else col_type)
+               for name, col_type, length in ddl_columns(sampled_tables[table])]
+    columns.append('        {:<20}DOUBLE PRECISION'.format('sample_priority'))
+    return '\n    CREATE TABLE IF NOT EXISTS {}_sample (\n{}\n    );\n'.format(
+        table, ',\n'.join(columns))
+
+
+sample_table_queries = [sample_table_create(table) for table in sampled_tables]
+sample_table_drops = ['DROP TABLE IF EXISTS {}_sample;'.format(table) for table in sampled_tables]
+
+# Rows whose sample entries an incremental load replaces. The other tables
+# are recomputed: staging holds only the new files, time is small.
+sample_changed_rows = {
+    'songplay': "start_time > %(max_ts)s",
+    'users':    "user_id IN (SELECT userId FROM staging_events WHERE page = 'NextSong')",
+    'songs':    "song_id IN (SELECT song_id FROM staging_songs)",
+    'artists':  "artist_id IN (SELECT artist_id FROM staging_songs)",
+}
+
+sample_table_status = "SELECT COUNT(*), MAX(sample_priority) FROM {table}_sample;"
+sample_table_delete = "DELETE FROM {table}_sample{where};"
+
+# Offer the rows of {where} whose priority is below {threshold}, the
+# highest one the sample keeps, then trim back to the lowest {size}
+sample_table_offer = ("""
+    INSERT INTO {table}_sample ({columns}, sample_priority)
+    SELECT {columns}, sample_priority
+      FROM (SELECT {columns}, RANDOM() AS sample_priority
+              FROM {table}{where}) AS offered
+     WHERE sample_priority < {threshold}
+     ORDER BY sample_priority
+     LIMIT {size};
+""")
+
+sample_table_trim = ("""
+    DELETE FROM {table}_sample
+     WHERE sample_priority > (SELECT MAX(sample_priority)
+                                FROM (SELECT sample_priority
+                                        FROM {table}_sample
+                                       ORDER BY sample_priority
+                                       LIMIT {size}) AS kept);
+""")
+
 
 # FINAL TABLES
-#  JOIN condition should be on song title, artist name and song duration.
+#  JOIN condition is on song title, artist name and song duration, through
+#  the match key both staging tables are distributed on. songs keeps the
+#  key, so incremental loads match new events against every known song.
+
+def time_key(column, granularity):
+    """ time dimension key of a TIMESTAMP expression, at a GRANULARITY_SECONDS granularity """
+    return 'CAST(FLOOR(EXTRACT(epoch FROM {}) / {}) AS INTEGER)'.format(
+        column, GRANULARITY_SECONDS[granularity])
+
 
-songplay_table_insert = ("""
-   INSERT INTO songplay (start_time, user_id, level, song_id, 
-            artist_id, session_id, location, user_agent)
+songplay_table_insert_template = ("""
+   INSERT INTO songplay (start_time, time_key, user_id, level, song_id, 
+            artist_id, session_id, location, user_agent, match_key)
     SELECT ts AS start_time, 
+           {time_key} AS time_key,
            e.userId AS user_id, 
            e.level AS level, 
            s.song_id AS song_id, 
            s.artist_id AS artist_id, 
            e.sessionId AS session_id, 
            e.location AS location, 
-           e.userAgent AS user_agent
+           e.userAgent AS user_agent,
+           e.match_key AS match_key
     FROM staging_events e
-    LEFT JOIN staging_songs s 
-    ON e.song = s.title
-    AND
-        e.artist = s.artist_name 
+    LEFT JOIN {songs} s 
+    ON e.match_key = s.match_key
    
     WHERE
       e.page = 'NextSong'
@@ -204,47 +497,73 @@ songplay_table_insert = ("""
 """)
 
 
+def songplay_table_insert(settings, songs='staging_songs'):
+    """ INSERT of the staged NextSong events, matched on match_key to the rows of songs """
+    return songplay_table_insert_template.format(
+        time_key=time_key('e.ts', settings.time_granularity), songs=songs)
 
 
-# user_table_insert = ("""
-#     INSERT INTO users
-#     WITH numbered_levels AS (
-#       SELECT ROW_NUMBER() over (PARTITION by userId ORDER BY ts DESC) AS row_num,
-#              userId AS user_id,
-#              firstName AS first_name, 
-#              lastName AS last_name, 
-#              gender, 
-#              level
-#         FROM staging_events
-#     )
-#     SELECT DISTINCT user_id, first_name, last_name, gender, level FROM numbered_levels
-#     WHERE row_num = 1 and user_id is not null
-    
-# """)
 
+
+# One row per user with the attributes of their latest event, picked by a
+# window over a single scan of staging
 user_table_insert = ("""
-     INSERT INTO users (user_id,
-     first_name,
-     last_name,
-     gender,
-     level)
-    SELECT  DISTINCT(userId)    AS user_id,
-            firstName           AS first_name,
-            lastName            AS last_name,
-            gender,
-            level
-    FROM staging_events
+    INSERT INTO users (user_id, first_name, last_name, gender, level)
+    SELECT user_id, first_name, last_name, gender, level
+      FROM (SELECT userId       AS user_id,
+                   firstName    AS first_name,
+                   lastName     AS last_name,
+                   gender,
+                   level,
+                   ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS row_num
+              FROM staging_events
+             WHERE page = 'NextSong'
+               AND userId IS NOT NULL) AS latest
+     WHERE row_num = 1;
+""")
 
-    WHERE page  =  'NextSong';
+# A new users_history version starts at every event whose level differs from
+# the user's previous one; it is valid until the next version starts.
+# {current} is the level each user had before the staged events, {filter}
+# restricts the events read.
+user_history_select = ("""
+    INSERT INTO users_history (user_id, first_name, last_name, gender, level,
+                               valid_from, valid_to, is_current)
+    WITH changes AS (
+        SELECT e.userId     AS user_id,
+               e.firstName  AS first_name,
+               e.lastName   AS last_name,
+               e.gender,
+               e.level,
+               e.ts,
+               COALESCE(LAG(e.level) OVER (PARTITION BY e.userId ORDER BY e.ts),
+                        {current}) AS previous_level
+          FROM staging_events e{join}
+         WHERE e.page = 'NextSong'
+           AND e.userId IS NOT NULL{filter}
+    ), versions AS (
+        SELECT user_id, first_name, last_name, gender, level,
+               ts AS valid_from,
+               LEAD(ts) OVER (PARTITION BY user_id ORDER BY ts) AS valid_to
+          FROM changes
+         WHERE previous_level IS NULL
+            OR previous_level <> level
+    )
+    SELECT user_id, first_name, last_name, gender, level, valid_from, valid_to,
+           valid_to IS NULL AS is_current
+      FROM versions;
 """)
 
+user_history_insert = user_history_select.format(current='NULL', join='', filter='')
+
 song_table_insert = ("""
     INSERT INTO songs 
     SELECT distinct song_id,
            title,
            artist_id,
-           CAST(year AS INTEGER),
-           duration
+           year,
+           duration,
+           match_key
       FROM staging_songs
       WHERE song_id IS NOT NULL
                      
@@ -263,30 +582,238 @@ artist_table_insert = ("""
 
 """)
 
-time_table_insert = ("""
-    INSERT INTO time 
-    SELECT DISTINCT ts AS start_time,
-           EXTRACT(hour     FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS hour,
-           EXTRACT(day      FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS day,
-           EXTRACT(week     FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS week,
-           EXTRACT(month    FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS month,
-           EXTRACT(year     FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS year,
-           EXTRACT(weekday  FROM timestamp 'epoch' + ts/1000 * interval '1 second') AS weekday
+# The time dimension is generated for whole key ranges rather than derived
+# from the events: one row per GRANULARITY step, keyed on its epoch seconds
+# divided by the step. Redshift runs generate_series on the leader node
+# only, so the keys come from a cross join of digits.
+def time_table_generate(first_key, last_key, granularity):
+    """ INSERT generating the time rows of keys first_key to last_key inclusive """
+    digits = len(str(last_key - first_key))
+    offset = ' + '.join('{} * d{}.d'.format(10 ** i, i) for i in range(digits))
+    return ("""
+    INSERT INTO time (time_key, start_time, hour, day, week, month, year, weekday)
+    WITH digits AS (
+        SELECT 0 AS d UNION ALL SELECT 1 UNION ALL SELECT 2 UNION ALL SELECT 3 UNION ALL
+        SELECT 4 UNION ALL SELECT 5 UNION ALL SELECT 6 UNION ALL SELECT 7 UNION ALL
+        SELECT 8 UNION ALL SELECT 9
+    ), keys AS (
+        SELECT {first} + {offset} AS time_key
+          FROM {digits}
+    )
+    SELECT time_key,
+           start_time,
+           EXTRACT(hour     FROM start_time) AS hour,
+           EXTRACT(day      FROM start_time) AS day,
+           EXTRACT(week     FROM start_time) AS week,
+           EXTRACT(month    FROM start_time) AS month,
+           EXTRACT(year     FROM start_time) AS year,
+           EXTRACT(dow      FROM start_time) AS weekday
+      FROM (SELECT time_key,
+                   TIMESTAMP '1970-01-01 00:00:00'
+                       + CAST(time_key AS BIGINT) * {seconds} * INTERVAL '1 second' AS start_time
+              FROM keys
+             WHERE time_key <= {last}) AS generated;
+""").format(first=first_key, last=last_key, offset=offset,
+           seconds=GRANULARITY_SECONDS[granularity],
+           digits=' CROSS JOIN '.join('digits d{}'.format(i) for i in range(digits)))
+
+
+time_key_range = "SELECT MIN(time_key), MAX(time_key) FROM time;"
+staged_time_range = "SELECT MIN(ts), MAX(ts) FROM staging_events WHERE page = 'NextSong';"
+
+# List of data types for amazon redshift
+# https://docs.aws.amazon.com/redshift/latest/dg/c_Supported_data_types.html
+
+
+
+
+
+
+# Rollups are rebuilt for the days present in staging only, so a load costs
+# in proportion to the days it touches rather than the whole fact table.
+songplay_day = "CAST(start_time AS DATE)"
+staged_days = ("""
+    SELECT DISTINCT CAST(ts AS DATE)
       FROM staging_events
      WHERE page = 'NextSong'
 """)
 
-import configparser
 
-# List of data types for amazon redshift
-# https://docs.aws.amazon.com/redshift/latest/dg/c_Supported_data_types.html
+def rollup_refresh(table, column, expression, days=staged_days):
+    """ DELETE and INSERT statements that rebuild one rollup for the days query days """
+    return ("""
+    DELETE FROM {table}
+     WHERE day IN ({staged_days});
+""".format(table=table, staged_days=days), """
+    INSERT INTO {table} (day, {column}, plays)
+    SELECT {day} AS day,
+           {expression} AS {column},
+           COUNT(*) AS plays
+      FROM songplay
+     WHERE {day} IN ({staged_days})
+     GROUP BY 1, 2;
+""".format(table=table, column=column, expression=expression, day=songplay_day,
+           staged_days=days))
+
+
+songplay_user_day_refresh = rollup_refresh('songplay_user_day', 'user_id', 'user_id')
+songplay_location_day_refresh = rollup_refresh('songplay_location_day', 'location', 'location')
+songplay_song_day_refresh = rollup_refresh('songplay_song_day', 'song_id', 'song_id')
+songplay_hour_day_refresh = rollup_refresh(
+    'songplay_hour_day', 'hour', "EXTRACT(hour FROM start_time)")
+
+
+
+# INCREMENTAL LOAD
+# Staging holds only the files added since the last run, each dimension is
+# merged (delete matching keys, then insert) and the fact table only takes
+# events newer than the recorded max ts. Staging holds only the new songs,
+# so the new events are matched against songs, merged first.
+
+staging_events_truncate =   "TRUNCATE staging_events;"
+staging_songs_truncate =    "TRUNCATE staging_songs;"
+staging_events_load_truncate = "TRUNCATE staging_events_load;"
+staging_songs_load_truncate = "TRUNCATE staging_songs_load;"
+
+def songplay_table_merge(settings):
+    return songplay_table_insert(settings, songs='songs') + """
+      AND e.ts > %(max_ts)s
+"""
 
-# CONFIG
-config = configparser.ConfigParser()
-config.read('dwh.cfg')
+user_table_merge = ("""
+    DELETE FROM users
+     USING staging_events e
+     WHERE users.user_id = e.userId
+       AND e.page = 'NextSong';
+""", user_table_insert)
+
+# Add the versions of the new events, continuing each user's current
+# version, then close the current versions a newer one replaced
+user_history_merge = (user_history_select.format(
+    current='c.level',
+    join="""
+          LEFT JOIN users_history c
+            ON c.user_id = e.userId
+           AND c.is_current""",
+    filter="""
+           AND e.ts > %(max_ts)s"""), """
+    UPDATE users_history
+       SET valid_to = n.valid_from,
+           is_current = FALSE
+      FROM (SELECT user_id, MIN(valid_from) AS valid_from
+              FROM users_history
+             WHERE valid_from > %(max_ts)s
+             GROUP BY user_id) AS n
+     WHERE users_history.user_id = n.user_id
+       AND users_history.is_current
+       AND users_history.valid_from < n.valid_from;
+""")
 
+song_table_merge = ("""
+    DELETE FROM songs
+     USING staging_songs s
+     WHERE songs.song_id = s.song_id;
+""", song_table_insert)
+
+artist_table_merge = ("""
+    DELETE FROM artists
+     USING staging_songs s
+     WHERE artists.artist_id = s.artist_id;
+""", artist_table_insert)
+
+
+
+# RELOAD
+# Staging holds only files reloaded after their quarantined records were
+# fixed. Songs and artists merge by key as in an incremental load, first,
+# so the reloaded events are matched against every known song. Only the
+# events without a songplay yet are inserted, so lines loaded the first
+# time are not counted twice, and songplays left unmatched are matched to
+# the reloaded songs. The events are older than what users holds, so users
+# only gains the ones it does not know yet.
+
+def songplay_table_reload_insert(settings):
+    return songplay_table_insert(settings, songs='songs') + """
+      AND NOT EXISTS (SELECT 1
+                        FROM songplay p
+                       WHERE p.session_id = e.sessionId
+                         AND p.user_id = e.userId
+                         AND p.start_time = e.ts)
+"""
 
+songplay_rematch = ("""
+    UPDATE songplay
+       SET song_id = s.song_id,
+           artist_id = s.artist_id
+      FROM songs s
+     WHERE songplay.song_id IS NULL
+       AND songplay.match_key = s.match_key
+       AND s.match_key IN (SELECT match_key FROM staging_songs);
+""")
 
+# days of the staged events and of the songplays of the staged songs
+reloaded_days = staged_days + """
+     UNION
+    SELECT DISTINCT CAST(start_time AS DATE)
+      FROM songplay
+     WHERE match_key IN (SELECT match_key FROM staging_songs)
+"""
+
+user_table_reload = ("""
+    INSERT INTO users (user_id, first_name, last_name, gender, level)
+    SELECT user_id, first_name, last_name, gender, level
+      FROM (SELECT userId       AS user_id,
+                   firstName    AS first_name,
+                   lastName     AS last_name,
+                   gender,
+                   level,
+                   ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS row_num
+              FROM staging_events
+             WHERE page = 'NextSong'
+               AND userId IS NOT NULL) AS latest
+     WHERE row_num = 1
+       AND NOT EXISTS (SELECT 1 FROM users u WHERE u.user_id = latest.user_id);
+""")
+
+
+watermark_select = "SELECT watermark FROM etl_watermarks WHERE source = %s;"
+watermark_delete = "DELETE FROM etl_watermarks WHERE source = %s;"
+watermark_insert = "INSERT INTO etl_watermarks VALUES (%s, %s, %s);"
+staging_events_max_ts = "SELECT MAX(ts) FROM staging_events WHERE page = 'NextSong';"
+
+# Quarantine the records the last COPY of this session rejected
+load_errors_capture = ("""
+    INSERT INTO load_errors (table_name, filename, line_number, colname, err_code, err_reason,
+                             raw_line, raw_field_value, query_id, recorded_at, resolved)
+    SELECT %s, TRIM(filename), line_number, TRIM(colname), err_code, TRIM(err_reason),
+           TRIM(raw_line), TRIM(raw_field_value), query, starttime, FALSE
+      FROM stl_load_errors
+     WHERE query = pg_last_copy_id();
+""")
+load_errors_insert = ("""
+    INSERT INTO load_errors (table_name, filename, line_number, colname, err_code, err_reason,
+                             raw_line, raw_field_value, query_id, recorded_at, resolved)
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, FALSE);
+""")
+load_errors_copy_files = ("""
+    SELECT DISTINCT TRIM(filename)
+      FROM stl_load_errors
+     WHERE query = pg_last_copy_id();
+""")
+load_errors_pending = ("""
+    SELECT table_name, filename, COUNT(*)
+      FROM load_errors
+     WHERE NOT resolved
+     GROUP BY table_name, filename
+     ORDER BY table_name, filename;
+""")
+load_errors_resolve = ("""
+    UPDATE load_errors
+       SET resolved = TRUE
+     WHERE NOT resolved
+       AND table_name = %s
+       AND filename = %s;
+""")
 
 
 
@@ -361,7 +888,7 @@ test4 = (
          count(*) AS cnt
     FROM songplay sp
     JOIN time t
-      ON sp.start_time = t.start_time
+      ON sp.time_key = t.time_key
 GROUP BY 1
 ORDER BY 2 DESC;
     """
@@ -431,40 +958,212 @@ test9 = (
 )
 
 
+# The test queries answered from the songplay rollups
+
+test1_rollup = (
+"""
+WITH super_users AS (
+    SELECT  user_id, SUM(plays) AS cnt
+    FROM songplay_user_day
+    GROUP BY user_id
+    ORDER BY cnt DESC
+    LIMIT 15
+)
+SELECT users.first_name, 
+       users.last_name, 
+       super_users.cnt
+  FROM super_users
+ INNER JOIN users
+       ON users.user_id = super_users.user_id
+       
+ ORDER BY cnt DESC
+"""
+)
+
+test2_rollup = (
+"""
+SELECT location, 
+       SUM(plays) AS cnt 
+  FROM songplay_location_day
+ GROUP BY location 
+ ORDER BY cnt DESC 
+ LIMIT 50
+"""
+)
+
+test3_rollup = (
+    """
+  SELECT r.song_id, s.title, SUM(r.plays) AS cnt 
+    FROM songplay_song_day r
+    JOIN songs s
+      ON r.song_id = s.song_id
+GROUP BY 1, 2
+ORDER BY 3 DESC
+   LIMIT 10;
+    """
+)
+
+test4_rollup = (
+    """
+  SELECT CASE
+           WHEN r.hour BETWEEN 2 AND 7  THEN '2~7'
+           WHEN r.hour BETWEEN 8 AND 12 THEN '8~12'
+           WHEN r.hour BETWEEN 13 AND 18 THEN '13~18'
+           WHEN r.hour BETWEEN 19 AND 22 THEN '19~22'
+           ELSE '23~24, 0~2'
+         END AS play_time, 
+         SUM(r.plays) AS cnt
+    FROM songplay_hour_day r
+GROUP BY 1
+ORDER BY 2 DESC;
+    """
+)
+
+
 # QUERY LISTS
-create_table_queries =  [
-    staging_events_table_create, 
-    staging_songs_table_create, 
-    user_table_create, 
-    song_table_create, 
-    artist_table_create, 
-    time_table_create, 
-    songplay_table_create
-    ]
+def create_table_queries(settings):
+    return [
+        staging_events_table_create, 
+        staging_songs_table_create, 
+        staging_events_load_create,
+        staging_songs_load_create,
+        user_table_create, 
+        song_table_create, 
+        artist_table_create, 
+        time_table_create, 
+        songplay_table_create,
+        watermark_table_create,
+        load_errors_table_create,
+        songplay_user_day_create,
+        songplay_location_day_create,
+        songplay_song_day_create,
+        songplay_hour_day_create
+    ] + sample_table_queries + ([user_history_table_create] if settings.user_history else [])
 
 drop_table_queries =    [
     staging_events_table_drop, 
     staging_songs_table_drop, 
+    staging_events_load_drop,
+    staging_songs_load_drop,
     songplay_table_drop, 
     user_table_drop, 
     song_table_drop, 
     artist_table_drop, 
-    time_table_drop
+    time_table_drop,
+    watermark_table_drop,
+    load_errors_table_drop,
+    songplay_user_day_drop,
+    songplay_location_day_drop,
+    songplay_song_day_drop,
+    songplay_hour_day_drop,
+    user_history_table_drop
+] + sample_table_drops
+
+
+def copy_table_queries(settings):
+    return [
+        staging_copy('staging_events', settings),
+        staging_copy('staging_songs', settings)
+    ]
+
+keyed_insert_queries = [
+    staging_events_keyed_insert,
+    staging_songs_keyed_insert
 ]
 
-copy_table_queries =    [
-    staging_events_copy, 
-    staging_songs_copy
+# star schema table -> (INSERT statement(s), tables that must be loaded first)
+# The star schema inserts only read staging, so they can all run
+# concurrently; the rollups wait for songplay. time is not in the graph:
+# time_dimension.extend_time_dimension runs before it.
+def insert_table_graph(settings):
+    graph = {
+        'songplay':                 (songplay_table_insert(settings), ()),
+        'users':                    (user_table_insert, ()),
+        'songs':                    (song_table_insert, ()),
+        'artists':                  (artist_table_insert, ()),
+        'songplay_user_day':        (songplay_user_day_refresh, ('songplay',)),
+        'songplay_location_day':    (songplay_location_day_refresh, ('songplay',)),
+        'songplay_song_day':        (songplay_song_day_refresh, ('songplay',)),
+        'songplay_hour_day':        (songplay_hour_day_refresh, ('songplay',)),
+    }
+    if settings.user_history:
+        graph['users_history'] = (user_history_insert, ())
+    return graph
+
+# rollup-backed equivalent of a test query -> rollup tables it reads
+rollup_queries = {
+    test1: (test1_rollup, ('songplay_user_day',)),
+    test2: (test2_rollup, ('songplay_location_day',)),
+    test3: (test3_rollup, ('songplay_song_day',)),
+    test4: (test4_rollup, ('songplay_hour_day',)),
+}
+
+# A rollup is in step with songplay when it counts as many plays up to the
+# same last day. Rows without a start_time have no day and are never rolled up.
+songplay_rollup_totals = "SELECT COUNT(start_time), MAX(CAST(start_time AS DATE)) FROM songplay;"
+rollup_totals = "SELECT SUM(plays), MAX(day) FROM {};"
+
+# staging table -> (S3 source prefix, manifest COPY template)
+def staging_sources(settings):
+    return {
+        'staging_events':   (settings.parquet_log_data or settings.log_data,
+                             staging_copy('staging_events', settings, manifest=True)),
+        'staging_songs':    (settings.parquet_song_data or settings.song_data,
+                             staging_copy('staging_songs', settings, manifest=True)),
+    }
+
+
+def insert_table_queries(settings):
+    return [
+        songplay_table_insert(settings),
+        user_table_insert, 
+        song_table_insert, 
+        artist_table_insert, 
+        *songplay_user_day_refresh,
+        *songplay_location_day_refresh,
+        *songplay_song_day_refresh,
+        *songplay_hour_day_refresh
+    ] + ([user_history_insert] if settings.user_history else [])
+
+def reload_table_queries(settings):
+    return [
+        *song_table_merge,
+        *artist_table_merge,
+        songplay_table_reload_insert(settings),
+        songplay_rematch,
+        user_table_reload,
+        *songplay_user_day_refresh,
+        *songplay_location_day_refresh,
+        *rollup_refresh('songplay_song_day', 'song_id', 'song_id', days=reloaded_days),
+        *songplay_hour_day_refresh
+    ]
+
+
+truncate_staging_queries = [
+    staging_events_truncate,
+    staging_songs_truncate,
+    staging_events_load_truncate,
+    staging_songs_load_truncate
 ]
 
-insert_table_queries =  [
-    songplay_table_insert, 
-    user_table_insert, 
-    song_table_insert, 
-    artist_table_insert, 
-    time_table_insert
+truncate_load_queries = [
+    staging_events_load_truncate,
+    staging_songs_load_truncate
 ]
 
+
+def merge_table_queries(settings):
+    return [
+        *user_table_merge,
+        *song_table_merge,
+        *artist_table_merge,
+        songplay_table_merge(settings),
+        *songplay_user_day_refresh,
+        *songplay_location_day_refresh,
+        *songplay_song_day_refresh,
+        *songplay_hour_day_refresh
+    ] + (list(user_history_merge) if settings.user_history else [])
+
 validation_queries = [
     count_staging_events,
     count_staging_songs,
@@ -485,4 +1184,5 @@ test_queries = [
     test7,
     test8,
     test9
-]
\ No newline at end of file
+]
+
@@ -0,0 +1,157 @@
+import json
+import logging
+import math
+
+
+def parse_s3_url(url):
+    """
+    Split an S3 url into bucket and key prefix
+
+    Arg(s):
+        url: s3://bucket/prefix url, optionally quoted as in dwh.cfg
+    Return(s):
+        (bucket, prefix) tuple
+    """
+    url = url.strip().strip("'\"")
+    if not url.startswith('s3://'):
+        raise ValueError('Not an S3 url: {}'.format(url))
+    bucket, _, prefix = url[len('s3://'):].partition('/')
+    return bucket, prefix
+
+
+def s3_client(config):
+    """
+    Create an S3 client. [S3] ENDPOINT_URL points it at a local S3 stand-in.
+
+    Arg(s):
+        config: config object
+    Return(s):
+        boto3 S3 client
+    """
+    import boto3
+
+    options = dict(region_name=config['CLUSTER'].get('REGION'))
+    if config['AWS'].get('AWS_ACCESS_KEY_ID'):
+        options.update(aws_access_key_id=config['AWS']['AWS_ACCESS_KEY_ID'],
+                       aws_secret_access_key=config['AWS']['AWS_SECRET_ACCESS_KEY'])
+    endpoint_url = config['S3'].get('ENDPOINT_URL')
+    if endpoint_url:
+        options['endpoint_url'] = endpoint_url
+    return boto3.client('s3', **options)
+
+
+def _iter_objects(s3, url, start_after=None):
+    """ (s3 url, size, LastModified) of the data files under an S3 prefix, in key order """
+    bucket, prefix = parse_s3_url(url)
+    options = dict(Bucket=bucket, Prefix=prefix)
+    if start_after:
+        options['StartAfter'] = start_after
+    for page in s3.get_paginator('list_objects_v2').paginate(**options):
+        for obj in page.get('Contents', []):
+            if obj['Key'].endswith('/') or obj['Size'] == 0:
+                continue
+            yield 's3://{}/{}'.format(bucket, obj['Key']), obj['Size'], obj['LastModified']
+
+
+def list_objects(s3, url, start_after=None):
+    """
+    List the data files under an S3 prefix, sorted by key
+
+    Arg(s):
+        s3: boto3 S3 client
+        url: s3://bucket/prefix to list
+        start_after: only list keys sorting after this one
+    Return(s):
+        list of (s3 url, size in bytes) tuples
+    """
+    return sorted((obj[0], obj[1]) for obj in _iter_objects(s3, url, start_after))
+
+
+def list_modified(s3, url, modified_after=None):
+    """
+    List the data files under an S3 prefix modified after a time, for
+    sources whose keys do not sort in arrival order. The whole prefix is
+    listed: S3 can only skip ahead by key.
+
+    Arg(s):
+        s3: boto3 S3 client
+        url: s3://bucket/prefix to list
+        modified_after: timezone-aware datetime, None lists every file
+    Return(s):
+        sorted list of (s3 url, size in bytes, LastModified) tuples
+    """
+    return sorted(obj for obj in _iter_objects(s3, url)
+                  if modified_after is None or obj[2] > modified_after)
+
+
+def shard_objects(objects, slices, max_parallel):
+    """
+    Split a sorted list of objects into contiguous key-prefix shards of
+    roughly equal size. Each shard gets at least one file per slice so that
+    a single shard COPY still keeps every slice of the cluster busy.
+
+    Arg(s):
+        objects: sorted list of (s3 url, size) tuples
+        slices: number of slices in the cluster
+        max_parallel: maximum number of shards
+    Return(s):
+        list of shards, each a list of (s3 url, size) tuples
+    """
+    if not objects:
+        return []
+    num_shards = max(1, min(max_parallel, len(objects) // max(1, slices)))
+    target = math.ceil(sum(size for _, size in objects) / num_shards)
+
+    shards, shard, shard_size = [], [], 0
+    for obj in objects:
+        shard.append(obj)
+        shard_size += obj[1]
+        if shard_size >= target and len(shards) < num_shards - 1:
+            shards.append(shard)
+            shard, shard_size = [], 0
+    if shard:
+        shards.append(shard)
+    return shards
+
+
+def write_manifest(s3, objects, manifest_url):
+    """
+    Upload a COPY manifest listing the given objects
+
+    Arg(s):
+        s3: boto3 S3 client
+        objects: list of (s3 url, size) tuples
+        manifest_url: s3 url the manifest is written to
+    Return(s):
+        manifest_url
+    """
+    bucket, key = parse_s3_url(manifest_url)
+    manifest = {'entries': [
+        {'url': url, 'mandatory': True, 'meta': {'content_length': size}}
+        for url, size in objects
+    ]}
+    s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(manifest).encode('utf-8'))
+    logging.info('Wrote manifest {} with {} files'.format(manifest_url, len(objects)))
+    return manifest_url
+
+
+def shard_manifests(s3, table, objects, manifest_prefix, slices, max_parallel):
+    """
+    Shard the listed files of a source and write one manifest per shard
+
+    Arg(s):
+        s3: boto3 S3 client
+        table: staging table the manifests are for, used to name them
+        objects: sorted list of (s3 url, size) tuples, see list_objects
+        manifest_prefix: s3 prefix the manifests are written under
+        slices: number of slices in the cluster
+        max_parallel: maximum number of shards
+    Return(s):
+        list of (manifest url, objects) tuples
+    """
+    manifest_prefix = manifest_prefix.strip().strip("'\"").rstrip('/')
+    manifests = []
+    for i, shard in enumerate(shard_objects(objects, slices, max_parallel)):
+        manifest_url = '{}/{}-{:04d}.manifest'.format(manifest_prefix, table, i)
+        manifests.append((write_manifest(s3, shard, manifest_url), shard))
+    return manifests
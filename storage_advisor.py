@@ -0,0 +1,305 @@
+import argparse
+import hashlib
+import logging
+import math
+import re
+from collections import Counter
+
+from config import cluster_slices, config
+from key_advisor import current_layout
+from local_loader import LOG_JSONPATHS, LOG_ZIP, iter_records, project_event, read_jsonpaths
+from schema import COLUMN_RE, ddl_columns, table_name
+from sql_queries import create_table_queries, staging_events_table_create
+
+INTEGER_TYPES = (('SMALLINT', 2 ** 15), ('INTEGER', 2 ** 31), ('BIGINT', 2 ** 63))
+STRING_TYPES = ('VARCHAR', 'CHAR', 'TEXT')
+# Types AZ64 can encode
+# https://docs.aws.amazon.com/redshift/latest/dg/az64-encoding.html
+AZ64_TYPES = ('SMALLINT', 'INTEGER', 'INT', 'BIGINT', 'DECIMAL', 'NUMERIC', 'DATE', 'TIMESTAMP',
+              'TIMESTAMPTZ')
+
+# VARCHAR widths recommended, the smallest that fits the longest value plus headroom
+VARCHAR_WIDTHS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 65535)
+HEADROOM = 1.25
+# BYTEDICT keeps a dictionary of up to 256 values per block
+BYTEDICT_MAX_DISTINCT = 256
+# Average run length, in load order, from which RUNLENGTH beats the others
+RUNLENGTH_MIN_RUN = 8
+# Distinct values tracked per column before it counts as high cardinality
+DISTINCT_CAP = 100000
+
+
+class ColumnProfile:
+    """ Width, range, cardinality and run statistics of one column """
+
+    def __init__(self, name, col_type, length):
+        self.name = name
+        self.col_type = col_type
+        self.length = length
+        self.rows = 0
+        self.nulls = 0
+        self.max_bytes = 0
+        self.minimum = None
+        self.maximum = None
+        self.integral = True
+        self.runs = 0
+        self.distinct = 0
+        self._values = set()
+        self._last = object()
+
+    def add(self, value):
+        self.rows += 1
+        if value is None or (isinstance(value, str) and not value.strip()):
+            value = None
+            self.nulls += 1
+        else:
+            text = str(value)
+            self.max_bytes = max(self.max_bytes, len(text.encode('utf-8')))
+            number = _as_number(value)
+            if number is None:
+                self.integral = False
+            else:
+                self.integral = self.integral and float(number).is_integer()
+                self.minimum = number if self.minimum is None else min(self.minimum, number)
+                self.maximum = number if self.maximum is None else max(self.maximum, number)
+            if self._values is not None:
+                self._values.add(value)
+                if len(self._values) > DISTINCT_CAP:
+                    self._values = None
+        if value != self._last:
+            self.runs += 1
+            self._last = value
+        self.distinct = len(self._values) if self._values is not None else DISTINCT_CAP
+
+    @property
+    def numeric(self):
+        return self.minimum is not None and self.rows > self.nulls and (
+            self.col_type not in STRING_TYPES or self.integral)
+
+
+def _as_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return int(value) if re.match(r'^-?\d+$', str(value).strip()) else None
+    except ValueError:
+        return None
+
+
+def profile_records(columns, rows, distkey=None):
+    """
+    Profile rows of a table
+
+    Args:
+        columns: ddl_columns of the table
+        rows: iterable of value lists, in column order
+        distkey: column whose value counts are kept for the skew report
+    Returns:
+        (list of ColumnProfile, Counter of distkey values)
+    """
+    profiles = [ColumnProfile(*column) for column in columns]
+    index = [c[0].lower() for c in columns].index(distkey) if distkey else None
+    keys = Counter()
+    for row in rows:
+        for profile, value in zip(profiles, row):
+            profile.add(value)
+        if index is not None:
+            value = row[index]
+            keys[None if isinstance(value, str) and not value.strip() else value] += 1
+    return profiles, keys
+
+
+def profile_zip(zip_path=LOG_ZIP, jsonpaths=LOG_JSONPATHS, distkey=None):
+    """ Profile staging_events as it would be loaded from data/log_data.zip """
+    keys = read_jsonpaths(jsonpaths)
+    rows = (project_event(record, keys) for _, _, record in iter_records(zip_path))
+    return profile_records(ddl_columns(staging_events_table_create), rows, distkey)
+
+
+def profile_table(cur, ddl, distkey=None):
+    """
+    Profile a live table with one aggregate query, plus one GROUP BY on the distkey
+
+    Run counts need the load order, which a table scan does not give, so
+    RUNLENGTH is never recommended from a live profile.
+    """
+    table = table_name(ddl)
+    columns = ddl_columns(ddl)
+    selects = ['COUNT(*)']
+    for name, col_type, _ in columns:
+        selects.append('COUNT({})'.format(name))
+        selects.append('COUNT(DISTINCT {})'.format(name))
+        if col_type in STRING_TYPES:
+            selects.append('MAX(OCTET_LENGTH({}))'.format(name))
+            selects += ['NULL', 'NULL']
+        else:
+            selects.append('NULL')
+            selects += ['MIN({})'.format(name), 'MAX({})'.format(name)]
+    cur.execute('SELECT {} FROM {};'.format(', '.join(selects), table))
+    result = cur.fetchone()
+
+    profiles = []
+    for i, column in enumerate(columns):
+        non_null, distinct, max_bytes, minimum, maximum = result[1 + 5 * i:6 + 5 * i]
+        profile = ColumnProfile(*column)
+        profile.rows, profile.nulls = result[0], result[0] - non_null
+        profile.distinct, profile.max_bytes = distinct, max_bytes or 0
+        profile.runs = profile.rows
+        if minimum is not None and isinstance(minimum, (int, float)):
+            profile.minimum, profile.maximum = minimum, maximum
+            profile.integral = isinstance(minimum, int) and isinstance(maximum, int)
+        else:
+            profile.integral = False
+        profiles.append(profile)
+
+    keys = Counter()
+    if distkey:
+        cur.execute('SELECT {0}, COUNT(*) FROM {1} GROUP BY {0};'.format(distkey, table))
+        keys.update(dict(cur.fetchall()))
+    return profiles, keys
+
+
+def recommend_type(profile):
+    """ Narrowest type that holds every profiled value, e.g. SMALLINT or VARCHAR(64) """
+    if profile.rows == profile.nulls:
+        return _declared(profile)
+    if profile.numeric and profile.integral and profile.col_type in STRING_TYPES + tuple(
+            t for t, _ in INTEGER_TYPES):
+        bound = max(abs(profile.minimum), abs(profile.maximum) + 1)
+        return next(t for t, limit in INTEGER_TYPES if bound <= limit)
+    if profile.col_type in STRING_TYPES:
+        width = math.ceil(profile.max_bytes * HEADROOM)
+        return 'VARCHAR({})'.format(next((w for w in VARCHAR_WIDTHS if w >= width),
+                                         VARCHAR_WIDTHS[-1]))
+    return _declared(profile)
+
+
+def _declared(profile):
+    return '{}({})'.format(profile.col_type, profile.length) if profile.length else profile.col_type
+
+
+def recommend_encoding(profile, col_type, sortkey=None):
+    """
+    Column compression for Redshift
+
+    * the sort key stays RAW, so zone maps stay effective
+    * long runs of equal values, in load order: RUNLENGTH
+    * numbers and dates: AZ64
+    * strings with at most 256 distinct values: BYTEDICT
+    * everything else: ZSTD
+    """
+    if profile.name.lower() == sortkey:
+        return 'RAW'
+    if profile.runs and profile.rows / profile.runs >= RUNLENGTH_MIN_RUN:
+        return 'RUNLENGTH'
+    base = col_type.split('(')[0]
+    if base in AZ64_TYPES:
+        return 'AZ64'
+    if base in STRING_TYPES and profile.distinct <= BYTEDICT_MAX_DISTINCT:
+        return 'BYTEDICT'
+    return 'ZSTD'
+
+
+def slice_of(value, slices):
+    """ Slice a distkey value hashes to. NULLs all land on one slice. """
+    digest = hashlib.md5(repr(value).encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % slices
+
+
+def slice_skew(keys, slices):
+    """
+    Rows per slice for a distribution on a column
+
+    Args:
+        keys: Counter of distkey value -> rows
+        slices: number of slices of the cluster
+    Returns:
+        (rows per slice, skew) where skew is the fullest slice over the mean, 1.0 is even
+    """
+    rows = [0] * slices
+    for value, count in keys.items():
+        rows[slice_of(value, slices)] += count
+    mean = sum(rows) / float(slices)
+    return rows, (max(rows) / mean if mean else 1.0)
+
+
+def rewrite_columns(ddl, recommendations):
+    """ CREATE TABLE statement with column types and encodings replaced """
+    lines = []
+    for line in ddl.split('\n'):
+        match = COLUMN_RE.match(line)
+        name = match.group(1).lower() if match else None
+        if name in recommendations:
+            col_type, encoding = recommendations[name]
+            rest = re.sub(r'\s+ENCODE\s+\w+', '', line[match.end():], flags=re.IGNORECASE)
+            identity = re.match(r'\s*IDENTITY\s*\([^)]*\)', rest, re.IGNORECASE)
+            split = identity.end() if identity else 0
+            line = '{}{}{} ENCODE {}{}'.format(line[:match.start(2)], col_type, rest[:split],
+                                               encoding.lower(), rest[split:])
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def report(ddl, profiles, keys, distkey, slices):
+    """ Print the profile, recommendations, revised DDL and skew of one table """
+    sortkey = current_layout(ddl)[2]
+    recommendations = {}
+    print('\n{}: {} rows'.format(table_name(ddl), profiles[0].rows if profiles else 0))
+    print('  {:<18} {:<16} {:>7} {:>9} {:>9}  {:<14} {}'.format(
+        'column', 'declared', 'null %', 'distinct', 'max bytes', 'recommended', 'encode'))
+    for profile in profiles:
+        col_type = recommend_type(profile)
+        encoding = recommend_encoding(profile, col_type, sortkey)
+        recommendations[profile.name.lower()] = (col_type, encoding)
+        print('  {:<18} {:<16} {:>7.1f} {:>9} {:>9}  {:<14} {}'.format(
+            profile.name, _declared(profile),
+            100.0 * profile.nulls / profile.rows if profile.rows else 0.0,
+            profile.distinct, profile.max_bytes, col_type, encoding))
+    print(rewrite_columns(ddl, recommendations))
+
+    if distkey:
+        rows, skew = slice_skew(keys, slices)
+        print('  rows per slice distributed on {}: min {} max {} skew {:.2f}'.format(
+            distkey, min(rows), max(rows), skew))
+        top, count = keys.most_common(1)[0] if keys else (None, 0)
+        if count:
+            print('  most frequent {}: {!r} in {} rows ({:.1f}%)'.format(
+                distkey, top, count, 100.0 * count / sum(keys.values())))
+
+
+def main(args):
+    slices = args.slices or cluster_slices(config)
+    if args.live:
+        from db import session
+        ddls = [d for d in create_table_queries(config.settings)
+                if not args.tables or table_name(d) in args.tables]
+        with session() as (cur, conn):
+            for ddl in ddls:
+                distkey = args.distkey or current_layout(ddl)[1]
+                profiles, keys = profile_table(cur, ddl, distkey)
+                report(ddl, profiles, keys, distkey, slices)
+            conn.rollback()
+    else:
+        distkey = args.distkey or current_layout(staging_events_table_create)[1]
+        profiles, keys = profile_zip(args.zip_path, args.jsonpaths, distkey)
+        report(staging_events_table_create, profiles, keys, distkey, slices)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Recommend column types, encodings and report distkey skew from profiled data')
+    parser.add_argument('--live', dest='live', default=False, action='store_true',
+                        help='profile the tables on the cluster instead of data/log_data.zip')
+    parser.add_argument('--table', dest='tables', action='append', default=[],
+                        help='with --live, profile only this table (repeatable)')
+    parser.add_argument('--distkey', dest='distkey', default=None,
+                        help='report skew for this column instead of the declared distkey')
+    parser.add_argument('--slices', dest='slices', type=int, default=None,
+                        help='defaults to the slices of the cluster in dwh.cfg')
+    parser.add_argument('--zip', dest='zip_path', default=LOG_ZIP)
+    parser.add_argument('--jsonpaths', dest='jsonpaths', default=LOG_JSONPATHS)
+    args = parser.parse_args()
+    main(args)
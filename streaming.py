@@ -0,0 +1,180 @@
+import csv
+import itertools
+import logging
+import os
+
+_cursor_ids = itertools.count()
+
+# Rows a ParquetSink buffers while some column is NULL in every row so far,
+# before it settles on a string type for it
+SCHEMA_BUFFER_ROWS = 100000
+
+
+def stream_rows(conn, query, chunksize=10000):
+    """
+    Run a query on a named server-side cursor and fetch it chunk by chunk,
+    so client memory stays bounded by one chunk whatever the result size
+
+    Args:
+        conn: db connection, the cursor lives in its current transaction
+        query: SELECT statement
+        chunksize: rows fetched per round trip
+    Yields:
+        (column names, list of rows) tuples, a single one with no rows for an
+        empty result, so sinks still write its columns
+    """
+    cur = conn.cursor(name='stream_{}'.format(next(_cursor_ids)))
+    cur.itersize = chunksize
+    try:
+        cur.execute(query)
+        chunks = 0
+        while True:
+            rows = cur.fetchmany(chunksize)
+            if not rows and chunks:
+                break
+            chunks += 1
+            yield [col[0] for col in cur.description], rows
+            if not rows:
+                break
+    finally:
+        cur.close()
+
+
+def stream_dataframes(conn, query, chunksize=10000):
+    """ Like stream_rows, as one pandas DataFrame per chunk """
+    import pandas as pd
+    for columns, rows in stream_rows(conn, query, chunksize):
+        yield pd.DataFrame(rows, columns=columns)
+
+
+def stream_record_batches(conn, query, chunksize=10000):
+    """ Like stream_rows, as one pyarrow RecordBatch per chunk """
+    import pyarrow as pa
+    for frame in stream_dataframes(conn, query, chunksize):
+        yield pa.RecordBatch.from_pandas(frame, preserve_index=False)
+
+
+class CsvSink:
+    """ Appends DataFrame chunks to a CSV file """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w', newline='')
+        self._writer = None
+
+    def write(self, frame):
+        if self._writer is None:
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(frame.columns)
+        self._writer.writerows(frame.itertuples(index=False, name=None))
+
+    def close(self):
+        self._file.close()
+
+
+class ParquetSink:
+    """
+    Appends DataFrame chunks to a Parquet file, one row group per chunk.
+
+    The file schema comes from the first chunks: columns that are NULL in
+    every row are typed by a later chunk, buffering up to SCHEMA_BUFFER_ROWS
+    rows, else as strings. Later chunks are cast to it, so a column pandas
+    turned from int to float because of a NULL is written as declared. An
+    empty result still gets a file with its columns.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._writer = None
+        self._pending = []
+
+    def write(self, frame):
+        import pyarrow as pa
+        table = pa.Table.from_pandas(unique_columns(frame), preserve_index=False)
+        if self._writer is not None:
+            self._writer.write_table(_conform(table, self._writer.schema))
+            return
+        self._pending.append(table)
+        if all(not pa.types.is_null(field.type) for field in table.schema) or \
+                sum(t.num_rows for t in self._pending) >= SCHEMA_BUFFER_ROWS:
+            self._flush()
+
+    def _flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        schema = self._pending[0].schema.remove_metadata()
+        for i, field in enumerate(schema):
+            if pa.types.is_null(field.type):
+                known = [t.schema.field(i).type for t in self._pending
+                         if not pa.types.is_null(t.schema.field(i).type)]
+                schema = schema.set(i, field.with_type(known[0] if known else pa.string()))
+        self._writer = pq.ParquetWriter(self.path, schema)
+        for table in self._pending:
+            self._writer.write_table(_conform(table, schema))
+        self._pending = []
+
+    def close(self):
+        if self._writer is None and self._pending:
+            self._flush()
+        if self._writer is not None:
+            self._writer.close()
+
+
+def unique_columns(frame):
+    """ Frame with repeated column names, e.g. of a SELECT * join, suffixed _2, _3... """
+    seen, names = {}, []
+    for name in frame.columns:
+        seen[name] = seen.get(name, 0) + 1
+        names.append(name if seen[name] == 1 else '{}_{}'.format(name, seen[name]))
+    if len(set(frame.columns)) == len(names):
+        return frame
+    frame = frame.copy(deep=False)
+    frame.columns = names
+    return frame
+
+
+def _conform(table, schema):
+    """ Cast a table to a file schema, column by column """
+    import pyarrow as pa
+    columns = []
+    for field in schema:
+        column = table.column(field.name)
+        if pa.types.is_null(column.type):
+            column = pa.nulls(len(column), field.type)
+        elif column.type != field.type:
+            try:
+                column = column.cast(field.type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+                raise ValueError('Column {} of type {} does not fit the {} of the file: {}'.format(
+                    field.name, column.type, field.type, e))
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def open_sink(path):
+    """ CsvSink or ParquetSink depending on the file extension, creating its directory """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    return ParquetSink(path) if os.path.splitext(path)[1] == '.parquet' else CsvSink(path)
+
+
+def write_stream(chunks, sink):
+    """
+    Drain DataFrame chunks into a sink
+
+    Args:
+        chunks: iterable of DataFrames
+        sink: CsvSink or ParquetSink
+    Returns:
+        number of rows written
+    """
+    total = 0
+    try:
+        for frame in chunks:
+            sink.write(frame)
+            total += len(frame)
+    finally:
+        sink.close()
+    logging.info('Wrote {} rows to {}'.format(total, sink.path))
+    return total
@@ -0,0 +1,133 @@
+import argparse
+import datetime
+import logging
+import math
+
+from config import config
+from sql_queries import GRANULARITY_SECONDS, staged_time_range, time_key_range, \
+    time_table_generate
+from watermarks import get_watermark, set_watermark
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# etl_watermarks entry of the granularity the time table was generated at
+GRANULARITY_WATERMARK = 'time.granularity'
+
+
+def time_key(ts, granularity):
+    """ Python twin of sql_queries.time_key: epoch seconds of ts divided by the step """
+    step = GRANULARITY_SECONDS[granularity]
+    return int(math.floor((ts - EPOCH).total_seconds() / step))
+
+
+def configured_range(settings):
+    """
+    Key range of the [TIME] START and END dates, END exclusive
+
+    Args:
+        settings: config.Settings
+    Returns:
+        (first key, last key), or None if no range is configured
+    """
+    if not settings.time_start or not settings.time_end:
+        return None
+    return (time_key(settings.time_start, settings.time_granularity),
+            time_key(settings.time_end, settings.time_granularity) - 1)
+
+
+def missing_ranges(wanted, existing):
+    """
+    Key ranges to generate so the time table covers wanted. The table always
+    holds one contiguous range, so it only ever grows at either end.
+
+    Args:
+        wanted: (first, last) keys that must exist
+        existing: (first, last) keys already in the table, (None, None) if empty
+    Returns:
+        list of (first, last) ranges
+    """
+    first, last = wanted
+    lo, hi = existing
+    if lo is None:
+        return [(first, last)]
+    # new keys are always joined to the table, without a gap
+    first, last = min(first, hi + 1), max(last, lo - 1)
+    ranges = []
+    if first < lo:
+        ranges.append((first, lo - 1))
+    if last > hi:
+        ranges.append((hi + 1, last))
+    return ranges
+
+
+def check_granularity(cur, granularity, existing):
+    """
+    Refuse to extend a time table generated at another granularity: its
+    keys, and the songplay.time_key values joined to them, count other steps.
+    Records the granularity of a table that is empty or predates the record.
+
+    Args:
+        cur: cursor to the db connection
+        granularity: the [TIME] GRANULARITY of this run
+        existing: (first, last) keys already in the table, (None, None) if empty
+    """
+    recorded = get_watermark(cur, GRANULARITY_WATERMARK)
+    if existing[0] is not None and recorded is not None and recorded != granularity:
+        raise ValueError(
+            'The time table was generated at {} granularity, [TIME] GRANULARITY is {}: set it '
+            'back or rebuild with create_tables.py and a full load'.format(recorded, granularity))
+    if recorded != granularity:
+        set_watermark(cur, GRANULARITY_WATERMARK, granularity)
+
+
+def extend_time_dimension(cur, settings, conn=None):
+    """
+    Generate the time rows for the configured date range and for every event
+    in staging that falls outside what the table already covers. Once the
+    table covers the data, a load costs two MIN/MAX queries. A table
+    generated at another granularity is refused, see check_granularity.
+
+    Args:
+        cur: cursor to the db connection
+        settings: config.Settings with the granularity and the optional [TIME] START and END
+        conn: db connection, committed if given
+    Returns:
+        number of time rows generated
+    """
+    granularity = settings.time_granularity
+    cur.execute(time_key_range)
+    existing = cur.fetchone()
+    check_granularity(cur, granularity, existing)
+
+    wanted = [configured_range(settings)]
+    cur.execute(staged_time_range)
+    staged = cur.fetchone()
+    if staged and staged[0] is not None:
+        wanted.append((time_key(staged[0], granularity), time_key(staged[1], granularity)))
+    wanted = [r for r in wanted if r]
+    generated = 0
+    if wanted:
+        first, last = min(r[0] for r in wanted), max(r[1] for r in wanted)
+        for lo, hi in missing_ranges((first, last), existing):
+            logging.info('Generating time keys {} to {}'.format(lo, hi))
+            cur.execute(time_table_generate(lo, hi, granularity))
+            generated += hi - lo + 1
+    if conn is not None:
+        conn.commit()
+    print('{} time rows generated at {} granularity.'.format(
+        generated, granularity))
+    return generated
+
+
+def main(args):
+    from db import session
+    with session() as (cur, conn):
+        extend_time_dimension(cur, config.settings, conn)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(
+        description='Generate the time dimension for [TIME] START to END and the staged events')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,59 @@
+import datetime
+import logging
+
+from sql_queries import watermark_table_create, watermark_select, watermark_delete, \
+    watermark_insert
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def ensure_watermark_table(cur):
+    """ Create the watermark table if it does not exist yet """
+    cur.execute(watermark_table_create)
+
+
+def get_watermark(cur, source, default=None):
+    """
+    Read the high-water mark recorded for a source
+
+    Args:
+        cur: cursor to the db connection
+        source: name of the source, e.g. a staging table or 'songplay.ts'
+        default: value returned when nothing was recorded yet
+    Returns:
+        the recorded watermark as a string, or default
+    """
+    cur.execute(watermark_select, (source,))
+    row = cur.fetchone()
+    return row[0] if row and row[0] is not None else default
+
+
+def get_timestamp_watermark(cur, source):
+    """
+    Read a TIMESTAMP high-water mark. Watermarks recorded as epoch millis,
+    before staging typed ts, are converted.
+
+    Returns:
+        datetime, the epoch if nothing was recorded yet
+    """
+    value = get_watermark(cur, source)
+    if value is None:
+        return EPOCH
+    if value.isdigit():
+        return EPOCH + datetime.timedelta(milliseconds=int(value))
+    return datetime.datetime.fromisoformat(value)
+
+
+def set_watermark(cur, source, value):
+    """
+    Record the high-water mark for a source. Not committed, so it can share
+    the transaction of the merge it describes.
+
+    Args:
+        cur: cursor to the db connection
+        source: name of the source
+        value: new watermark, stored as a string
+    """
+    cur.execute(watermark_delete, (source,))
+    cur.execute(watermark_insert, (source, str(value), datetime.datetime.utcnow()))
+    logging.info('Watermark {} -> {}'.format(source, value))